@@ -0,0 +1,113 @@
+import copy
+import hashlib
+import threading
+import time
+
+import faiss
+import numpy as np
+
+
+# ------------------------------------------------------------------------------
+# === HISTORY KEY ===
+# ------------------------------------------------------------------------------
+def history_key(chat_history: list, *params) -> str:
+    """
+    Hash of the chat-history state the answer depends on. `generate_answer` only puts
+    the last turn into the prompt, so that turn (plus any retrieval parameters passed
+    in `params`) decides whether a cached answer can be reused.
+    """
+    if chat_history:
+        last = chat_history[-1]
+        state = f"{last['user']}\0{last['assistant']}"
+    else:
+        state = ""
+    state += "\0" + "\0".join(str(p) for p in params)
+    return hashlib.sha1(state.encode("utf-8")).hexdigest()
+
+
+# ------------------------------------------------------------------------------
+# === SEMANTIC ANSWER CACHE ===
+# ------------------------------------------------------------------------------
+class SemanticAnswerCache:
+    """
+    Stores past answers next to the L2-normalized embedding of their question in a
+    small FAISS inner-product index. A new question is served from the cache when a
+    stored question with the same history key has cosine similarity >= `threshold`.
+    Entries expire after `ttl` seconds; past `max_entries` the oldest one is dropped.
+    """
+
+    def __init__(self, threshold: float = 0.95, ttl: float = 6 * 3600, max_entries: int = 1000,
+                 search_width: int = 16):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.search_width = search_width
+        self._lock = threading.Lock()
+        self._index = None
+        self._entries = {}   # faiss id -> entry dict
+        self._next_id = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def _remove(self, ids: list):
+        if ids:
+            self._index.remove_ids(np.array(ids, dtype="int64"))
+            for entry_id in ids:
+                del self._entries[entry_id]
+            self.stats["evictions"] += len(ids)
+
+    def _evict_expired(self):
+        now = time.time()
+        self._remove([i for i, e in self._entries.items() if now - e["created"] > self.ttl])
+
+    def lookup(self, vector: np.ndarray, key: str):
+        """Returns a copy of {"answer", "chunks", "similarity"} or None."""
+        vector = np.asarray(vector, dtype="float32").reshape(1, -1)
+        with self._lock:
+            if self._index is not None:
+                self._evict_expired()
+            if not self._entries:
+                self.stats["misses"] += 1
+                return None
+            distances, ids = self._index.search(vector, min(self.search_width, len(self._entries)))
+            for similarity, entry_id in zip(distances[0], ids[0]):
+                if entry_id < 0 or similarity < self.threshold:
+                    break
+                entry = self._entries[int(entry_id)]
+                if entry["key"] == key:
+                    self.stats["hits"] += 1
+                    return {
+                        "answer": entry["answer"],
+                        "chunks": copy.deepcopy(entry["chunks"]),
+                        "similarity": float(similarity),
+                    }
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, vector: np.ndarray, key: str, answer: str, chunks: list):
+        vector = np.asarray(vector, dtype="float32").reshape(1, -1)
+        with self._lock:
+            if self._index is None:
+                self._index = faiss.IndexIDMap2(faiss.IndexFlatIP(vector.shape[1]))
+            self._evict_expired()
+            overflow = len(self._entries) + 1 - self.max_entries
+            if overflow > 0:
+                oldest = sorted(self._entries, key=lambda i: self._entries[i]["created"])
+                self._remove(oldest[:overflow])
+            entry_id = self._next_id
+            self._next_id += 1
+            self._index.add_with_ids(vector, np.array([entry_id], dtype="int64"))
+            self._entries[entry_id] = {
+                "key": key,
+                "answer": answer,
+                "chunks": copy.deepcopy(chunks),
+                "created": time.time(),
+            }
+
+    def clear(self):
+        with self._lock:
+            if self._index is not None:
+                self._index.reset()
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,253 @@
+"""
+Headless HTTP API around the rag_core pipeline (FastAPI + uvicorn).
+
+    POST /answer          JSON body -> {"answer", "chunks", "timings"}
+    POST /answer/stream   same body -> Server-Sent Events: `chunks`, `token`..., `done`
+                          (or `error`), with the payloads of generate_answer_stream
+    GET  /health          readiness, reranker state, queue depth
+    GET  /reports         report names accepted by the `reports` filter of the body
+    GET  /metrics         tracing histograms in Prometheus text format
+
+Index, chunk store, models and caches are the process-wide ones of rag_core,
+loaded once at start-up. At most RAG_API_MAX_CONCURRENCY pipelines run at a time
+(each on a worker thread); up to RAG_API_MAX_QUEUE more requests wait up to
+RAG_API_QUEUE_TIMEOUT seconds for a slot, anything beyond gets 503 + Retry-After.
+
+    python api.py --host 0.0.0.0 --port 8000 --workers 4
+    uvicorn api:app --workers 4
+
+Each worker is a separate process with its own copy of the pipeline state (the
+memory-mapped index and chunk store pages are shared through the page cache).
+"""
+import argparse
+import asyncio
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Optional
+
+import numpy as np
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import Response, StreamingResponse
+from pydantic import BaseModel
+
+import rag_core
+import serving_client
+import tracing
+
+
+MAX_CONCURRENCY = int(os.environ.get("RAG_API_MAX_CONCURRENCY", "8"))
+MAX_QUEUE = int(os.environ.get("RAG_API_MAX_QUEUE", "32"))
+QUEUE_TIMEOUT = float(os.environ.get("RAG_API_QUEUE_TIMEOUT", "30"))
+
+
+class AnswerRequest(BaseModel):
+    query: str
+    chat_history: list = []
+    k: int = 4
+    window: int = 1
+    rerank_top_n: int = 6
+    mode: Optional[str] = None
+    use_answer_cache: bool = True
+    context_token_budget: Optional[int] = None
+    reports: Optional[list] = None
+
+
+# ------------------------------------------------------------------------------
+# === ADMISSION CONTROL (BOUNDED CONCURRENCY + QUEUE) ===
+# ------------------------------------------------------------------------------
+class Admission:
+    """`max_concurrency` running slots plus at most `max_queue` waiters; the rest are rejected."""
+
+    def __init__(self, max_concurrency: int, max_queue: int, queue_timeout: float):
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.waiting = 0
+        self.running = 0
+
+    async def acquire(self):
+        if self.semaphore.locked() and self.waiting >= self.max_queue:
+            raise HTTPException(503, "Server busy, queue full", headers={"Retry-After": "1"})
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise HTTPException(503, "Server busy, timed out in queue", headers={"Retry-After": "1"})
+        finally:
+            self.waiting -= 1
+        self.running += 1
+
+    def release(self):
+        self.running -= 1
+        self.semaphore.release()
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def _dumps(payload) -> str:
+    return json.dumps(payload, default=_json_default, ensure_ascii=False)
+
+
+def _validate(request: AnswerRequest):
+    if request.mode is not None and request.mode not in rag_core.PIPELINE_MODES:
+        raise HTTPException(400, f"Unknown pipeline mode {request.mode!r}, expected one of {rag_core.PIPELINE_MODES}")
+    if request.reports:
+        index, chunk_store, _ = rag_core.get_faiss_resources()
+        unknown = sorted(set(request.reports) - set(rag_core.available_reports(index, chunk_store)))
+        if unknown:
+            raise HTTPException(400, f"Unknown reports {unknown}")
+
+
+def _pipeline_kwargs(request: AnswerRequest) -> dict:
+    index, chunk_store, lexical_index = rag_core.get_faiss_resources()
+    kwargs = dict(
+        query=request.query, index=index, chunk_store=chunk_store, lexical_index=lexical_index,
+        k=request.k, window=request.window, rerank_top_n=request.rerank_top_n,
+        chat_history=request.chat_history, use_answer_cache=request.use_answer_cache,
+    )
+    if request.mode is not None:
+        kwargs["mode"] = request.mode
+    if request.context_token_budget is not None:
+        kwargs["context_token_budget"] = request.context_token_budget
+    if request.reports:
+        kwargs["report_filter"] = request.reports
+    return kwargs
+
+
+# ------------------------------------------------------------------------------
+# === APPLICATION ===
+# ------------------------------------------------------------------------------
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Same start-up as app.py: shared index, background reranker warm-up
+    await asyncio.get_running_loop().run_in_executor(None, rag_core.get_faiss_resources)
+    rag_core.warm_up_reranker()
+    app.state.admission = Admission(MAX_CONCURRENCY, MAX_QUEUE, QUEUE_TIMEOUT)
+    app.state.executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENCY, thread_name_prefix="rag-api")
+    yield
+    app.state.executor.shutdown(wait=False, cancel_futures=True)
+
+
+app = FastAPI(title="IPCC RAG API", lifespan=lifespan)
+
+
+@app.post("/answer")
+async def answer(request: AnswerRequest, http_request: Request):
+    _validate(request)
+    admission = http_request.app.state.admission
+    await admission.acquire()
+    try:
+        result = await asyncio.get_running_loop().run_in_executor(
+            http_request.app.state.executor,
+            tracing.run_in_context(lambda: rag_core.generate_answer(**_pipeline_kwargs(request))),
+        )
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    finally:
+        admission.release()
+    return Response(_dumps(result), media_type="application/json")
+
+
+def _run_stream(request: AnswerRequest, loop, queue: asyncio.Queue, cancelled: threading.Event):
+    """Worker thread: drives generate_answer_stream and hands each event to the event loop."""
+    events = None
+    try:
+        events = rag_core.generate_answer_stream(**_pipeline_kwargs(request))
+        for event in events:
+            if cancelled.is_set():
+                break
+            loop.call_soon_threadsafe(queue.put_nowait, event)
+    except Exception as e:
+        loop.call_soon_threadsafe(queue.put_nowait, {"type": "error", "error": f"{type(e).__name__}: {e}"})
+    finally:
+        if events is not None:
+            events.close()
+        loop.call_soon_threadsafe(queue.put_nowait, None)
+
+
+@app.post("/answer/stream")
+async def answer_stream(request: AnswerRequest, http_request: Request):
+    _validate(request)
+    admission = http_request.app.state.admission
+    await admission.acquire()
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    cancelled = threading.Event()
+    try:
+        future = loop.run_in_executor(http_request.app.state.executor,
+                                      tracing.run_in_context(_run_stream), request, loop, queue, cancelled)
+    except BaseException:
+        admission.release()
+        raise
+    # The slot is freed when the worker exits, not when the client goes away
+    future.add_done_callback(lambda _: admission.release())
+
+    async def sse():
+        try:
+            while True:
+                event = await queue.get()
+                if event is None:
+                    break
+                yield f"event: {event['type']}\ndata: {_dumps(event)}\n\n"
+        finally:
+            # Client gone or stream finished: the worker stops at its next event
+            cancelled.set()
+
+    return StreamingResponse(sse(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.get("/health")
+async def health(http_request: Request):
+    admission = http_request.app.state.admission
+    index, chunk_store, lexical_index = rag_core.get_faiss_resources()
+    return {
+        "status": "ok",
+        "index_vectors": index.ntotal,
+        "chunks": len(chunk_store),
+        "lexical_index": lexical_index is not None,
+        "resources_version": rag_core.faiss_resources_version(),
+        "loaded_shards": getattr(index, "loaded_reports", None),
+        "reranker_ready": rag_core.reranker.ready,
+        "reranker_loading": rag_core.reranker.loading,
+        "running": admission.running,
+        "queued": admission.waiting,
+        "max_concurrency": MAX_CONCURRENCY,
+        "max_queue": MAX_QUEUE,
+        "serving": serving_client.policy_stats(),
+    }
+
+
+@app.get("/reports")
+async def reports():
+    index, chunk_store, _ = rag_core.get_faiss_resources()
+    return {"reports": rag_core.available_reports(index, chunk_store)}
+
+
+@app.get("/metrics")
+async def metrics():
+    return Response(tracing.prometheus_text(), media_type="text/plain; version=0.0.4")
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default=os.environ.get("RAG_API_HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("RAG_API_PORT", "8000")))
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("RAG_API_WORKERS", "1")))
+    args = parser.parse_args()
+    uvicorn.run("api:app", host=args.host, port=args.port, workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""
+Thin client of the API in api.py (standard library only), used by app.py when
+RAG_API_URL is set. `stream_answer` yields the same events as
+`rag_core.generate_answer_stream`, so the Streamlit loop does not change.
+"""
+import json
+import os
+import urllib.request
+
+
+API_TIMEOUT = float(os.environ.get("RAG_API_TIMEOUT", "120"))
+
+
+def _post(base_url: str, path: str, payload: dict, accept: str, timeout: float):
+    request = urllib.request.Request(
+        base_url.rstrip("/") + path,
+        data=json.dumps(payload).encode("utf-8"),
+        headers={"Content-Type": "application/json", "Accept": accept},
+        method="POST",
+    )
+    return urllib.request.urlopen(request, timeout=timeout)
+
+
+def reports(base_url: str, timeout: float = API_TIMEOUT) -> list:
+    """GET /reports: names accepted by the `reports` filter."""
+    with urllib.request.urlopen(base_url.rstrip("/") + "/reports", timeout=timeout) as response:
+        return json.loads(response.read().decode("utf-8"))["reports"]
+
+
+def answer(base_url: str, query: str, timeout: float = API_TIMEOUT, **params) -> dict:
+    """POST /answer; `params` are the AnswerRequest fields (k, window, chat_history, mode, reports, ...)."""
+    with _post(base_url, "/answer", {"query": query, **params}, "application/json", timeout) as response:
+        return json.loads(response.read().decode("utf-8"))
+
+
+def stream_answer(base_url: str, query: str, timeout: float = API_TIMEOUT, **params):
+    """POST /answer/stream and yields the decoded SSE events; an `error` event raises RuntimeError."""
+    with _post(base_url, "/answer/stream", {"query": query, **params}, "text/event-stream", timeout) as response:
+        data_lines = []
+        for raw_line in response:
+            line = raw_line.decode("utf-8").rstrip("\r\n")
+            if line.startswith("data:"):
+                data_lines.append(line[5:].lstrip())
+            elif not line and data_lines:
+                event = json.loads("\n".join(data_lines))
+                data_lines = []
+                if event.get("type") == "error":
+                    raise RuntimeError(f"RAG API error: {event.get('error')}")
+                yield event
@@ -1,19 +1,37 @@
 import sys
 import types
 import os
-import time
-from rag_core import load_faiss_resources, generate_answer
 import re
 import streamlit as st
 
 # ==============================================================================
-# === LOAD FAISS + METADATA ONCE ===
+# === PIPELINE: REMOTE API (RAG_API_URL) OR IN-PROCESS ===
 # ==============================================================================
-if "faiss_index" not in st.session_state:
-    index, chunk_ids, chunk_id_to_info = load_faiss_resources()
-    st.session_state.faiss_index = index
-    st.session_state.chunk_ids = chunk_ids
-    st.session_state.chunk_id_to_info = chunk_id_to_info
+# With RAG_API_URL set, this script is a thin client of api.py and loads nothing itself.
+API_URL = os.environ.get("RAG_API_URL")
+
+if API_URL:
+    from api_client import reports, stream_answer
+
+    # Cached across reruns: every widget interaction reruns this script
+    @st.cache_data(ttl=300, show_spinner=False)
+    def fetch_report_names(base_url: str) -> list:
+        return reports(base_url)
+
+    available_report_names = fetch_report_names(API_URL)
+else:
+    from rag_core import available_reports, get_faiss_resources, generate_answer_stream, warm_up_reranker
+    from tracing import start_metrics_server_from_env
+
+    # The index is held by rag_core for the whole process, not copied into every session.
+    faiss_index, chunk_store, lexical_index = get_faiss_resources()
+    available_report_names = available_reports(faiss_index, chunk_store)
+
+    # Load the cross-encoder in the background; answers fall back to FAISS order until it is ready
+    warm_up_reranker()
+
+    # Span histograms / recent traces on a local port when RAG_METRICS_PORT is set
+    start_metrics_server_from_env()
 
 # ==============================================================================
 # === INITIALIZE STORAGE FOR TIMINGS ===
@@ -207,6 +225,14 @@ st.markdown(
     unsafe_allow_html=True,
 )
 
+# ==============================================================================
+# === REPORT FILTER (ONLY WHEN SEVERAL REPORTS ARE INDEXED) ===
+# ==============================================================================
+# No selection searches every report; a selection only searches those reports' shards.
+selected_reports = []
+if len(available_report_names) > 1:
+    selected_reports = st.sidebar.multiselect("Limit answers to these reports", available_report_names)
+
 # ==============================================================================
 # === CHAT INPUT (BOTTOM) ===
 # ==============================================================================
@@ -268,23 +294,25 @@ for user_msg, bot_msg in st.session_state.chat_history:
 # ==============================================================================
 # === TIMING BUBBLE (optional) ===
 # ==============================================================================
-# if st.session_state.last_timings is not None:
-#     t = st.session_state.last_timings
-#     st.markdown(
-#         f"""
-#         <div class="chat-row bot-row">
-#             <div class="timing-bubble">
-#                 ⏱ Contextualization: {t.get('contextualization', 0):.2f}s<br>
-#                 ⏱ Paraphrase Gen: {t.get('paraphrase_generation', 0):.2f}s<br>
-#                 ⏱ Retrieval+Rerank: {t.get('retrieval_and_rerank', 0):.2f}s<br>
-#                 ⏱ LLM Generation: {t.get('generation', 0):.2f}s
-#             </div>
-#         </div>
-#         """,
-#         unsafe_allow_html=True,
-#     )
-#     # Clear so it only shows once
-#     st.session_state.last_timings = None
+# Set RAG_SHOW_TIMINGS=1 to display the per-stage breakdown of the last answer.
+if os.environ.get("RAG_SHOW_TIMINGS") and st.session_state.last_timings is not None:
+    t = st.session_state.last_timings
+    st.markdown(
+        f"""
+        <div class="chat-row bot-row">
+            <div class="timing-bubble">
+                ⏱ Contextualization: {t.get('contextualization', 0):.2f}s<br>
+                ⏱ Paraphrase Gen: {t.get('paraphrase_generation', 0):.2f}s<br>
+                ⏱ Retrieval+Rerank: {t.get('retrieval_and_rerank', 0):.2f}s<br>
+                ⏱ Time to first token: {t.get('time_to_first_token', 0):.2f}s<br>
+                ⏱ LLM Generation: {t.get('generation', 0):.2f}s
+            </div>
+        </div>
+        """,
+        unsafe_allow_html=True,
+    )
+    # Clear so it only shows once
+    st.session_state.last_timings = None
 
 # ==============================================================================
 # === GENERATE RESPONSE LOGIC (WITH SPINNER) ===
@@ -297,41 +325,43 @@ if st.session_state.chat_history and st.session_state.chat_history[-1][1] == "..
     for user_msg, bot_msg in st.session_state.chat_history[-3:-1]:
         memory.append({"user": user_msg, "assistant": bot_msg})
 
-    # Call generate_answer() inside a spinner so the user sees “Thinking…”
-    with st.spinner("Thinking…"):
-        response = generate_answer(
+    # Stream the assistant’s answer token by token as the model produces it
+    placeholder = st.empty()
+    streamed = ""
+    response = {}
+    if API_URL:
+        events = stream_answer(API_URL, question, k=4, window=1, rerank_top_n=6, chat_history=memory,
+                               reports=selected_reports or None)
+    else:
+        events = generate_answer_stream(
             query=question,
-            index=st.session_state.faiss_index,
-            chunk_ids=st.session_state.chunk_ids,
-            chunk_id_to_info=st.session_state.chunk_id_to_info,
-            k=4, window=1, rerank_top_n=6, chat_history=memory
+            index=faiss_index,
+            chunk_store=chunk_store,
+            lexical_index=lexical_index,
+            k=4, window=1, rerank_top_n=6, chat_history=memory,
+            report_filter=selected_reports or None
         )
+    with st.spinner("Thinking…"):
+        for event in events:
+            if event["type"] == "token":
+                streamed += event["text"]
+                # Render the partial text inside a chat bubble
+                placeholder.markdown(
+                    f"""
+                    <div class="chat-row bot-row">
+                        <div class="chat-bubble bot-bubble">{streamed}</div>
+                    </div>
+                    """,
+                    unsafe_allow_html=True,
+                )
+            elif event["type"] == "done":
+                response = event
 
-    # Store the returned timing breakdown so we can render it above
+    # Store the returned timing breakdown (incl. time-to-first-token) so we can render it above
     st.session_state.last_timings = response.get("timings", {})
 
     answer_full = response["answer"]
 
-    # Stream the assistant’s answer paragraph by paragraph
-    placeholder = st.empty()
-    streamed = ""
-    for para in answer_full.split("\n"):
-        # Append this entire paragraph (with its trailing newline) at once
-        streamed += para + "\n"
-
-        # Render the partial text inside a chat bubble
-        placeholder.markdown(
-            f"""
-            <div class="chat-row bot-row">
-                <div class="chat-bubble bot-bubble">{streamed}</div>
-            </div>
-            """,
-            unsafe_allow_html=True,
-        )
-
-        # Pause briefly so that the user sees each paragraph appear in turn
-        time.sleep(0.1)
-
     # Replace the placeholder with the full answer (so chat_history is updated)
     st.session_state.chat_history[-1] = (question, answer_full)
     st.session_state.last_sources = response["chunks"]
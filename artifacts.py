@@ -0,0 +1,335 @@
+"""
+Versioned, checksum-verified fetch of the FAISS index and metadata.
+
+`artifacts.json` lists, for one artifact version, each file's URL, sha256 and size.
+Files are kept in a content-addressed cache, so several versions live side by side
+and a file shared by two versions is stored once:
+
+    <cache>/sha256/<hash>                  verified file contents
+    <cache>/versions/<version>/<filename>  symlink to the blob (the paths rag_core opens)
+    <cache>/versions/<version>/resolved.json   hashes of the files of that version
+    <cache>/partial/<version>-<filename>.part  interrupted downloads, resumed with Range
+
+Downloads are streamed in chunks, checked against the size the server announces,
+resumed where they stopped, verified against the manifest and only then renamed
+into the cache. With RAG_ARTIFACT_REQUIRE_PINNED=1, files without a sha256 in the
+manifest are refused instead of cached with a warning. All files are fetched in
+parallel; processes starting together (API workers) take a lock per file, so one
+downloads and the others reuse its result.
+RAG_ARTIFACT_MIRROR (e.g. file:///mnt/ipcc-mirror/) replaces the manifest URLs by
+`<mirror><filename>`, which allows offline start-up from a local copy.
+Artifacts marked `"optional": true` (e.g. the `<index>.params.json` search parameters
+of an ANN index) are skipped when they have no URL or the source does not have them.
+
+    python artifacts.py fetch                  download / verify the manifest version
+    python artifacts.py pin                    record sha256 + size of the files in the manifest
+    python artifacts.py mirror --output DIR    copy the version's files into a mirror directory
+    python artifacts.py list                   cached versions
+"""
+import argparse
+import hashlib
+import http.client
+import json
+import os
+import shutil
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from locks import file_lock
+
+
+MANIFEST_PATH = os.environ.get(
+    "RAG_ARTIFACT_MANIFEST", os.path.join(os.path.dirname(os.path.abspath(__file__)), "artifacts.json")
+)
+CACHE_DIR = os.environ.get("RAG_ARTIFACT_CACHE", "/tmp/ipcc_artifacts")
+MIRROR = os.environ.get("RAG_ARTIFACT_MIRROR")
+
+CHUNK_SIZE = 1 << 20
+RETRIES = int(os.environ.get("RAG_ARTIFACT_RETRIES", "5"))
+TIMEOUT = float(os.environ.get("RAG_ARTIFACT_TIMEOUT", "60"))
+REQUIRE_PINNED = os.environ.get("RAG_ARTIFACT_REQUIRE_PINNED", "0") == "1"
+# Client errors worth retrying (request timeout, rate limit); other 4xx fail at once
+RETRYABLE_HTTP_CODES = (408, 429)
+
+
+def load_manifest(path: str = MANIFEST_PATH) -> dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+def sha256_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# ------------------------------------------------------------------------------
+# === RESUMABLE DOWNLOAD ===
+# ------------------------------------------------------------------------------
+def _open(url: str, offset: int):
+    """
+    Returns (stream, resumed, total): `resumed` is False when the source restarts from
+    byte 0, `total` is the full file size announced by the source (None if unknown).
+    """
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme == "file":
+        f = open(urllib.request.url2pathname(parsed.path), "rb")
+        f.seek(offset)
+        return f, offset > 0, os.fstat(f.fileno()).st_size
+    request = urllib.request.Request(url, headers={"Range": f"bytes={offset}-"} if offset else {})
+    response = urllib.request.urlopen(request, timeout=TIMEOUT)
+    if response.headers.get_content_type() == "text/html":
+        response.close()
+        # e.g. the Google Drive "cannot scan this file for viruses" page instead of the file
+        raise RuntimeError(f"{url} returned an HTML page instead of the artifact")
+    resumed = offset > 0 and response.status == 206
+    return response, resumed, _announced_size(response, offset if resumed else 0)
+
+
+def _announced_size(response, offset: int):
+    """Full size from Content-Range (resumed responses) or offset + Content-Length."""
+    total = response.headers.get("Content-Range", "").rpartition("/")[2]
+    if total.isdigit():
+        return int(total)
+    length = response.headers.get("Content-Length", "")
+    return offset + int(length) if length.isdigit() else None
+
+
+def download(url: str, partial_path: str, expected_size: int = None):
+    """Streams `url` into `partial_path`, continuing an earlier partial download if any."""
+    for attempt in range(RETRIES):
+        offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+        if expected_size is not None and offset >= expected_size:
+            if offset == expected_size:
+                return
+            offset = 0   # larger than expected: start over
+        try:
+            stream, resumed, total = _open(url, offset)
+            written = offset if resumed else 0
+            with stream, open(partial_path, "ab" if resumed else "wb") as out:
+                while True:
+                    block = stream.read(CHUNK_SIZE)
+                    if not block:
+                        break
+                    out.write(block)
+                    written += len(block)
+            # A connection closed early ends the stream without an error: resume from here
+            total = total if total is not None else expected_size
+            if total is not None and written < total:
+                raise OSError(f"stream ended after {written} of {total} bytes")
+            return
+        except urllib.error.HTTPError as e:
+            if e.code == 416 and offset:
+                return   # range starts at the end: the partial file is already complete
+            if attempt == RETRIES - 1 or (400 <= e.code < 500 and e.code not in RETRYABLE_HTTP_CODES):
+                raise
+            print(f"⚠️ Download of {url} failed ({e}), retrying.")
+            time.sleep(min(30.0, 2 ** attempt))
+        except (OSError, RuntimeError, http.client.HTTPException) as e:
+            if attempt == RETRIES - 1 or isinstance(e, (RuntimeError, FileNotFoundError)):
+                raise   # missing local file (file:// mirror): nothing to resume
+            wait = min(30.0, 2 ** attempt)
+            print(f"⚠️ Download of {url} interrupted ({e}), resuming in {wait:.0f}s.")
+            time.sleep(wait)
+
+
+# ------------------------------------------------------------------------------
+# === CONTENT-ADDRESSED CACHE ===
+# ------------------------------------------------------------------------------
+def _blob_path(cache_dir: str, sha256: str) -> str:
+    return os.path.join(cache_dir, "sha256", sha256)
+
+
+def _tmp_path(path: str) -> str:
+    """Temporary name next to `path`, unique to this process and thread."""
+    return f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+
+def _link(blob: str, path: str):
+    """Points the version path at the blob (symlink, else hard link, else copy), atomically."""
+    tmp_path = _tmp_path(path)
+    try:
+        os.symlink(os.path.relpath(blob, os.path.dirname(path)), tmp_path)
+    except OSError:
+        try:
+            os.link(blob, tmp_path)
+        except OSError:
+            shutil.copyfile(blob, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _version_dir(cache_dir: str, version: str) -> str:
+    return os.path.join(cache_dir, "versions", version)
+
+
+def _read_resolved(version_dir: str) -> dict:
+    path = os.path.join(version_dir, "resolved.json")
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def fetch_artifact(name: str, spec: dict, version: str, cache_dir: str = CACHE_DIR, mirror: str = MIRROR,
+                   require_pinned: bool = REQUIRE_PINNED) -> dict:
+    """Makes `<cache>/versions/<version>/<filename>` point at verified contents; returns its record."""
+    if spec.get("optional") and not (mirror or spec.get("url")):
+        return None
+    if require_pinned and not spec.get("sha256"):
+        raise RuntimeError(f"{spec['filename']} has no sha256 in the manifest (RAG_ARTIFACT_REQUIRE_PINNED=1); "
+                           f"run `python artifacts.py pin` against a trusted copy.")
+    version_dir = _version_dir(cache_dir, version)
+    path = os.path.join(version_dir, spec["filename"])
+
+    record = _cached_record(name, spec, version_dir, path, cache_dir)
+    if record:
+        return record
+
+    # One process downloads a file at a time; the others find its blob once they get the lock
+    os.makedirs(os.path.join(cache_dir, "partial"), exist_ok=True)
+    partial_path = os.path.join(cache_dir, "partial", f"{version}-{spec['filename']}.part")
+    with file_lock(partial_path + ".lock"):
+        record = _cached_record(name, spec, version_dir, path, cache_dir)
+        if record:
+            return record
+        try:
+            return _download_artifact(spec, mirror, partial_path, path, cache_dir)
+        except (urllib.error.HTTPError, FileNotFoundError) as e:
+            if not spec.get("optional") or getattr(e, "code", 404) != 404:
+                raise
+            print(f"⚠️ Optional artifact {spec['filename']} not found ({e}), continuing without it.")
+            return None
+
+
+def _cached_record(name: str, spec: dict, version_dir: str, path: str, cache_dir: str):
+    """Record of the file if this version already points at verified contents, else None."""
+    expected_sha = spec.get("sha256")
+
+    # Already resolved for this version (no re-hash of large files on every start)
+    known = _read_resolved(version_dir).get(name)
+    if known and os.path.exists(path) and os.path.getsize(path) == known["size"] \
+            and (expected_sha is None or known["sha256"] == expected_sha):
+        return {**known, "path": path}
+
+    # Same contents already cached under another version
+    if expected_sha and os.path.exists(_blob_path(cache_dir, expected_sha)):
+        _link(_blob_path(cache_dir, expected_sha), path)
+        return {"sha256": expected_sha, "size": os.path.getsize(path), "path": path}
+
+    # Unpinned file linked by another process since (resolved.json is written after all files)
+    if expected_sha is None and os.path.islink(path) and os.path.exists(path):
+        sha256 = os.path.basename(os.readlink(path))
+        if os.path.exists(_blob_path(cache_dir, sha256)):
+            return {"sha256": sha256, "size": os.path.getsize(path), "path": path}
+    return None
+
+
+def _download_artifact(spec: dict, mirror: str, partial_path: str, path: str, cache_dir: str) -> dict:
+    expected_sha, expected_size = spec.get("sha256"), spec.get("size")
+    url = mirror.rstrip("/") + "/" + spec["filename"] if mirror else spec["url"]
+    t0 = time.time()
+    download(url, partial_path, expected_size)
+
+    size = os.path.getsize(partial_path)
+    sha256 = sha256_file(partial_path)
+    if (expected_size is not None and size != expected_size) or (expected_sha and sha256 != expected_sha):
+        os.remove(partial_path)
+        raise RuntimeError(
+            f"{spec['filename']} failed verification: got {size} bytes / sha256 {sha256}, "
+            f"expected {expected_size} bytes / sha256 {expected_sha}"
+        )
+    if not expected_sha:
+        print(f"⚠️ {spec['filename']} is not pinned in the manifest (sha256 {sha256}); run `python artifacts.py pin`.")
+
+    blob = _blob_path(cache_dir, sha256)
+    os.makedirs(os.path.dirname(blob), exist_ok=True)
+    os.replace(partial_path, blob)
+    _link(blob, path)
+    print(f"✅ {spec['filename']} ({size / 1e6:.1f} MB) fetched in {time.time() - t0:.1f}s.")
+    return {"sha256": sha256, "size": size, "path": path}
+
+
+def fetch_artifacts(manifest_path: str = MANIFEST_PATH, cache_dir: str = CACHE_DIR, mirror: str = MIRROR,
+                    require_pinned: bool = REQUIRE_PINNED) -> dict:
+    """Fetches every artifact of the manifest version in parallel; returns name -> local path (if any)."""
+    manifest = load_manifest(manifest_path)
+    version = manifest["version"]
+    version_dir = _version_dir(cache_dir, version)
+    os.makedirs(version_dir, exist_ok=True)
+
+    specs = manifest["artifacts"]
+    with ThreadPoolExecutor(max_workers=len(specs)) as pool:
+        futures = {name: pool.submit(fetch_artifact, name, spec, version, cache_dir, mirror, require_pinned)
+                   for name, spec in specs.items()}
+        records = {name: future.result() for name, future in futures.items()}
+    records = {name: record for name, record in records.items() if record is not None}
+
+    resolved = {name: {"sha256": r["sha256"], "size": r["size"]} for name, r in records.items()}
+    if resolved != _read_resolved(version_dir):
+        tmp_path = _tmp_path(os.path.join(version_dir, "resolved.json"))
+        with open(tmp_path, "w") as f:
+            json.dump(resolved, f, indent=2)
+        os.replace(tmp_path, os.path.join(version_dir, "resolved.json"))
+    return {name: r["path"] for name, r in records.items()}
+
+
+def version_dir(manifest_path: str = MANIFEST_PATH, cache_dir: str = CACHE_DIR) -> str:
+    """Directory of the manifest version; derived files (chunk store, BM25) are kept there too."""
+    return _version_dir(cache_dir, load_manifest(manifest_path)["version"])
+
+
+# ------------------------------------------------------------------------------
+# === CLI ===
+# ------------------------------------------------------------------------------
+def pin(manifest_path: str, cache_dir: str, mirror: str):
+    """Fetches the files and writes their sha256 and size into the manifest."""
+    manifest = load_manifest(manifest_path)
+    fetch_artifacts(manifest_path, cache_dir, mirror, require_pinned=False)
+    resolved = _read_resolved(_version_dir(cache_dir, manifest["version"]))
+    for name, spec in manifest["artifacts"].items():
+        if name in resolved:
+            spec.update(resolved[name])
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+        f.write("\n")
+    os.replace(tmp_path, manifest_path)
+    print(f"✅ Pinned {len(resolved)} artifacts of {manifest['version']} in {manifest_path}.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["fetch", "pin", "mirror", "list"])
+    parser.add_argument("--manifest", default=MANIFEST_PATH)
+    parser.add_argument("--cache-dir", default=CACHE_DIR)
+    parser.add_argument("--mirror", default=MIRROR, help="base URL replacing the manifest URLs, e.g. file:///mnt/ipcc/")
+    parser.add_argument("--output", help="mirror directory to write (mirror command)")
+    args = parser.parse_args()
+
+    if args.command == "fetch":
+        for name, path in fetch_artifacts(args.manifest, args.cache_dir, args.mirror).items():
+            print(f"{name}: {path}")
+    elif args.command == "pin":
+        pin(args.manifest, args.cache_dir, args.mirror)
+    elif args.command == "mirror":
+        if not args.output:
+            parser.error("mirror needs --output")
+        os.makedirs(args.output, exist_ok=True)
+        for path in fetch_artifacts(args.manifest, args.cache_dir, args.mirror).values():
+            shutil.copyfile(path, os.path.join(args.output, os.path.basename(path)))
+        print(f"✅ Mirror written to {args.output} (use RAG_ARTIFACT_MIRROR=file://{os.path.abspath(args.output)}/).")
+    else:
+        versions_root = os.path.join(args.cache_dir, "versions")
+        for version in sorted(os.listdir(versions_root)) if os.path.isdir(versions_root) else []:
+            files = _read_resolved(os.path.join(versions_root, version))
+            print(f"{version}: " + ", ".join(f"{name} {r['sha256'][:12]} {r['size']} B" for name, r in files.items()))
+
+
+if __name__ == "__main__":
+    main()
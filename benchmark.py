@@ -0,0 +1,214 @@
+"""
+Offline per-stage benchmark of `rag_core.generate_answer`.
+
+Runs the real pipeline (expansion, embedding, FAISS search, span building, rerank,
+prompt packing, generation) against the stub endpoints of offline_stubs.py with
+injected latencies, over synthetic corpora of several sizes. No network access is
+needed; the corpora are generated once and cached in `--data-dir`.
+
+    python benchmark.py --sizes 10000 100000 1000000 --dim 1024 --queries 50 \\
+        --embed-latency 0.08 --chat-latency 0.6 --token-latency 0.01 --output bench.json
+    python benchmark.py --sizes 10000000 --dim 256 --index-factory IVF16384,PQ32 --nprobe 32
+
+Stage seconds per query (mean / p50 / p95 / min / max over the timed queries):
+    expansion         contextualization + paraphrase calls (0 in "fast" mode)
+    embedding         embedding requests (cache misses only reach the stub)
+    search            FAISS index.search
+    lexical           BM25 lists (with --lexical)
+    window_expansion  ±window neighbors merged into spans
+    rerank            cross-encoder (or FAISS-order fallback with --no-reranker)
+    prompt_build      token-budgeted context packing
+    generation        chat model call, prompt build excluded
+In "full" mode the raw-query embedding + search overlap with the expansion calls,
+so the stages do not add up to `end_to_end`.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import faiss
+import numpy as np
+
+# Before importing rag_core: keep the stub vectors out of the real embedding cache
+os.environ.setdefault("RAG_EMBEDDING_CACHE_DIR", tempfile.mkdtemp(prefix="rag_bench_embedding_cache_"))
+
+import rag_core
+from offline_stubs import StubEmbeddings, StubChatModel, build_synthetic_corpus, synthetic_text
+from build_ann_index import apply_search_params
+
+
+STAGES = {
+    "expansion": "query_expansion",
+    "embedding": "embedding",
+    "search": "faiss_search",
+    "lexical": "lexical_retrieval",
+    "window_expansion": "span_build",
+    "rerank": "rerank",
+    "prompt_build": "prompt_build",
+}
+
+
+def summarize(values: list) -> dict:
+    values = np.asarray(values, dtype="float64")
+    return {
+        "mean": float(values.mean()),
+        "p50": float(np.percentile(values, 50)),
+        "p95": float(np.percentile(values, 95)),
+        "min": float(values.min()),
+        "max": float(values.max()),
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def corpus_dir(args, n_vectors: int) -> str:
+    name = f"n{n_vectors}_d{args.dim}_{args.index_factory.replace(',', '_')}_s{args.seed}"
+    return os.path.join(args.data_dir, name)
+
+
+def load_corpus(args, n_vectors: int) -> dict:
+    path = corpus_dir(args, n_vectors)
+    info = {"n_vectors": n_vectors, "corpus_dir": path}
+    if not os.path.exists(os.path.join(path, "chunk_store")):
+        print(f"Building synthetic corpus of {n_vectors} vectors in {path} ...")
+        built = build_synthetic_corpus(path, n_vectors, dim=args.dim, index_factory=args.index_factory,
+                                       words_per_chunk=args.words_per_chunk, seed=args.seed)
+        info.update({key: value for key, value in built.items() if key.endswith("seconds")})
+    index_path = os.path.join(path, "index.faiss")
+
+    t0 = time.perf_counter()
+    index, chunk_store, lexical_index = rag_core.load_faiss_resources(
+        index_path, metadata_path=None, chunk_store_path=os.path.join(path, "chunk_store"),
+        with_lexical=args.lexical,
+    )
+    if args.nprobe:
+        apply_search_params(index, {"nprobe": args.nprobe})
+    if args.ef_search:
+        apply_search_params(index, {"efSearch": args.ef_search})
+    info["load_seconds"] = time.perf_counter() - t0
+    info["index_bytes"] = os.path.getsize(index_path)
+    return {"info": info, "resources": (index, chunk_store, lexical_index)}
+
+
+def run_queries(args, resources, mode: str, queries: list) -> list:
+    index, chunk_store, lexical_index = resources
+    runs = []
+    for query in queries:
+        t0 = time.perf_counter()
+        out = rag_core.generate_answer(
+            query, index, chunk_store, k=args.k, window=args.window, rerank_top_n=args.rerank_top_n,
+            use_answer_cache=False, lexical_index=lexical_index, mode=mode,
+        )
+        timings = out["timings"]
+        timings["end_to_end"] = time.perf_counter() - t0
+        runs.append(timings)
+    return runs
+
+
+def stage_report(runs: list) -> dict:
+    stages = {name: summarize([run.get(key, 0.0) for run in runs]) for name, key in STAGES.items()}
+    stages["generation"] = summarize([run["generation"] - run.get("prompt_build", 0.0) for run in runs])
+    return stages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--dim", type=int, default=1024, help="1024 = databricks-gte-large-en")
+    parser.add_argument("--index-factory", default="Flat", help="faiss.index_factory string, e.g. HNSW32 or IVF4096,PQ64")
+    parser.add_argument("--nprobe", type=int, default=None)
+    parser.add_argument("--ef-search", type=int, default=None)
+    parser.add_argument("--words-per-chunk", type=int, default=150)
+    parser.add_argument("--data-dir", default="/tmp/rag_benchmark")
+    parser.add_argument("--modes", nargs="+", default=["full"], choices=rag_core.PIPELINE_MODES)
+    parser.add_argument("--queries", type=int, default=20, help="timed queries per size and mode")
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("-k", type=int, default=4)
+    parser.add_argument("--window", type=int, default=1)
+    parser.add_argument("--rerank-top-n", type=int, default=6)
+    parser.add_argument("--lexical", action="store_true", help="build/use the BM25 index (slow to build at 10M)")
+    parser.add_argument("--no-reranker", action="store_true", help="skip the cross-encoder (FAISS-order fallback)")
+    parser.add_argument("--embed-latency", type=float, default=0.0, help="seconds per embedding request")
+    parser.add_argument("--embed-per-text-latency", type=float, default=0.0)
+    parser.add_argument("--chat-latency", type=float, default=0.0, help="seconds per chat call / to first token")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="seconds per streamed answer token")
+    parser.add_argument("--answer-tokens", type=int, default=200)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--threads", type=int, default=None, help="FAISS OpenMP threads")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="JSON file (default: stdout)")
+    args = parser.parse_args()
+
+    if args.threads:
+        faiss.omp_set_num_threads(args.threads)
+    rag_core.set_models(
+        embeddings=StubEmbeddings(dim=args.dim, latency=args.embed_latency,
+                                  per_text_latency=args.embed_per_text_latency, jitter=args.jitter, seed=args.seed),
+        chat=StubChatModel(latency=args.chat_latency, token_latency=args.token_latency, jitter=args.jitter,
+                           answer_tokens=args.answer_tokens, seed=args.seed),
+    )
+    if args.no_reranker:
+        rag_core.reranker.disable()
+    else:
+        rag_core.reranker.load()   # model load time is not part of the per-query numbers
+
+    rng = np.random.default_rng(args.seed)
+    results = []
+    for n_vectors in args.sizes:
+        corpus = load_corpus(args, n_vectors)
+        for mode in args.modes:
+            # Distinct questions, so the embedding cache never answers for the stub
+            queries = [f"Q{n_vectors}-{mode}-{i}: {synthetic_text(rng, 12)}?"
+                       for i in range(args.warmup + args.queries)]
+            runs = run_queries(args, corpus["resources"], mode, queries)[args.warmup:]
+            results.append({
+                **corpus["info"],
+                "mode": mode,
+                "n_queries": len(runs),
+                "stages": stage_report(runs),
+                "end_to_end": summarize([run["end_to_end"] for run in runs]),
+                "pipeline_paths": {path: sum(run.get("pipeline_path") == path for run in runs)
+                                   for path in sorted({run.get("pipeline_path") for run in runs})},
+                "span_count_mean": float(np.mean([run.get("span_count", 0) for run in runs])),
+                "reranker_fallback": int(any(run.get("reranker_fallback") for run in runs)),
+            })
+            stages = results[-1]["stages"]
+            print(f"n={n_vectors:<9} {mode:<9} end-to-end p50 {results[-1]['end_to_end']['p50'] * 1000:8.1f} ms  "
+                  + "  ".join(f"{name} {stage['p50'] * 1000:.1f}" for name, stage in stages.items()),
+                  file=sys.stderr)
+
+    report = {
+        "git_commit": git_commit(),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "faiss": faiss.__version__,
+            "numpy": np.__version__,
+            "reranker_backend": None if args.no_reranker else rag_core.RERANKER_BACKEND,
+        },
+        "config": vars(args),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"✅ Benchmark written to {args.output}.", file=sys.stderr)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""
+Local BM25 lexical index over the chunk store texts.
+
+Exact, acronym-heavy IPCC terms ("BECCS", "SSP1-1.9", "DACCS", "AFOLU") are matched
+literally, which the dense embedding sometimes misses. Search is pure NumPy over an
+inverted index stored next to the FAISS index:
+
+    <dir>/vocab.json          term -> term id
+    <dir>/indptr.npy          int64 (n_terms + 1) offsets into the postings
+    <dir>/doc_ids.npy         int32 postings (chunk positions), grouped by term
+    <dir>/tfs.npy             float32 term frequencies, aligned with doc_ids
+    <dir>/doc_len.npy         int32 tokens per chunk
+    <dir>/meta.json           n_docs, avgdl, k1, b
+
+    python bm25.py --chunk-store /tmp/ipcc_chunk_store --output /tmp/ipcc_faiss.index.bm25
+"""
+import argparse
+import json
+import os
+import re
+import shutil
+from collections import Counter
+
+import numpy as np
+
+
+# Keeps compounds such as "SSP1-1.9", "CO2-eq" or "1.5" together
+TOKEN_PATTERN = re.compile(r"[A-Za-z0-9]+(?:[-.][A-Za-z0-9]+)*")
+
+STOPWORDS = frozenset("""
+a an and are as at be by for from has have how in is it its of on or that the their this to was
+were what which with will would can could does do did into than then there these those about
+""".split())
+
+
+def tokenize(text: str) -> list:
+    """Lower-cased terms; compounds are also indexed by their parts ("ssp1-1.9" -> "ssp1", "1.9")."""
+    terms = []
+    for match in TOKEN_PATTERN.findall(text):
+        term = match.lower()
+        if term in STOPWORDS:
+            continue
+        terms.append(term)
+        if "-" in term:
+            terms.extend(part for part in term.split("-") if part and part not in STOPWORDS)
+    return terms
+
+
+# ------------------------------------------------------------------------------
+# === INDEX ===
+# ------------------------------------------------------------------------------
+class BM25Index:
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        with open(os.path.join(path, "vocab.json")) as f:
+            self.vocab = json.load(f)
+        self.n_docs, self.avgdl, self.k1, self.b = meta["n_docs"], meta["avgdl"], meta["k1"], meta["b"]
+        self.indptr = np.load(os.path.join(path, "indptr.npy"), mmap_mode="r")
+        self.doc_ids = np.load(os.path.join(path, "doc_ids.npy"), mmap_mode="r")
+        self.tfs = np.load(os.path.join(path, "tfs.npy"), mmap_mode="r")
+        self.doc_len = np.load(os.path.join(path, "doc_len.npy"), mmap_mode="r")
+
+    def __len__(self):
+        return self.n_docs
+
+    def search(self, query: str, k: int = 5, allowed: np.ndarray = None):
+        """
+        Returns (scores, positions) of the top-k chunks, best first (possibly fewer than k).
+        `allowed` (boolean mask over positions) limits the results, e.g. to some reports.
+        """
+        term_ids = [self.vocab[t] for t in dict.fromkeys(tokenize(query)) if t in self.vocab]
+        if not term_ids:
+            return np.zeros(0, dtype="float32"), np.zeros(0, dtype="int64")
+
+        docs, contributions = [], []
+        for term_id in term_ids:
+            start, end = self.indptr[term_id], self.indptr[term_id + 1]
+            postings = np.asarray(self.doc_ids[start:end])
+            tf = np.asarray(self.tfs[start:end])
+            df = end - start
+            idf = np.log(1.0 + (self.n_docs - df + 0.5) / (df + 0.5))
+            norm = self.k1 * (1.0 - self.b + self.b * np.asarray(self.doc_len[postings]) / self.avgdl)
+            docs.append(postings)
+            contributions.append(idf * tf * (self.k1 + 1.0) / (tf + norm))
+
+        candidates, inverse = np.unique(np.concatenate(docs), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(contributions)).astype("float32")
+        if allowed is not None:
+            keep = allowed[candidates]
+            candidates, scores = candidates[keep], scores[keep]
+            if len(candidates) == 0:
+                return np.zeros(0, dtype="float32"), np.zeros(0, dtype="int64")
+        top = np.argpartition(-scores, min(k, len(scores)) - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return scores[top], candidates[top].astype("int64")
+
+
+def build_bm25_index(texts, output_path: str, k1: float = 1.5, b: float = 0.75) -> int:
+    """Builds the index from an iterable of chunk texts in FAISS position order."""
+    vocab = {}
+    postings = []   # per term: list of (doc, tf)
+    doc_len = []
+    for doc_id, text in enumerate(texts):
+        counts = Counter(tokenize(text))
+        doc_len.append(sum(counts.values()))
+        for term, tf in counts.items():
+            term_id = vocab.setdefault(term, len(vocab))
+            if term_id == len(postings):
+                postings.append([])
+            postings[term_id].append((doc_id, tf))
+
+    indptr = np.zeros(len(vocab) + 1, dtype="int64")
+    indptr[1:] = np.cumsum([len(p) for p in postings])
+    doc_ids = np.fromiter((d for p in postings for d, _ in p), dtype="int32", count=int(indptr[-1]))
+    tfs = np.fromiter((tf for p in postings for _, tf in p), dtype="float32", count=int(indptr[-1]))
+
+    tmp_path = output_path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    np.save(os.path.join(tmp_path, "indptr.npy"), indptr)
+    np.save(os.path.join(tmp_path, "doc_ids.npy"), doc_ids)
+    np.save(os.path.join(tmp_path, "tfs.npy"), tfs)
+    np.save(os.path.join(tmp_path, "doc_len.npy"), np.array(doc_len, dtype="int32"))
+    with open(os.path.join(tmp_path, "vocab.json"), "w") as f:
+        json.dump(vocab, f)
+    with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+        json.dump({"n_docs": len(doc_len), "avgdl": float(np.mean(doc_len)) if doc_len else 0.0,
+                   "k1": k1, "b": b}, f)
+    shutil.rmtree(output_path, ignore_errors=True)
+    os.replace(tmp_path, output_path)
+    return len(doc_len)
+
+
+# ------------------------------------------------------------------------------
+# === RECIPROCAL-RANK FUSION ===
+# ------------------------------------------------------------------------------
+def reciprocal_rank_fusion(indices: np.ndarray, k_rrf: int = 60) -> np.ndarray:
+    """
+    `indices` holds one ranked list per row (-1 = padding). Returns an array of the same
+    shape with, for every entry, the fused score of its position: the sum over all
+    lists of 1 / (k_rrf + rank).
+    """
+    ranks = np.broadcast_to(np.arange(1, indices.shape[1] + 1), indices.shape)
+    valid = indices >= 0
+    positions, inverse = np.unique(indices[valid], return_inverse=True)
+    totals = np.bincount(inverse, weights=1.0 / (k_rrf + ranks[valid]))
+    fused = np.zeros(indices.shape, dtype="float32")
+    fused[valid] = totals[inverse]
+    return fused
+
+
+def main():
+    from chunk_store import ChunkStore
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunk-store", default="/tmp/ipcc_chunk_store")
+    parser.add_argument("--output", default="/tmp/ipcc_faiss.index.bm25")
+    parser.add_argument("--k1", type=float, default=1.5)
+    parser.add_argument("--b", type=float, default=0.75)
+    args = parser.parse_args()
+    store = ChunkStore(args.chunk_store)
+    count = build_bm25_index((store.text(i) for i in range(len(store))), args.output, k1=args.k1, b=args.b)
+    print(f"✅ BM25 index over {count} chunks written to {args.output}.")
+
+
+if __name__ == "__main__":
+    main()
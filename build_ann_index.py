@@ -0,0 +1,226 @@
+"""
+Builds an approximate-nearest-neighbor index from the existing flat FAISS index.
+
+The vectors are read back from the brute-force IndexFlatIP built by the Databricks
+notebooks, and an HNSW, IVF-Flat or IVF-PQ index (inner product) is written next to
+a `<output>.params.json` file that records the build and search parameters.
+`rag_core.load_faiss_resources` applies the recorded search parameters (nprobe /
+efSearch) when it loads the index; for an index served from the artifact cache, list
+the params file as the optional `index_params` artifact of artifacts.json.
+
+    python build_ann_index.py --type hnsw --hnsw-m 32 --ef-construction 200 --ef-search 64 \\
+        --output /tmp/ipcc_faiss_hnsw.index --benchmark
+    python build_ann_index.py --type ivf-pq --nlist 4096 --pq-m 64 --nprobe 32 \\
+        --output /tmp/ipcc_faiss_ivfpq.index --benchmark --holdout 2000
+
+With `--benchmark`, `--holdout` vectors are removed from the corpus, an index with the
+same parameters is built on the remainder, and recall@k versus latency against the
+exact flat search is reported for a sweep of nprobe / efSearch values.
+"""
+import argparse
+import json
+import os
+import time
+
+import faiss
+import numpy as np
+
+from chunk_store import ChunkStore
+
+
+def params_path(index_path: str) -> str:
+    return index_path + ".params.json"
+
+
+def load_search_params(index_path: str) -> dict:
+    """Search-time parameters recorded by this tool for `index_path` ({} if none)."""
+    path = params_path(index_path)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f).get("search_params", {})
+
+
+def apply_search_params(index, search_params: dict):
+    parameter_space = faiss.ParameterSpace()
+    for name, value in search_params.items():
+        parameter_space.set_index_parameter(index, name, value)
+
+
+def ann_type(index):
+    """"hnsw" / "ivf" for indexes whose recall depends on search parameters, else None."""
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexIDMap):
+        index = faiss.downcast_index(index.index)
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    try:
+        faiss.extract_index_ivf(index)
+        return "ivf"
+    except RuntimeError:
+        return None
+
+
+# ------------------------------------------------------------------------------
+# === BUILDING ===
+# ------------------------------------------------------------------------------
+def read_vectors(index_path: str) -> np.ndarray:
+    index = faiss.read_index(index_path)
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def build_index(vectors: np.ndarray, args):
+    dim = vectors.shape[1]
+    if args.type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, args.hnsw_m, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = args.ef_construction
+    elif args.type in ("ivf-flat", "ivf-pq"):
+        quantizer = faiss.IndexFlatIP(dim)
+        if args.type == "ivf-flat":
+            index = faiss.IndexIVFFlat(quantizer, dim, args.nlist, faiss.METRIC_INNER_PRODUCT)
+        else:
+            index = faiss.IndexIVFPQ(quantizer, dim, args.nlist, args.pq_m, args.pq_bits,
+                                     faiss.METRIC_INNER_PRODUCT)
+        rng = np.random.default_rng(args.seed)
+        n_train = min(len(vectors), args.train_size)
+        index.train(vectors[rng.choice(len(vectors), n_train, replace=False)])
+    else:
+        raise ValueError(f"Unknown index type {args.type!r}")
+    index.add(vectors)
+    return index
+
+
+def search_params_for(args) -> dict:
+    if args.type == "hnsw":
+        return {"efSearch": args.ef_search}
+    return {"nprobe": args.nprobe}
+
+
+def build_params(args) -> dict:
+    if args.type == "hnsw":
+        return {"M": args.hnsw_m, "efConstruction": args.ef_construction}
+    params = {"nlist": args.nlist, "train_size": args.train_size}
+    if args.type == "ivf-pq":
+        params.update({"pq_m": args.pq_m, "pq_bits": args.pq_bits})
+    return params
+
+
+# ------------------------------------------------------------------------------
+# === RECALL / LATENCY BENCHMARK ===
+# ------------------------------------------------------------------------------
+def timed_search(index, queries: np.ndarray, k: int):
+    t0 = time.perf_counter()
+    _, indices = index.search(queries, k)
+    return indices, 1000 * (time.perf_counter() - t0) / len(queries)
+
+
+def recall_at_k(found: np.ndarray, truth: np.ndarray) -> float:
+    hits = sum(len(set(f[f >= 0]) & set(t[t >= 0])) for f, t in zip(found, truth))
+    return hits / truth.size
+
+
+def benchmark(vectors: np.ndarray, args) -> dict:
+    rng = np.random.default_rng(args.seed)
+    if args.queries:
+        queries = np.load(args.queries).astype("float32")
+        faiss.normalize_L2(queries)
+        corpus = vectors
+    else:
+        holdout = rng.choice(len(vectors), args.holdout, replace=False)
+        mask = np.ones(len(vectors), dtype=bool)
+        mask[holdout] = False
+        queries, corpus = vectors[holdout], vectors[mask]
+
+    flat = faiss.IndexFlatIP(corpus.shape[1])
+    flat.add(corpus)
+    truth, flat_ms = timed_search(flat, queries, args.k)
+
+    t0 = time.perf_counter()
+    index = build_index(corpus, args)
+    build_seconds = time.perf_counter() - t0
+
+    if args.type == "hnsw":
+        name, values = "efSearch", [v for v in [16, 32, 64, 128, 256, 512] if v >= args.k]
+    else:
+        name, values = "nprobe", [v for v in [1, 2, 4, 8, 16, 32, 64, 128, 256] if v <= args.nlist]
+    sweep = []
+    for value in values:
+        apply_search_params(index, {name: value})
+        found, ms = timed_search(index, queries, args.k)
+        sweep.append({name: value, f"recall@{args.k}": recall_at_k(found, truth), "ms_per_query": ms})
+
+    return {
+        "n_queries": len(queries),
+        "corpus_size": len(corpus),
+        "build_seconds": build_seconds,
+        "flat_ms_per_query": flat_ms,
+        "sweep": sweep,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--input", default="/tmp/ipcc_faiss.index", help="existing flat index")
+    parser.add_argument("--chunk-store", default="/tmp/ipcc_chunk_store", help="checked against the vector count")
+    parser.add_argument("--output", required=True)
+    parser.add_argument("--type", choices=["hnsw", "ivf-flat", "ivf-pq"], default="hnsw")
+    parser.add_argument("--hnsw-m", type=int, default=32)
+    parser.add_argument("--ef-construction", type=int, default=200)
+    parser.add_argument("--ef-search", type=int, default=64)
+    parser.add_argument("--nlist", type=int, default=1024)
+    parser.add_argument("--nprobe", type=int, default=16)
+    parser.add_argument("--pq-m", type=int, default=64, help="sub-quantizers (must divide the dimension)")
+    parser.add_argument("--pq-bits", type=int, default=8)
+    parser.add_argument("--train-size", type=int, default=100000)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--benchmark", action="store_true")
+    parser.add_argument("--benchmark-only", action="store_true", help="run the benchmark, write no index")
+    parser.add_argument("--holdout", type=int, default=1000, help="corpus vectors held out as benchmark queries")
+    parser.add_argument("--queries", default=None, help=".npy of query vectors instead of held-out ones")
+    parser.add_argument("-k", type=int, default=10)
+    args = parser.parse_args()
+
+    if args.threads:
+        faiss.omp_set_num_threads(args.threads)
+
+    vectors = read_vectors(args.input)
+    if os.path.exists(args.chunk_store):
+        n_chunks = len(ChunkStore(args.chunk_store))
+        if n_chunks != len(vectors):
+            raise SystemExit(f"Index has {len(vectors)} vectors but the chunk store has {n_chunks} chunks.")
+    else:
+        print(f"⚠️ No chunk store at {args.chunk_store}, the vector count is not checked.")
+    print(f"Loaded {len(vectors)} vectors of dim {vectors.shape[1]} from {args.input}.")
+
+    report = {"type": args.type, "build_params": build_params(args), "search_params": search_params_for(args)}
+    if args.benchmark or args.benchmark_only:
+        report["benchmark"] = benchmark(vectors, args)
+        bench = report["benchmark"]
+        print(f"Flat: {bench['flat_ms_per_query']:.3f} ms/query over {bench['corpus_size']} vectors "
+              f"({bench['n_queries']} held-out queries), ANN build {bench['build_seconds']:.1f}s")
+        for row in bench["sweep"]:
+            print("  " + "  ".join(f"{key}={value:.4f}" if isinstance(value, float) else f"{key}={value}"
+                                   for key, value in row.items()))
+
+    if args.benchmark_only:
+        print(json.dumps(report, indent=2))
+        return
+
+    t0 = time.perf_counter()
+    index = build_index(vectors, args)
+    apply_search_params(index, report["search_params"])
+    faiss.write_index(index, args.output)
+    report.update({
+        "source_index": os.path.abspath(args.input),
+        "ntotal": index.ntotal,
+        "dim": vectors.shape[1],
+        "build_seconds": time.perf_counter() - t0,
+    })
+    with open(params_path(args.output), "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"✅ {args.type} index written to {args.output} (params in {params_path(args.output)}).")
+
+
+if __name__ == "__main__":
+    main()
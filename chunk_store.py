@@ -0,0 +1,373 @@
+"""
+Columnar chunk store: chunk texts, ids and metadata addressed by FAISS position.
+
+Layout of a store directory:
+    texts.bin / text_offsets.npy   all chunk texts in one UTF-8 blob + int64 offsets (n + 1)
+    ids.bin   / id_offsets.npy     chunk ids, same layout
+    col_<name>.npy                 one array per metadata key: int32 dictionary codes for
+                                   string values (-1 = missing), int64 for integer values
+    meta.json                      count, vocabularies of the dictionary-encoded columns
+    tokens.bin / token_offsets.npy optional: int32 token ids of every text for the reranker
+    tokens.json                    tokenizer, without special tokens (see write_passage_tokens)
+
+Everything is memory-mapped, so opening a store is instant, the pages are shared by all
+processes, and only the chunks that are actually retrieved get decoded. Readers only use
+the first `count` entries of every file, so a store grows in place (`append_chunk_store`)
+and meta.json, replaced last, commits the new chunks.
+
+One-time conversion from the pickled metadata of the Databricks notebooks:
+    python chunk_store.py --metadata /tmp/ipcc_faiss_metadata.pkl --output /tmp/ipcc_chunk_store
+
+Pre-tokenization of an existing store with the reranker tokenizer (offline, once per
+store and tokenizer; the cross-encoder then only tokenizes the query per request):
+    python chunk_store.py --output /tmp/ipcc_chunk_store --tokenize BAAI/bge-reranker-base
+"""
+import argparse
+import io
+import json
+import os
+import pickle
+import shutil
+
+import numpy as np
+
+
+INT_MISSING = np.iinfo(np.int64).min   # missing value of the integer columns
+
+
+# ------------------------------------------------------------------------------
+# === READING ===
+# ------------------------------------------------------------------------------
+class ChunkStore:
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        self.count = meta["count"]
+        self.vocabularies = meta["dict_columns"]
+        self.int_columns = meta["int_columns"]
+        self._texts = self._blob("texts.bin")
+        self._text_offsets = np.load(os.path.join(path, "text_offsets.npy"), mmap_mode="r")[:self.count + 1]
+        self._ids = self._blob("ids.bin")
+        self._id_offsets = np.load(os.path.join(path, "id_offsets.npy"), mmap_mode="r")[:self.count + 1]
+        self.columns = {
+            name: np.load(os.path.join(path, f"col_{name}.npy"), mmap_mode="r")[:self.count]
+            for name in list(self.vocabularies) + self.int_columns
+        }
+        self.tokenizer_name = None
+        if os.path.exists(os.path.join(path, "tokens.json")):
+            with open(os.path.join(path, "tokens.json")) as f:
+                tokens_meta = json.load(f)
+            if tokens_meta["count"] == self.count:
+                self.tokenizer_name = tokens_meta["tokenizer"]
+                self._tokens = np.memmap(os.path.join(path, "tokens.bin"), dtype=np.int32, mode="r") \
+                    if os.path.getsize(os.path.join(path, "tokens.bin")) else np.zeros(0, dtype=np.int32)
+                self._token_offsets = np.load(os.path.join(path, "token_offsets.npy"), mmap_mode="r")[:self.count + 1]
+
+    def _blob(self, name: str):
+        path = os.path.join(self.path, name)
+        if os.path.getsize(path) == 0:
+            return np.zeros(0, dtype=np.uint8)  # np.memmap refuses empty files
+        return np.memmap(path, dtype=np.uint8, mode="r")
+
+    def __len__(self):
+        return self.count
+
+    def text(self, position: int) -> str:
+        start, end = self._text_offsets[position], self._text_offsets[position + 1]
+        return bytes(self._texts[start:end]).decode("utf-8")
+
+    def text_lengths(self, positions) -> np.ndarray:
+        """UTF-8 byte lengths of the texts at `positions`, read from the offsets only."""
+        positions = np.asarray(positions, dtype="int64")
+        return self._text_offsets[positions + 1] - self._text_offsets[positions]
+
+    def chunk_id(self, position: int) -> str:
+        start, end = self._id_offsets[position], self._id_offsets[position + 1]
+        return bytes(self._ids[start:end]).decode("utf-8")
+
+    def token_ids(self, position: int):
+        """Pre-computed token ids of the text (a memory-mapped int32 view), or None."""
+        if self.tokenizer_name is None:
+            return None
+        return self._tokens[self._token_offsets[position]:self._token_offsets[position + 1]]
+
+    def metadata(self, position: int) -> dict:
+        metadata = {}
+        for name, vocabulary in self.vocabularies.items():
+            code = self.columns[name][position]
+            if code >= 0:
+                metadata[name] = vocabulary[code]
+        for name in self.int_columns:
+            value = self.columns[name][position]
+            if value != INT_MISSING:
+                metadata[name] = int(value)
+        return metadata
+
+    def get(self, position: int) -> dict:
+        position = int(position)
+        return {
+            "chunk_id": self.chunk_id(position),
+            "text": self.text(position),
+            "metadata": self.metadata(position),
+        }
+
+    def get_many(self, positions) -> list:
+        return [self.get(position) for position in positions]
+
+    def column_codes(self, name: str):
+        """Integer codes of a metadata column for all chunks (None if the column does not exist)."""
+        return self.columns.get(name)
+
+
+# ------------------------------------------------------------------------------
+# === WRITING ===
+# ------------------------------------------------------------------------------
+def write_chunk_store(path: str, records):
+    """
+    Writes an iterable of (chunk_id, text, metadata) records, in FAISS position order,
+    to a new store directory (written to `<path>.tmp` first, then renamed).
+    """
+    tmp_path = path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    text_offsets, id_offsets = [0], [0]
+    values = {}   # metadata key -> list of raw values (None when missing)
+    count = 0
+    with open(os.path.join(tmp_path, "texts.bin"), "wb") as texts, \
+            open(os.path.join(tmp_path, "ids.bin"), "wb") as ids:
+        for chunk_id, text, metadata in records:
+            text_offsets.append(text_offsets[-1] + texts.write(text.encode("utf-8")))
+            id_offsets.append(id_offsets[-1] + ids.write(str(chunk_id).encode("utf-8")))
+            for name, value in metadata.items():
+                values.setdefault(name, [None] * count).append(value)
+            count += 1
+            for column in values.values():
+                if len(column) < count:
+                    column.append(None)
+
+    np.save(os.path.join(tmp_path, "text_offsets.npy"), np.array(text_offsets, dtype="int64"))
+    np.save(os.path.join(tmp_path, "id_offsets.npy"), np.array(id_offsets, dtype="int64"))
+
+    dict_columns, int_columns = {}, []
+    for name, column in values.items():
+        present = [v for v in column if v is not None]
+        if present and all(_is_int(v) for v in present):
+            codes = np.array([INT_MISSING if v is None else v for v in column], dtype="int64")
+            int_columns.append(name)
+        else:
+            # Dictionary encoding: each distinct value is stored once in meta.json
+            vocabulary = list(dict.fromkeys(str(v) for v in present))
+            lookup = {v: i for i, v in enumerate(vocabulary)}
+            codes = np.array([-1 if v is None else lookup[str(v)] for v in column], dtype="int32")
+            dict_columns[name] = vocabulary
+        np.save(os.path.join(tmp_path, f"col_{name}.npy"), codes)
+
+    with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+        json.dump({"count": count, "dict_columns": dict_columns, "int_columns": int_columns}, f)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+    return count
+
+
+def _is_int(value) -> bool:
+    return isinstance(value, (int, np.integer)) and not isinstance(value, bool)
+
+
+def _extend_blob(path: str, keep_bytes: int, data: bytes):
+    """Cuts the file at `path` to `keep_bytes` and appends `data`."""
+    with open(path, "r+b" if os.path.exists(path) else "w+b") as f:
+        f.truncate(keep_bytes)
+        f.seek(0, os.SEEK_END)
+        f.write(data)
+
+
+def _extend_npy(path: str, keep: int, values: np.ndarray):
+    """
+    Keeps the first `keep` items of the 1-D array saved at `path` and appends `values`
+    in place. The header, written last, is the only part rewritten (numpy pads it so the
+    length can grow); if the new length does not fit, the file is rewritten instead.
+    """
+    with open(path, "r+b") as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            _, _, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            _, _, dtype = np.lib.format.read_array_header_2_0(f)
+        data_offset = f.tell()
+        header = io.BytesIO()
+        fields = {"descr": np.lib.format.dtype_to_descr(dtype), "fortran_order": False,
+                  "shape": (keep + len(values),)}
+        if version == (1, 0):
+            np.lib.format.write_array_header_1_0(header, fields)
+        else:
+            np.lib.format.write_array_header_2_0(header, fields)
+        if len(header.getvalue()) == data_offset:
+            f.truncate(data_offset + keep * dtype.itemsize)
+            f.seek(0, os.SEEK_END)
+            f.write(np.asarray(values, dtype=dtype).tobytes())
+            f.flush()
+            f.seek(0)
+            f.write(header.getvalue())
+            return
+    array = np.concatenate([np.load(path, mmap_mode="r")[:keep], np.asarray(values, dtype=dtype)])
+    np.save(path + ".tmp.npy", array)
+    os.replace(path + ".tmp.npy", path)
+
+
+def append_chunk_store(path: str, records, keep: int = None, tokenizer=None) -> int:
+    """
+    Appends (chunk_id, text, metadata) records to the store at `path` without rewriting
+    it: blobs, offsets and columns grow at their end and meta.json, replaced last,
+    commits the new count. `keep` (default: the committed count) first drops the chunks
+    after it, e.g. those of an interrupted indexing run. A pre-tokenized store gets the
+    new texts tokenized as well (with `tokenizer`, loaded from the recorded name if None).
+    Returns the new count.
+    """
+    store = ChunkStore(path)
+    keep = store.count if keep is None else keep
+    records = list(records)
+    texts = [text.encode("utf-8") for _, text, _ in records]
+    ids = [str(chunk_id).encode("utf-8") for chunk_id, _, _ in records]
+
+    # Everything that can fail (column types, tokenizer) is done before the first write
+    vocabularies = {name: list(vocabulary) for name, vocabulary in store.vocabularies.items()}
+    if keep < store.count:
+        # Values are numbered in order of first appearance: the dropped chunks' own values come last
+        for name, vocabulary in vocabularies.items():
+            del vocabulary[int(store.columns[name][:keep].max(initial=-1)) + 1:]
+    int_columns = list(store.int_columns)
+    columns = {}   # name -> (codes of the new records, existed before)
+    names = list(vocabularies) + int_columns
+    names += [name for _, _, metadata in records for name in metadata if name not in names]
+    for name in dict.fromkeys(names):
+        values = [metadata.get(name) for _, _, metadata in records]
+        present = [v for v in values if v is not None]
+        existed = name in vocabularies or name in int_columns
+        if name in int_columns or (not existed and present and all(_is_int(v) for v in present)):
+            if not all(_is_int(v) for v in present):
+                raise ValueError(f"Column {name} of {path} holds integers; rewrite the store to add other values")
+            codes = np.array([INT_MISSING if v is None else v for v in values], dtype="int64")
+            if not existed:
+                int_columns.append(name)
+        else:
+            vocabulary = vocabularies.setdefault(name, [])
+            lookup = {v: i for i, v in enumerate(vocabulary)}
+            for value in dict.fromkeys(str(v) for v in present):
+                if value not in lookup:
+                    lookup[value] = len(vocabulary)
+                    vocabulary.append(value)
+            codes = np.array([-1 if v is None else lookup[str(v)] for v in values], dtype="int32")
+        columns[name] = (codes, existed)
+
+    token_ids, tokens_meta = None, None
+    if os.path.exists(os.path.join(path, "tokens.json")):
+        with open(os.path.join(path, "tokens.json")) as f:
+            tokens_meta = json.load(f)
+        token_offsets = np.load(os.path.join(path, "token_offsets.npy"), mmap_mode="r")
+        if len(token_offsets) - 1 >= keep:
+            tokenizer = tokenizer or load_tokenizer(tokens_meta["tokenizer"])
+            token_ids = []
+            for start in range(0, len(records), 256):
+                batch = [text for _, text, _ in records[start:start + 256]]
+                token_ids += tokenizer(batch, add_special_tokens=False)["input_ids"]
+            token_end = int(token_offsets[keep])
+        else:
+            print(f"⚠️ Token files of {path} are out of date; run `python chunk_store.py --tokenize` again.")
+
+    text_end, id_end = int(store._text_offsets[keep]), int(store._id_offsets[keep])
+    _extend_blob(os.path.join(path, "texts.bin"), text_end, b"".join(texts))
+    _extend_npy(os.path.join(path, "text_offsets.npy"), keep + 1,
+                text_end + np.cumsum([len(text) for text in texts], dtype="int64"))
+    _extend_blob(os.path.join(path, "ids.bin"), id_end, b"".join(ids))
+    _extend_npy(os.path.join(path, "id_offsets.npy"), keep + 1,
+                id_end + np.cumsum([len(chunk_id) for chunk_id in ids], dtype="int64"))
+    for name, (codes, existed) in columns.items():
+        column_path = os.path.join(path, f"col_{name}.npy")
+        if existed:
+            _extend_npy(column_path, keep, codes)
+        else:
+            missing = INT_MISSING if codes.dtype == np.int64 else -1
+            np.save(column_path + ".tmp.npy", np.concatenate([np.full(keep, missing, dtype=codes.dtype), codes]))
+            os.replace(column_path + ".tmp.npy", column_path)
+    if token_ids is not None:
+        _extend_blob(os.path.join(path, "tokens.bin"), token_end * 4,
+                     b"".join(np.asarray(ids, dtype=np.int32).tobytes() for ids in token_ids))
+        _extend_npy(os.path.join(path, "token_offsets.npy"), keep + 1,
+                    token_end + np.cumsum([len(ids) for ids in token_ids], dtype="int64"))
+
+    count = keep + len(records)
+    with open(os.path.join(path, "meta.json.tmp"), "w") as f:
+        json.dump({"count": count, "dict_columns": vocabularies, "int_columns": int_columns}, f)
+    os.replace(os.path.join(path, "meta.json.tmp"), os.path.join(path, "meta.json"))
+    if token_ids is not None:
+        with open(os.path.join(path, "tokens.json.tmp"), "w") as f:
+            json.dump({"tokenizer": tokens_meta["tokenizer"], "count": count}, f)
+        os.replace(os.path.join(path, "tokens.json.tmp"), os.path.join(path, "tokens.json"))
+    return count
+
+
+def write_passage_tokens(path: str, tokenizer, tokenizer_name: str, batch_size: int = 256) -> int:
+    """
+    Tokenizes every text of the store at `path` (no special tokens, no truncation) and
+    stores the ids next to it; `tokenizer_name` is recorded so that a reranker with
+    another tokenizer ignores them. Returns the number of tokens written.
+    """
+    store = ChunkStore(path)
+    offsets = [0]
+    with open(os.path.join(path, "tokens.bin.tmp"), "wb") as out:
+        for start in range(0, len(store), batch_size):
+            texts = [store.text(p) for p in range(start, min(start + batch_size, len(store)))]
+            for ids in tokenizer(texts, add_special_tokens=False)["input_ids"]:
+                offsets.append(offsets[-1] + len(ids))
+                out.write(np.asarray(ids, dtype=np.int32).tobytes())
+    np.save(os.path.join(path, "token_offsets.tmp.npy"), np.array(offsets, dtype="int64"))
+    os.replace(os.path.join(path, "tokens.bin.tmp"), os.path.join(path, "tokens.bin"))
+    os.replace(os.path.join(path, "token_offsets.tmp.npy"), os.path.join(path, "token_offsets.npy"))
+    # Written last: readers only use the token files once this matches the store
+    with open(os.path.join(path, "tokens.json.tmp"), "w") as f:
+        json.dump({"tokenizer": tokenizer_name, "count": len(store)}, f)
+    os.replace(os.path.join(path, "tokens.json.tmp"), os.path.join(path, "tokens.json"))
+    return offsets[-1]
+
+
+def load_tokenizer(tokenizer_name: str):
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(tokenizer_name, local_files_only=os.path.isdir(tokenizer_name))
+
+
+def tokenize_store(path: str, tokenizer_name: str) -> int:
+    return write_passage_tokens(path, load_tokenizer(tokenizer_name), tokenizer_name)
+
+
+def convert_pickle(metadata_path: str, output_path: str) -> int:
+    """One-time conversion of `{"chunk_ids", "chunk_id_to_info"}` pickles to a chunk store."""
+    with open(metadata_path, "rb") as f:
+        meta = pickle.load(f)
+    chunk_ids, chunk_id_to_info = meta["chunk_ids"], meta["chunk_id_to_info"]
+    records = (
+        (chunk_id, chunk_id_to_info[chunk_id]["text"], chunk_id_to_info[chunk_id].get("metadata", {}))
+        for chunk_id in chunk_ids
+    )
+    return write_chunk_store(output_path, records)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--metadata", default="/tmp/ipcc_faiss_metadata.pkl")
+    parser.add_argument("--output", default="/tmp/ipcc_chunk_store")
+    parser.add_argument("--tokenize", metavar="TOKENIZER",
+                        help="pre-tokenize the texts of the existing store at --output with this reranker tokenizer")
+    args = parser.parse_args()
+    if args.tokenize:
+        n_tokens = tokenize_store(args.output, args.tokenize)
+        print(f"✅ Stored {n_tokens} {args.tokenize} tokens in {args.output}.")
+        return
+    count = convert_pickle(args.metadata, args.output)
+    print(f"✅ Converted {count} chunks to {args.output}.")
+
+
+if __name__ == "__main__":
+    main()
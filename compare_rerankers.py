@@ -0,0 +1,127 @@
+"""
+Compares reranker backends against the fp32 PyTorch baseline.
+
+For every backend it reports latency (per micro-batch and per pair) and how well
+its scores agree with fp32: Spearman rank correlation, top-k overlap of the
+selected groups per query, and the max absolute score difference.
+
+    python compare_rerankers.py --chunk-store /tmp/ipcc_chunk_store \\
+        --backends torch-int8 onnx --max-length 512 --batch-size 16 --threads 4
+
+(rag_core writes the chunk store next to the index on first load; `python chunk_store.py`
+converts a metadata pickle into one)
+"""
+import argparse
+import json
+import random
+import time
+
+import numpy as np
+
+from chunk_store import ChunkStore
+from rerankers import make_reranker
+
+
+SAMPLE_QUERIES = [
+    "What is the impact of a 1.5°C scenario on the steel industry?",
+    "How does BECCS contribute to net zero CO2 emissions?",
+    "Which mitigation options exist in AFOLU?",
+    "What are the main emission sources of cement production?",
+    "How do SSP1-1.9 pathways differ from SSP2-4.5 for energy demand?",
+    "What role does hydrogen play in decarbonizing heavy transport?",
+    "What are the costs of direct air carbon capture and storage (DACCS)?",
+    "How do carbon pricing policies affect energy-intensive industries?",
+]
+
+
+def load_candidate_groups(chunk_store_path: str, n_groups: int, window: int, seed: int) -> list:
+    """Random ±window groups of consecutive chunks, like the ones FAISS retrieval produces."""
+    chunk_store = ChunkStore(chunk_store_path)
+    rng = random.Random(seed)
+    groups = []
+    for _ in range(n_groups):
+        anchor = rng.randrange(len(chunk_store))
+        positions = range(max(0, anchor - window), min(len(chunk_store), anchor + window + 1))
+        groups.append(" ".join(chunk_store.text(p) for p in positions))
+    return groups
+
+
+def spearman(a: np.ndarray, b: np.ndarray) -> float:
+    rank_a = np.argsort(np.argsort(a)).astype("float64")
+    rank_b = np.argsort(np.argsort(b)).astype("float64")
+    return float(np.corrcoef(rank_a, rank_b)[0, 1])
+
+
+def run_backend(backend, queries: list, groups: list, repeat: int) -> dict:
+    scores = []
+    latencies = []
+    for _ in range(repeat):
+        scores = []
+        for query in queries:
+            t0 = time.perf_counter()
+            scores.append(backend.score_pairs([(query, group) for group in groups]))
+            latencies.append(time.perf_counter() - t0)
+    return {"scores": scores, "latencies": np.array(latencies)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunk-store", default="/tmp/ipcc_chunk_store")
+    parser.add_argument("--model", default="BAAI/bge-reranker-base")
+    parser.add_argument("--backends", nargs="+", default=["torch-int8", "onnx"])
+    parser.add_argument("--groups", type=int, default=36, help="candidate groups per query (4 queries x k=4 x ...)")
+    parser.add_argument("--window", type=int, default=1)
+    parser.add_argument("--top-n", type=int, default=6)
+    parser.add_argument("--max-length", type=int, default=512)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--local-only", action="store_true")
+    parser.add_argument("--json", action="store_true", help="print a JSON report instead of a table")
+    args = parser.parse_args()
+
+    groups = load_candidate_groups(args.chunk_store, args.groups, args.window, args.seed)
+    backend_kwargs = dict(model_name=args.model, max_length=args.max_length, batch_size=args.batch_size,
+                          num_threads=args.threads, local_only=args.local_only)
+
+    baseline = run_backend(make_reranker("torch", **backend_kwargs).load(), SAMPLE_QUERIES, groups, args.repeat)
+    report = []
+    for name in ["torch"] + [b for b in args.backends if b != "torch"]:
+        result = baseline if name == "torch" else run_backend(
+            make_reranker(name, **backend_kwargs).load(), SAMPLE_QUERIES, groups, args.repeat
+        )
+        latencies = result["latencies"]
+        agreement = [
+            (
+                spearman(base, other),
+                len(set(np.argsort(-base)[:args.top_n]) & set(np.argsort(-other)[:args.top_n])) / args.top_n,
+                float(np.max(np.abs(base - other))),
+            )
+            for base, other in zip(baseline["scores"], result["scores"])
+        ]
+        report.append({
+            "backend": name,
+            "latency_ms_mean": 1000 * float(latencies.mean()),
+            "latency_ms_p50": 1000 * float(np.percentile(latencies, 50)),
+            "latency_ms_p95": 1000 * float(np.percentile(latencies, 95)),
+            "pairs_per_second": len(groups) / float(latencies.mean()),
+            "spearman_vs_fp32": float(np.mean([a[0] for a in agreement])),
+            f"top{args.top_n}_overlap_vs_fp32": float(np.mean([a[1] for a in agreement])),
+            "max_abs_score_diff": float(np.max([a[2] for a in agreement])),
+        })
+
+    if args.json:
+        print(json.dumps({"config": vars(args), "results": report}, indent=2))
+        return
+    print(f"{len(SAMPLE_QUERIES)} queries x {len(groups)} groups, max_length={args.max_length}, "
+          f"batch_size={args.batch_size}, threads={args.threads}")
+    print(f"{'backend':<12}{'mean ms':>10}{'p95 ms':>10}{'pairs/s':>10}{'spearman':>10}{'top-n':>8}{'max diff':>10}")
+    for r in report:
+        print(f"{r['backend']:<12}{r['latency_ms_mean']:>10.1f}{r['latency_ms_p95']:>10.1f}"
+              f"{r['pairs_per_second']:>10.1f}{r['spearman_vs_fp32']:>10.4f}"
+              f"{r[f'top{args.top_n}_overlap_vs_fp32']:>8.2f}{r['max_abs_score_diff']:>10.4f}")
+
+
+if __name__ == "__main__":
+    main()
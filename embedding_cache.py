@@ -0,0 +1,204 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+
+from locks import file_lock
+
+
+# ------------------------------------------------------------------------------
+# === KEYS ===
+# ------------------------------------------------------------------------------
+def normalize_text(text: str) -> str:
+    # gte-large-en is uncased, so case and whitespace differences map to the same vector
+    text = unicodedata.normalize("NFKC", text)
+    return " ".join(text.casefold().split())
+
+
+def cache_key(text: str, model_name: str) -> str:
+    return hashlib.sha1(f"{model_name}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+
+# ------------------------------------------------------------------------------
+# === TWO-TIER EMBEDDING CACHE ===
+# ------------------------------------------------------------------------------
+DISK_FORMAT = 2   # format 1 kept the slot keys in a separate keys.log
+
+
+def key_words(key: str) -> np.ndarray:
+    """The 20-byte sha1 key as 3 uint64 words (zero padded), the form stored on disk."""
+    return np.frombuffer(bytes.fromhex(key).ljust(24, b"\0"), dtype="uint64")
+
+
+class EmbeddingCache:
+    """
+    Query-embedding cache with two tiers:
+    - an in-process LRU (OrderedDict) of `memory_size` vectors,
+    - an on-disk tier under `cache_dir/<model>/`: memory-mapped arrays of `disk_size`
+      slots holding the float32 vectors, the key of each slot and its last-access
+      time (used for LRU eviction; 0 marks a free slot).
+
+    One instance is meant to be shared by every session of the process (all methods
+    take a lock). The disk tier survives restarts and can be shared by several
+    processes: slots are allocated and written under a file lock, and a vector is
+    only returned if the key stored next to it still matches after it was copied.
+    """
+
+    def __init__(self, cache_dir: str, model_name: str, memory_size: int = 2048, disk_size: int = 20000):
+        self.model_name = model_name
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        self.dir = os.path.join(cache_dir, model_name.replace("/", "_"))
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._vectors = None
+        self._keys = None
+        self._last_used = None
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+        if disk_size > 0:
+            os.makedirs(self.dir, exist_ok=True)
+            self._open_disk_tier()
+
+    # --- disk tier -------------------------------------------------------------
+    def _path(self, name):
+        return os.path.join(self.dir, name)
+
+    def _open_disk_tier(self, dim: int = None):
+        meta_path = self._path("meta.json")
+        with file_lock(self._path("lock")):
+            meta = None
+            if os.path.exists(meta_path):
+                with open(meta_path) as f:
+                    meta = json.load(f)
+                if meta.get("disk_size") != self.disk_size or meta.get("format") != DISK_FORMAT:
+                    print("⚠️ Embedding cache size or format changed, resetting the disk tier.")
+                    self._reset_disk_tier()
+                    meta = None
+            if meta is None:
+                if dim is None:
+                    return  # created lazily on the first put(), once the dimension is known
+                self._map_arrays(dim, mode="w+")
+                # meta.json last: other processes only open complete files
+                with open(meta_path + ".tmp", "w") as f:
+                    json.dump({"model": self.model_name, "dim": dim, "disk_size": self.disk_size,
+                               "format": DISK_FORMAT}, f)
+                os.replace(meta_path + ".tmp", meta_path)
+            else:
+                self._map_arrays(meta["dim"], mode="r+")
+
+    def _map_arrays(self, dim: int, mode: str):
+        self._vectors = np.memmap(self._path("vectors.f32"), dtype="float32", mode=mode,
+                                  shape=(self.disk_size, dim))
+        self._keys = np.memmap(self._path("keys.u64"), dtype="uint64", mode=mode, shape=(self.disk_size, 3))
+        self._last_used = np.memmap(self._path("last_used.f64"), dtype="float64", mode=mode,
+                                    shape=(self.disk_size,))
+
+    def _reset_disk_tier(self):
+        for name in ["meta.json", "vectors.f32", "keys.u64", "last_used.f64", "keys.log"]:
+            if os.path.exists(self._path(name)):
+                os.remove(self._path(name))
+        self._vectors = self._keys = self._last_used = None
+
+    def _disk_lookup(self, words: np.ndarray):
+        candidates = np.flatnonzero(self._keys[:, 0] == words[0])
+        for slot in candidates:
+            if np.array_equal(self._keys[slot], words):
+                return int(slot)
+        return None
+
+    def _disk_get(self, key: str):
+        if self._vectors is None:
+            if self.disk_size <= 0 or not os.path.exists(self._path("meta.json")):
+                return None
+            self._open_disk_tier()   # created by another process since
+            if self._vectors is None:
+                return None
+        words = key_words(key)
+        slot = self._disk_lookup(words)
+        if slot is None:
+            return None
+        vector = np.array(self._vectors[slot])
+        if not np.array_equal(self._keys[slot], words):
+            return None  # slot reused by another process while copying
+        self._last_used[slot] = time.time()
+        return vector
+
+    def _disk_put(self, key: str, vector: np.ndarray):
+        if self.disk_size <= 0:
+            return
+        if self._vectors is None:
+            self._open_disk_tier(dim=vector.shape[0])
+        if vector.shape[0] != self._vectors.shape[1]:
+            return  # another model dimension; never mix vectors in one file
+        words = key_words(key)
+        with file_lock(self._path("lock")):
+            slot = self._disk_lookup(words)
+            if slot is None:
+                free = np.flatnonzero(self._last_used == 0)
+                if len(free):
+                    slot = int(free[0])
+                else:
+                    # Size-based eviction: reuse the least recently used slot
+                    slot = int(np.argmin(self._last_used))
+                    self.stats["evictions"] += 1
+                # Key cleared while the vector is written, so readers never match a torn slot
+                self._keys[slot] = 0
+                self._vectors[slot] = vector
+                self._keys[slot] = words
+            self._last_used[slot] = time.time()
+
+    # --- public API ------------------------------------------------------------
+    def get(self, text: str):
+        key = cache_key(text, self.model_name)
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return vector
+            vector = self._disk_get(key)
+            if vector is not None:
+                self._memory_put(key, vector)
+                self.stats["disk_hits"] += 1
+                return vector
+            self.stats["misses"] += 1
+            return None
+
+    def _memory_put(self, key: str, vector: np.ndarray):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def put(self, text: str, vector):
+        key = cache_key(text, self.model_name)
+        vector = np.asarray(vector, dtype="float32")
+        with self._lock:
+            self._memory_put(key, vector)
+            self._disk_put(key, vector)
+
+    def embed(self, texts: list, embed_fn):
+        """
+        Returns (vectors, hits, misses) for `texts`. Only the cache misses are sent to
+        `embed_fn` (e.g. `embedder.embed_documents`), in a single call.
+        """
+        vectors = [self.get(text) for text in texts]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            fresh = embed_fn([texts[i] for i in missing])
+            for i, vector in zip(missing, fresh):
+                vectors[i] = np.asarray(vector, dtype="float32")
+                self.put(texts[i], vectors[i])
+        return np.vstack(vectors).astype("float32"), len(texts) - len(missing), len(missing)
+
+    def flush(self):
+        with self._lock:
+            if self._vectors is not None:
+                self._vectors.flush()
+                self._keys.flush()
+                self._last_used.flush()
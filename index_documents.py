@@ -0,0 +1,362 @@
+"""
+Local, incremental chunk-and-embed indexing (the notebooks 01 + 02 without Databricks).
+
+Documents are streamed through a generator pipeline:
+
+    pages (PyMuPDF, same cleaning as notebook 01)
+      -> chunks (RecursiveCharacterTextSplitter 1000 / 150, acronym expansion, min 120 chars)
+      -> new chunks only (content hash not already in the index)
+      -> concurrent, rate-limited embedding batches with retry
+      -> appended to the FAISS index and the chunk store
+
+Chunks are identified by a sha1 of (report_name, page, text), kept in `<index>.hashes`
+(one per FAISS position). Re-running on an unchanged report embeds nothing; a new
+report only embeds its own chunks. The existing vectors are never recomputed, and the
+chunk store, its pre-tokenized texts and the per-report shards only receive the new
+chunks. The chunk store is committed first and the index last: a run interrupted in
+between leaves extra chunks in the store, which the next run drops before appending.
+
+    python index_documents.py --index /data/ipcc_faiss.index --chunk-store /data/ipcc_chunk_store \\
+        --pdf AR6_WGII.pdf --report-name IPCC_AR6_WGII --concurrency 4 --requests-per-second 5
+
+`--embedder stub` uses offline_stubs.StubEmbeddings instead of the Databricks endpoint.
+Plain-text inputs (.txt, pages separated by form feeds) are accepted as well.
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import random
+import re
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import faiss
+import numpy as np
+
+from chunk_store import ChunkStore, append_chunk_store, write_chunk_store
+from shards import add_to_shards, is_sharded, shards_path, split_index
+
+
+# Same values as notebook 01
+MIN_PAGE_LENGTH = 80
+MIN_CHUNK_LENGTH = 120
+TARGET_CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 150
+JUNK_PATTERN = re.compile(r"(contributing authors|isbn|doi:)", re.IGNORECASE)
+
+
+# ------------------------------------------------------------------------------
+# === PAGES & CHUNKS (GENERATORS) ===
+# ------------------------------------------------------------------------------
+def clean_page_text(text: str) -> str:
+    """Page cleaning of notebook 01: junk paragraphs dropped, whitespace flattened."""
+    paragraphs = [para.strip() for para in text.strip().split("\n\n") if not JUNK_PATTERN.search(para)]
+    cleaned = "\n\n".join(paragraphs).replace("\xa0", " ").replace("\n", " ")
+    return re.sub(r"\s+", " ", cleaned).strip()
+
+
+def read_raw_pages(path: str):
+    """Yields (page_number, raw_text); page numbers are 1-based."""
+    if path.lower().endswith(".pdf"):
+        import fitz  # PyMuPDF
+        with fitz.open(path) as doc:
+            for page_num in range(doc.page_count):
+                yield page_num + 1, doc.load_page(page_num).get_text("text")
+    else:
+        with open(path, encoding="utf-8") as f:
+            for page_num, text in enumerate(f.read().split("\f")):
+                yield page_num + 1, text
+
+
+def extract_pages(path: str):
+    for page_number, text in read_raw_pages(path):
+        if not text.strip() or len(text.strip()) < MIN_PAGE_LENGTH:
+            continue
+        cleaned = clean_page_text(text)
+        if len(cleaned) >= MIN_PAGE_LENGTH:
+            yield page_number, cleaned
+
+
+def extract_acronyms(path: str, first_page: int, last_page: int) -> dict:
+    """Acronym list pages (1-based, inclusive) -> {acronym: "definition (ACRONYM)"}, as in notebook 01."""
+    text = "".join(t for n, t in read_raw_pages(path) if first_page <= n <= last_page)
+    pattern = re.compile(r"\b([A-Z][A-Z0-9\-/\.]{1,10})\b\s+([^\n]+?)(?=\n[A-Z]{2,10}\s|$)")
+    acronym_map = {acronym: f"{definition.strip().replace(chr(0xa0), ' ')} ({acronym})"
+                   for acronym, definition in pattern.findall(text)}
+    acronym_map.pop("VI", None)   # false positive
+    return acronym_map
+
+
+def expand_acronyms(text: str, acronym_map: dict) -> str:
+    for acronym, full in acronym_map.items():
+        text = re.sub(rf"\b{re.escape(acronym)}\b", full, text)
+    return text
+
+
+def make_splitter():
+    try:
+        from langchain_text_splitters import RecursiveCharacterTextSplitter
+    except ImportError:
+        from langchain.text_splitter import RecursiveCharacterTextSplitter
+    return RecursiveCharacterTextSplitter(
+        chunk_size=TARGET_CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, separators=["\n\n", "\n", ".", " "]
+    )
+
+
+def chunk_pages(pages, report_name: str, acronym_map: dict = None):
+    """Yields (text, metadata) per chunk; `chunk_index` is assigned when the chunk is appended."""
+    splitter = make_splitter()
+    for page_number, text in pages:
+        if acronym_map:
+            text = expand_acronyms(text, acronym_map)
+        for chunk in splitter.split_text(text):
+            chunk = chunk.strip()
+            if len(chunk) >= MIN_CHUNK_LENGTH:
+                yield chunk, {"source": f"page_{page_number}", "report_name": report_name}
+
+
+def content_hash(text: str, metadata: dict) -> str:
+    key = f"{metadata.get('report_name', '')}\0{metadata.get('source', '')}\0{text}"
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def batched(iterable, size: int):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+# ------------------------------------------------------------------------------
+# === CONCURRENT, RATE-LIMITED EMBEDDING ===
+# ------------------------------------------------------------------------------
+class RateLimiter:
+    """Spaces calls at least 1 / `rate` seconds apart across threads (no limit if rate is falsy)."""
+
+    def __init__(self, rate: float = None):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def embed_with_retry(embedder, texts: list, limiter: RateLimiter, retries: int = 5, base_delay: float = 1.0):
+    for attempt in range(retries + 1):
+        limiter.wait()
+        try:
+            vectors = np.asarray(embedder.embed_documents(texts), dtype="float32")
+            if vectors.shape[0] != len(texts):
+                raise ValueError(f"{vectors.shape[0]} embeddings returned for {len(texts)} texts")
+            return vectors
+        except Exception as e:
+            if attempt == retries:
+                raise
+            delay = min(60.0, base_delay * 2 ** attempt) * (0.5 + random.random())
+            print(f"⚠️ Embedding batch failed ({e}), retry {attempt + 1}/{retries} in {delay:.1f}s.")
+            time.sleep(delay)
+
+
+def embed_batches(batches, embedder, concurrency: int = 4, requests_per_second: float = None, retries: int = 5):
+    """
+    Yields (batch, vectors) in input order while up to `concurrency` requests are in
+    flight; at most 2 x concurrency batches are read ahead from the generator.
+    """
+    limiter = RateLimiter(requests_per_second)
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="rag-indexing") as pool:
+        pending = []
+        for batch in batches:
+            texts = [text for text, _, _ in batch]
+            pending.append((batch, pool.submit(embed_with_retry, embedder, texts, limiter, retries)))
+            if len(pending) >= 2 * concurrency:
+                done_batch, future = pending.pop(0)
+                yield done_batch, future.result()
+        for done_batch, future in pending:
+            yield done_batch, future.result()
+
+
+# ------------------------------------------------------------------------------
+# === INCREMENTAL APPEND ===
+# ------------------------------------------------------------------------------
+def hashes_path(index_path: str) -> str:
+    return index_path + ".hashes"
+
+
+def load_hashes(index_path: str, chunk_store, count: int) -> tuple:
+    """
+    (hashes of the first `count` positions, whether the sidecar holds exactly those);
+    recomputed from the chunk store if the sidecar is missing or out of date.
+    """
+    path = hashes_path(index_path)
+    if os.path.exists(path):
+        with open(path) as f:
+            hashes = f.read().split()
+        if len(hashes) == count and all(len(digest) == 40 for digest in hashes):
+            return hashes, True
+    return [content_hash(chunk_store.text(p), chunk_store.metadata(p)) for p in range(count)], False
+
+
+def _write_atomic(path: str, write):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = path + ".tmp"
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _write_lines(path: str, lines: list):
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def index_documents(documents: list, index_path: str, chunk_store_path: str, embedder,
+                    batch_size: int = 32, concurrency: int = 4, requests_per_second: float = None,
+                    retries: int = 5) -> dict:
+    """
+    `documents`: list of (path, report_name, acronym_map or None). Appends the new chunks
+    to the index (created as IndexFlatIP if missing) and the chunk store; returns counts.
+    """
+    store = ChunkStore(chunk_store_path) if os.path.exists(chunk_store_path) else None
+    index = faiss.read_index(index_path) if os.path.exists(index_path) else None
+    n_existing = index.ntotal if index is not None else 0
+    n_stored = len(store) if store is not None else 0
+    if n_stored < n_existing:
+        raise ValueError(f"Index has {n_existing} vectors but the chunk store has {n_stored} chunks")
+    if n_stored > n_existing:
+        # Store committed but index not written: the extra chunks are dropped and re-embedded
+        print(f"⚠️ Chunk store has {n_stored - n_existing} chunks more than the index (interrupted run), "
+              f"dropping them.")
+
+    hashes, hashes_in_sync = load_hashes(index_path, store, n_existing) if store is not None else ([], False)
+    known = set(hashes)
+    next_chunk_index = 0
+    if store is not None and store.column_codes("chunk_index") is not None:
+        next_chunk_index = int(np.max(store.column_codes("chunk_index")[:n_existing], initial=-1)) + 1
+
+    stats = {"chunks_seen": 0, "chunks_skipped": 0, "chunks_added": 0}
+
+    def new_chunks():
+        for path, report_name, acronym_map in documents:
+            for text, metadata in chunk_pages(extract_pages(path), report_name, acronym_map):
+                stats["chunks_seen"] += 1
+                digest = content_hash(text, metadata)
+                if digest in known:
+                    stats["chunks_skipped"] += 1
+                    continue
+                known.add(digest)
+                yield text, metadata, digest
+
+    new_records, new_vectors = [], []
+    t0 = time.time()
+    for batch, vectors in embed_batches(batched(new_chunks(), batch_size), embedder,
+                                        concurrency=concurrency, requests_per_second=requests_per_second,
+                                        retries=retries):
+        faiss.normalize_L2(vectors)
+        if index is None:
+            index = faiss.IndexFlatIP(vectors.shape[1])   # as in notebook 02
+        if vectors.shape[1] != index.d:
+            raise ValueError(f"Embedding dimension {vectors.shape[1]} does not match the index ({index.d})")
+        index.add(vectors)
+        new_vectors.append(vectors)
+        for text, metadata, digest in batch:
+            position = n_existing + len(new_records)
+            new_records.append((f"chunk_{position}", text, {**metadata, "chunk_index": next_chunk_index}))
+            hashes.append(digest)
+            next_chunk_index += 1
+        stats["chunks_added"] = len(new_records)
+        print(f"  {stats['chunks_added']} chunks embedded ({time.time() - t0:.0f}s)")
+
+    if not new_records:
+        if n_stored > n_existing:
+            append_chunk_store(chunk_store_path, [], keep=n_existing)
+        print(f"✅ Nothing to add ({stats['chunks_skipped']} chunks already indexed).")
+        return stats
+
+    # 1. Chunk store: the new records are appended in place (pre-tokenized texts too)
+    if store is not None:
+        append_chunk_store(chunk_store_path, new_records, keep=n_existing)
+    else:
+        write_chunk_store(chunk_store_path, new_records)
+    # 2. Index (FAISS has no append to a file: written whole, then swapped in), then hashes
+    _write_atomic(index_path, lambda tmp: faiss.write_index(index, tmp))
+    if hashes_in_sync:
+        with open(hashes_path(index_path), "a") as f:
+            f.write("\n".join(hashes[n_existing:]) + "\n")
+    else:
+        _write_atomic(hashes_path(index_path), lambda tmp: _write_lines(tmp, hashes))
+
+    # 3. Derived files of the previous contents: BM25 is rebuilt by rag_core.load_faiss_resources;
+    # per-report shards get the new vectors only (re-split if an earlier run stopped before them)
+    shutil.rmtree(index_path + ".bm25", ignore_errors=True)
+    shard_dir = shards_path(index_path)
+    if is_sharded(shard_dir):
+        with open(os.path.join(shard_dir, "shards.json")) as f:
+            shard_manifest = json.load(f)
+        if shard_manifest["ntotal"] == n_existing:
+            add_to_shards(shard_dir, np.vstack(new_vectors), np.arange(n_existing, index.ntotal),
+                          [metadata["report_name"] for _, _, metadata in new_records])
+        else:
+            split_index(index_path, ChunkStore(chunk_store_path), shard_dir,
+                        shard_manifest.get("index_factory", "Flat"), shard_manifest.get("search_params"))
+    print(f"✅ Added {stats['chunks_added']} chunks ({stats['chunks_skipped']} unchanged skipped); "
+          f"index now has {index.ntotal} vectors.")
+    return stats
+
+
+def make_embedder(name: str, endpoint: str, dim: int):
+    if name == "stub":
+        from offline_stubs import StubEmbeddings
+        return StubEmbeddings(dim=dim)
+    from databricks_langchain import DatabricksEmbeddings
+    return DatabricksEmbeddings(endpoint=endpoint)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--index", required=True, help="FAISS index to append to (created if missing)")
+    parser.add_argument("--chunk-store", required=True, help="chunk store to append to (created if missing)")
+    parser.add_argument("--pdf", action="append", required=True, help="document to index (repeatable)")
+    parser.add_argument("--report-name", action="append", help="report name per --pdf (default: file name)")
+    parser.add_argument("--acronym-pages", action="append",
+                        help="acronym list pages per --pdf, e.g. 1983-1990 for AR6 WGIII ('-' for none)")
+    parser.add_argument("--embedder", choices=["databricks", "stub"], default="databricks")
+    parser.add_argument("--endpoint", default="databricks-gte-large-en")
+    parser.add_argument("--stub-dim", type=int, default=1024)
+    parser.add_argument("--batch-size", type=int, default=32, help="texts per embedding request")
+    parser.add_argument("--concurrency", type=int, default=4, help="embedding requests in flight")
+    parser.add_argument("--requests-per-second", type=float, default=None)
+    parser.add_argument("--retries", type=int, default=5)
+    args = parser.parse_args()
+
+    report_names = args.report_name or []
+    acronym_pages = args.acronym_pages or []
+    documents = []
+    for i, path in enumerate(args.pdf):
+        report_name = report_names[i] if i < len(report_names) else os.path.splitext(os.path.basename(path))[0]
+        acronym_map = None
+        if i < len(acronym_pages) and acronym_pages[i] != "-":
+            first, last = (int(p) for p in acronym_pages[i].split("-"))
+            acronym_map = extract_acronyms(path, first, last)
+            print(f"✅ Extracted {len(acronym_map)} acronyms from {path}.")
+        documents.append((path, report_name, acronym_map))
+
+    index_documents(documents, args.index, args.chunk_store, make_embedder(args.embedder, args.endpoint, args.stub_dim),
+                    batch_size=args.batch_size, concurrency=args.concurrency,
+                    requests_per_second=args.requests_per_second, retries=args.retries)
+
+
+if __name__ == "__main__":
+    main()
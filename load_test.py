@@ -0,0 +1,421 @@
+"""
+Multi-user load test of the answer pipeline, to find the saturation point of one instance.
+
+Simulated sessions behave like Streamlit sessions of app.py: each one asks IPCC
+questions one after the other, streams the answer, keeps the last two turns as
+chat history and waits `--think-time` seconds before its next question. Sessions
+run as threads inside `--workers` worker processes (like Streamlit / uvicorn
+instances); concurrency is ramped up step by step (`--concurrency 1 2 4 8 ...`),
+each step lasting `--step-seconds`.
+
+Targets:
+    inprocess   rag_core in each worker, against the stub endpoints of offline_stubs.py
+                (injected LLM / embedding latency) over a synthetic or real corpus
+    http        a running api.py (`--url`), through api_client.stream_answer
+
+    python load_test.py --concurrency 1 2 4 8 16 32 --workers 2 --step-seconds 30 \\
+        --chat-latency 0.6 --token-latency 0.01 --embed-latency 0.08 --output load.json
+    python load_test.py --target http --url http://127.0.0.1:8000 --server-pids 1234 1235
+
+Per step: throughput (answers / s), end-to-end, time-to-first-token and per-stage
+p50 / p95 / p99, errors, and the peak RSS of every worker process during the step
+(VmHWM, reset at the start of each step on Linux; for the http target, also the
+memory of the `--server-pids`). `saturation` is the last step whose throughput
+still grew by more than `--saturation-gain` over the previous one.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+
+QUESTIONS = [
+    "How can the steel industry reduce its emissions?",
+    "What role does hydrogen play in decarbonizing heavy industry?",
+    "Which mitigation options exist for the cement sector?",
+    "How does electrification of transport affect electricity demand?",
+    "What are the costs of carbon capture and storage compared to renewables?",
+    "How much do pathways limiting warming to 1.5°C rely on carbon dioxide removal?",
+    "What is the potential of BECCS and DACCS?",
+    "How do AFOLU emissions evolve in the SSP1-1.9 scenario?",
+    "Which policies are most effective at reducing emissions from buildings?",
+    "What are the co-benefits of urban mitigation strategies?",
+    "How fast must coal power be phased out in 1.5°C pathways?",
+    "What financing gaps exist for mitigation in developing countries?",
+    "How does demand-side mitigation reduce emissions in the transport sector?",
+    "What is the remaining carbon budget for 1.5°C?",
+    "How can agriculture reduce methane emissions?",
+    "What are the risks of relying on bioenergy for mitigation?",
+    "How does carbon pricing affect industrial competitiveness?",
+    "What is the mitigation potential of energy efficiency in industry?",
+    "How do net-zero targets differ between CO2 and all greenhouse gases?",
+    "What role does international cooperation play in climate mitigation?",
+]
+
+STAGES = {
+    "expansion": "query_expansion",
+    "embedding": "embedding",
+    "search": "faiss_search",
+    "lexical": "lexical_retrieval",
+    "window_expansion": "span_build",
+    "rerank": "rerank",
+    "prompt_build": "prompt_build",
+    "generation": "generation",
+}
+
+
+def percentiles(values: list) -> dict:
+    if not values:
+        return {"n": 0}
+    values = np.asarray(values, dtype="float64")
+    return {
+        "n": int(len(values)),
+        "mean": float(values.mean()),
+        "p50": float(np.percentile(values, 50)),
+        "p95": float(np.percentile(values, 95)),
+        "p99": float(np.percentile(values, 99)),
+        "max": float(values.max()),
+    }
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def reset_peak_rss():
+    """Resets this process's VmHWM to its current RSS (Linux), so the next peak is per step."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def proc_memory_mb(pid: int) -> dict:
+    """Current (VmRSS) and peak (VmHWM) resident memory of another process (Linux)."""
+    memory = {}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith(("VmRSS:", "VmHWM:")):
+                    key, value = line.split(":")
+                    memory["rss_mb" if key == "VmRSS" else "peak_rss_mb"] = int(value.split()[0]) / 1024
+    except OSError:
+        pass
+    return memory
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+# ------------------------------------------------------------------------------
+# === TARGETS ===
+# ------------------------------------------------------------------------------
+class InProcessTarget:
+    """rag_core in this process, with stub endpoints; resources are loaded once per worker."""
+
+    def __init__(self, args):
+        # Before importing rag_core: keep the stub vectors out of the real embedding cache
+        self.cache_dir = None
+        if "RAG_EMBEDDING_CACHE_DIR" not in os.environ:
+            self.cache_dir = tempfile.mkdtemp(prefix="rag_load_embedding_cache_")
+            os.environ["RAG_EMBEDDING_CACHE_DIR"] = self.cache_dir
+        import rag_core
+        from offline_stubs import StubChatModel, StubEmbeddings
+
+        self.rag_core = rag_core
+        self.args = args
+        index, chunk_store, lexical_index = rag_core.load_faiss_resources(
+            args.index, metadata_path=None, chunk_store_path=args.chunk_store, with_lexical=args.lexical
+        )
+        self.resources = dict(index=index, chunk_store=chunk_store, lexical_index=lexical_index)
+        rag_core.set_models(
+            embeddings=StubEmbeddings(dim=index.d, latency=args.embed_latency, jitter=args.jitter),
+            chat=StubChatModel(latency=args.chat_latency, token_latency=args.token_latency, jitter=args.jitter,
+                               answer_tokens=args.answer_tokens),
+        )
+        if args.reranker:
+            rag_core.reranker.load()   # model load time is not part of the per-request numbers
+        else:
+            rag_core.reranker.disable()
+
+    def ask(self, question: str, chat_history: list):
+        kwargs = dict(k=self.args.k, window=self.args.window, rerank_top_n=self.args.rerank_top_n,
+                      chat_history=chat_history, use_answer_cache=self.args.answer_cache)
+        if self.args.mode:
+            kwargs["mode"] = self.args.mode
+        return self.rag_core.generate_answer_stream(question, **self.resources, **kwargs)
+
+    def close(self):
+        if self.cache_dir:
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+
+class HttpTarget:
+    """A running api.py, through the same client app.py uses with RAG_API_URL."""
+
+    def __init__(self, args):
+        from api_client import stream_answer
+
+        self.stream_answer = stream_answer
+        self.args = args
+
+    def ask(self, question: str, chat_history: list):
+        kwargs = dict(k=self.args.k, window=self.args.window, rerank_top_n=self.args.rerank_top_n,
+                      chat_history=chat_history, use_answer_cache=self.args.answer_cache)
+        if self.args.mode:
+            kwargs["mode"] = self.args.mode
+        return self.stream_answer(self.args.url, question, **kwargs)
+
+    def close(self):
+        pass
+
+
+TARGETS = {"inprocess": InProcessTarget, "http": HttpTarget}
+
+
+# ------------------------------------------------------------------------------
+# === SESSIONS (THREADS IN A WORKER PROCESS) ===
+# ------------------------------------------------------------------------------
+def run_session(target, session_id: int, end_time: float, think_time: float, records: list, lock: threading.Lock):
+    rng = random.Random(session_id)
+    history = []   # like app.py: the last two (user, assistant) turns
+    while time.monotonic() < end_time:
+        question = rng.choice(QUESTIONS)
+        record = {"session": session_id, "start": time.time()}
+        t0 = time.perf_counter()
+        try:
+            answer = ""
+            for event in target.ask(question, [{"user": u, "assistant": a} for u, a in history[-2:]]):
+                if event["type"] == "token" and "time_to_first_token" not in record:
+                    record["time_to_first_token"] = time.perf_counter() - t0
+                elif event["type"] == "done":
+                    answer = event["answer"]
+                    record["timings"] = {key: value for key, value in event["timings"].items()
+                                         if isinstance(value, (int, float))}
+            record["end_to_end"] = time.perf_counter() - t0
+            history.append((question, answer))
+        except Exception as e:
+            record["error"] = f"{type(e).__name__}: {e}"
+            record["end_to_end"] = time.perf_counter() - t0
+        with lock:
+            records.append(record)
+        if think_time > 0:
+            time.sleep(rng.uniform(0.5, 1.5) * think_time)
+
+
+def run_step(target, first_session: int, n_sessions: int, seconds: float, think_time: float) -> list:
+    records, lock = [], threading.Lock()
+    end_time = time.monotonic() + seconds
+    threads = [
+        threading.Thread(target=run_session, args=(target, first_session + i, end_time, think_time, records, lock),
+                         name=f"session-{first_session + i}", daemon=True)
+        for i in range(n_sessions)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return records
+
+
+def worker_main(worker_id: int, args_dict: dict, conn):
+    """Worker process: builds the target once, then runs the steps sent by the driver."""
+    args = argparse.Namespace(**args_dict)
+    try:
+        target = TARGETS[args.target](args)
+    except Exception as e:
+        conn.send({"error": f"{type(e).__name__}: {e}"})
+        return
+    try:
+        conn.send({"ready": True, "rss_mb": proc_memory_mb(os.getpid()).get("rss_mb", peak_rss_mb())})
+        while True:
+            step = conn.recv()
+            if step is None:
+                return
+            reset_peak_rss()
+            start_rss = proc_memory_mb(os.getpid()).get("rss_mb")
+            records = run_step(target, step["first_session"], step["sessions"], step["seconds"], args.think_time)
+            memory = proc_memory_mb(os.getpid())
+            # Without /proc (not Linux): lifetime peak, and no per-step growth
+            conn.send({"records": records, "peak_rss_mb": memory.get("peak_rss_mb", peak_rss_mb()),
+                       "start_rss_mb": start_rss})
+    finally:
+        target.close()
+
+
+# ------------------------------------------------------------------------------
+# === DRIVER ===
+# ------------------------------------------------------------------------------
+def step_report(concurrency: int, seconds: float, replies: list, server_pids: list) -> dict:
+    records = [record for reply in replies for record in reply["records"]]
+    ok = [record for record in records if "error" not in record]
+    report = {
+        "concurrency": concurrency,
+        "seconds": seconds,
+        "requests": len(records),
+        "errors": len(records) - len(ok),
+        "error_samples": sorted({record["error"] for record in records if "error" in record})[:5],
+        "throughput_rps": len(ok) / seconds if seconds > 0 else 0.0,
+        "end_to_end": percentiles([record["end_to_end"] for record in ok]),
+        "time_to_first_token": percentiles([record["time_to_first_token"] for record in ok
+                                            if "time_to_first_token" in record]),
+        "stages": {name: percentiles([record["timings"][key] for record in ok if key in record.get("timings", {})])
+                   for name, key in STAGES.items()},
+        "workers": [
+            {"peak_rss_mb": reply["peak_rss_mb"], "start_rss_mb": reply["start_rss_mb"],
+             "sessions": reply["sessions"],
+             "rss_growth_per_session_mb": None if reply["start_rss_mb"] is None
+             else (reply["peak_rss_mb"] - reply["start_rss_mb"]) / max(1, reply["sessions"])}
+            for reply in replies
+        ],
+    }
+    if server_pids:
+        report["servers"] = {str(pid): proc_memory_mb(pid) for pid in server_pids}
+    return report
+
+
+def find_saturation(steps: list, min_gain: float) -> dict:
+    """Last step whose throughput still grew by more than `min_gain` (relative) over the previous one."""
+    best = steps[0] if steps else None
+    for previous, step in zip(steps, steps[1:]):
+        if step["throughput_rps"] <= previous["throughput_rps"] * (1.0 + min_gain):
+            break
+        best = step
+    if best is None:
+        return {}
+    return {"concurrency": best["concurrency"], "throughput_rps": best["throughput_rps"],
+            "end_to_end_p95": best["end_to_end"].get("p95"), "end_to_end_p99": best["end_to_end"].get("p99")}
+
+
+def prepare_corpus(args):
+    """Synthetic corpus (cached in --data-dir) unless --index / --chunk-store point at a real one."""
+    if args.target != "inprocess" or args.index:
+        return
+    from offline_stubs import build_synthetic_corpus
+
+    path = os.path.join(args.data_dir, f"n{args.size}_d{args.dim}_Flat_s0")
+    if not os.path.exists(os.path.join(path, "chunk_store")):
+        print(f"Building synthetic corpus of {args.size} vectors in {path} ...", file=sys.stderr)
+        build_synthetic_corpus(path, args.size, dim=args.dim)
+    args.index = os.path.join(path, "index.faiss")
+    args.chunk_store = os.path.join(path, "chunk_store")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--target", choices=sorted(TARGETS), default="inprocess")
+    parser.add_argument("--url", default=os.environ.get("RAG_API_URL", "http://127.0.0.1:8000"))
+    parser.add_argument("--server-pids", type=int, nargs="*", default=[], help="api.py processes to report RSS of")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16],
+                        help="total concurrent sessions of each ramp step")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes sharing the sessions")
+    parser.add_argument("--step-seconds", type=float, default=30.0)
+    parser.add_argument("--think-time", type=float, default=0.0, help="mean pause between a session's questions")
+    parser.add_argument("--saturation-gain", type=float, default=0.1)
+    # Pipeline parameters (same defaults as app.py)
+    parser.add_argument("--mode", default=None, help="pipeline mode (default: RAG_PIPELINE_MODE)")
+    parser.add_argument("-k", type=int, default=4)
+    parser.add_argument("--window", type=int, default=1)
+    parser.add_argument("--rerank-top-n", type=int, default=6)
+    parser.add_argument("--answer-cache", action="store_true", help="allow semantic answer cache hits")
+    # In-process target: corpus, stub latencies, reranker
+    parser.add_argument("--index", default=None, help="FAISS index (default: synthetic corpus of --size)")
+    parser.add_argument("--chunk-store", default=None)
+    parser.add_argument("--size", type=int, default=100000)
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("--data-dir", default="/tmp/rag_benchmark")
+    parser.add_argument("--lexical", action="store_true")
+    parser.add_argument("--reranker", action="store_true", help="load the cross-encoder (default: FAISS order)")
+    parser.add_argument("--embed-latency", type=float, default=0.08)
+    parser.add_argument("--chat-latency", type=float, default=0.6, help="seconds per chat call / to first token")
+    parser.add_argument("--token-latency", type=float, default=0.01)
+    parser.add_argument("--answer-tokens", type=int, default=200)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--output", default=None, help="JSON file (default: stdout)")
+    args = parser.parse_args()
+    prepare_corpus(args)
+
+    # Spawned workers: no state inherited from this process, one pipeline copy each
+    context = multiprocessing.get_context("spawn")
+    pipes, workers, baseline_rss = [], [], []
+    for worker_id in range(args.workers):
+        parent_conn, child_conn = context.Pipe()
+        process = context.Process(target=worker_main, args=(worker_id, vars(args), child_conn),
+                                  name=f"load-worker-{worker_id}", daemon=True)
+        process.start()
+        pipes.append(parent_conn)
+        workers.append(process)
+    for conn in pipes:
+        ready = conn.recv()
+        if "error" in ready:
+            raise SystemExit(f"Worker failed to start: {ready['error']}")
+        baseline_rss.append(ready["rss_mb"])
+    print(f"✅ {args.workers} workers ready ({', '.join(f'{rss:.0f} MB' for rss in baseline_rss)}).", file=sys.stderr)
+
+    steps = []
+    try:
+        for concurrency in args.concurrency:
+            # Sessions split as evenly as possible over the workers
+            shares = [concurrency // args.workers + (i < concurrency % args.workers) for i in range(args.workers)]
+            t0 = time.perf_counter()
+            first = 0
+            for conn, share in zip(pipes, shares):
+                conn.send({"first_session": first, "sessions": share, "seconds": args.step_seconds})
+                first += share
+            replies = []
+            for conn, share in zip(pipes, shares):
+                replies.append({**conn.recv(), "sessions": share})
+            elapsed = time.perf_counter() - t0
+            steps.append(step_report(concurrency, elapsed, replies, args.server_pids))
+            step = steps[-1]
+            print(f"sessions={concurrency:<4} {step['throughput_rps']:7.2f} answers/s  "
+                  f"e2e p50 {step['end_to_end'].get('p50', 0):6.2f}s p95 {step['end_to_end'].get('p95', 0):6.2f}s "
+                  f"p99 {step['end_to_end'].get('p99', 0):6.2f}s  errors {step['errors']}  "
+                  f"peak RSS {max(w['peak_rss_mb'] for w in step['workers']):.0f} MB", file=sys.stderr)
+    finally:
+        for conn in pipes:
+            conn.send(None)
+        for process in workers:
+            process.join(timeout=10)
+
+    report = {
+        "git_commit": git_commit(),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "config": vars(args),
+        "steps": steps,
+        "saturation": find_saturation(steps, args.saturation_gain),
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"✅ Load test written to {args.output}.", file=sys.stderr)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
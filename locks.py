@@ -0,0 +1,25 @@
+"""
+Cross-process file locks, for the caches and artifacts shared by several workers
+(`api.py --workers N`, uvicorn workers, Streamlit instances on one host).
+"""
+import contextlib
+import os
+
+try:
+    import fcntl
+except ImportError:   # not POSIX: single-process use only
+    fcntl = None
+
+
+@contextlib.contextmanager
+def file_lock(path: str):
+    """Exclusive advisory lock on `path` (created if needed), held for the `with` block."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "a") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
@@ -0,0 +1,308 @@
+"""
+Offline stand-ins for the Databricks endpoints and a synthetic corpus generator.
+
+`StubEmbeddings` and `StubChatModel` have the methods rag_core uses on
+`DatabricksEmbeddings` / `ChatDatabricks` and sleep for a configurable latency
+instead of calling a serving endpoint; install them with `rag_core.set_models`.
+`StubServingServer` serves the same replies over HTTP in the Databricks
+`/serving-endpoints/{name}/invocations` format, with injected latency, slow tails,
+errors and dropped connections, to exercise serving_client.py.
+`build_synthetic_corpus` writes a FAISS index and a chunk store of any size with
+the same layout and metadata as the real IPCC artifacts.
+"""
+import hashlib
+import json
+import os
+import random
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import faiss
+import numpy as np
+
+from chunk_store import write_chunk_store
+
+
+# ------------------------------------------------------------------------------
+# === STUB ENDPOINTS ===
+# ------------------------------------------------------------------------------
+def _sleep(latency: float, jitter: float, rng: random.Random):
+    if latency > 0 or jitter > 0:
+        time.sleep(max(0.0, latency + rng.uniform(-jitter, jitter)))
+
+
+class StubEmbeddings:
+    """
+    Deterministic unit vectors derived from a hash of the text. Each request sleeps
+    `latency` seconds (± `jitter`) plus `per_text_latency` per text in the batch.
+    """
+
+    def __init__(self, dim: int = 1024, latency: float = 0.0, per_text_latency: float = 0.0,
+                 jitter: float = 0.0, seed: int = 0):
+        self.dim = dim
+        self.latency = latency
+        self.per_text_latency = per_text_latency
+        self.jitter = jitter
+        self.requests = 0
+        self._rng = random.Random(seed)
+
+    def _vector(self, text: str) -> list:
+        seed = int.from_bytes(hashlib.sha1(text.encode("utf-8")).digest()[:8], "little")
+        vector = np.random.default_rng(seed).standard_normal(self.dim).astype("float32")
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def embed_documents(self, texts: list) -> list:
+        self.requests += 1
+        _sleep(self.latency + self.per_text_latency * len(texts), self.jitter, self._rng)
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text: str) -> list:
+        return self.embed_documents([text])[0]
+
+
+class StubMessage:
+    def __init__(self, content: str):
+        self.content = content
+
+
+class StubChatModel:
+    """
+    Answers after `latency` seconds (± `jitter`). `stream` waits `latency` for the
+    first token and `token_latency` for each of the `answer_tokens` that follow.
+    Paraphrase prompts get `n_paraphrases` lines back, like the real model.
+    """
+
+    def __init__(self, latency: float = 0.0, token_latency: float = 0.0, jitter: float = 0.0,
+                 answer_tokens: int = 200, n_paraphrases: int = 2, seed: int = 0):
+        self.latency = latency
+        self.token_latency = token_latency
+        self.jitter = jitter
+        self.answer_tokens = answer_tokens
+        self.n_paraphrases = n_paraphrases
+        self.requests = 0
+        self._rng = random.Random(seed)
+
+    def _reply(self, messages: list) -> str:
+        system, question = messages[0].content, messages[-1].content
+        if "paraphrase" in system.lower():
+            return "\n".join(f"Paraphrase {i + 1}: {question}" for i in range(self.n_paraphrases))
+        if "background knowledge" in system:
+            return f"Background for: {question[:200]}"
+        return " ".join(["answer"] * (self.answer_tokens - 1) + ["(1)"])
+
+    def invoke(self, messages: list) -> StubMessage:
+        self.requests += 1
+        _sleep(self.latency + self.token_latency * self.answer_tokens, self.jitter, self._rng)
+        return StubMessage(self._reply(messages))
+
+    def stream(self, messages: list):
+        self.requests += 1
+        _sleep(self.latency, self.jitter, self._rng)
+        for i, word in enumerate(self._reply(messages).split(" ")):
+            if i:
+                time.sleep(self.token_latency)
+            yield StubMessage(word + " ")
+
+
+# ------------------------------------------------------------------------------
+# === STUB SERVING ENDPOINT (HTTP) ===
+# ------------------------------------------------------------------------------
+class StubServingServer:
+    """
+    Local HTTP/1.1 (keep-alive) server answering chat payloads (`messages`, optionally
+    `"stream": true` as SSE) and embedding payloads (`input`) like a serving endpoint.
+    Each request waits `latency` ± `jitter`; with probability `slow_rate` it waits
+    `slow_latency` instead (the tail that hedging targets), with `error_rate` it answers
+    `error_status`, and with `drop_rate` it closes the connection without answering.
+    """
+
+    def __init__(self, port: int = 0, latency: float = 0.0, jitter: float = 0.0, token_latency: float = 0.0,
+                 slow_rate: float = 0.0, slow_latency: float = 2.0, error_rate: float = 0.0,
+                 error_status: int = 503, drop_rate: float = 0.0, dim: int = 1024, seed: int = 0):
+        self.latency, self.jitter, self.token_latency = latency, jitter, token_latency
+        self.slow_rate, self.slow_latency = slow_rate, slow_latency
+        self.error_rate, self.error_status, self.drop_rate = error_rate, error_status, drop_rate
+        self.embeddings = StubEmbeddings(dim=dim)
+        self.chat = StubChatModel()
+        self.stats = {"requests": 0, "errors": 0, "drops": 0, "slow": 0, "connections": 0}
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def start(self) -> "StubServingServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, name="stub-serving", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _draw(self):
+        """(outcome, delay) of the next request: outcome is "ok", "error" or "drop"."""
+        with self._lock:
+            self.stats["requests"] += 1
+            roll = self._rng.random()
+            slow = self._rng.random() < self.slow_rate
+            delay = self.slow_latency if slow else max(0.0, self.latency + self._rng.uniform(-self.jitter, self.jitter))
+            self.stats["slow"] += int(slow)
+            if roll < self.drop_rate:
+                self.stats["drops"] += 1
+                return "drop", delay
+            if roll < self.drop_rate + self.error_rate:
+                self.stats["errors"] += 1
+                return "error", delay
+            return "ok", delay
+
+    def _handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                # Headers and body are separate writes: avoid the Nagle / delayed-ACK stall
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                with stub._lock:
+                    stub.stats["connections"] += 1
+
+            def log_message(self, *args):
+                pass
+
+            def handle(self):
+                try:
+                    super().handle()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass   # client went away, e.g. the losing copy of a hedged call
+
+            def _send_json(self, status: int, payload: dict):
+                body = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                if not (self.path.startswith("/serving-endpoints/") and self.path.endswith("/invocations")):
+                    self._send_json(404, {"error_code": "NOT_FOUND", "message": self.path})
+                    return
+                outcome, delay = stub._draw()
+                time.sleep(delay)
+                if outcome == "drop":
+                    self.close_connection = True
+                    self.connection.close()
+                    return
+                if outcome == "error":
+                    self._send_json(stub.error_status, {"error_code": "TEMPORARILY_UNAVAILABLE", "message": "injected"})
+                    return
+                if "input" in payload:
+                    texts = payload["input"] if isinstance(payload["input"], list) else [payload["input"]]
+                    vectors = stub.embeddings.embed_documents(texts)
+                    self._send_json(200, {"object": "list", "data": [
+                        {"object": "embedding", "index": i, "embedding": v} for i, v in enumerate(vectors)
+                    ]})
+                    return
+                messages = [StubMessage(m["content"]) for m in payload.get("messages", [])]
+                reply = stub.chat._reply(messages)
+                if not payload.get("stream"):
+                    self._send_json(200, {"object": "chat.completion", "choices": [
+                        {"index": 0, "message": {"role": "assistant", "content": reply}, "finish_reason": "stop"}
+                    ]})
+                    return
+                # SSE without Content-Length: the connection is closed at the end of the stream
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                self.close_connection = True
+                for i, word in enumerate(reply.split(" ")):
+                    if i:
+                        time.sleep(stub.token_latency)
+                    event = {"object": "chat.completion.chunk",
+                             "choices": [{"index": 0, "delta": {"content": word + " "}}]}
+                    self.wfile.write(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+                    self.wfile.flush()
+                self.wfile.write(b"data: [DONE]\n\n")
+
+        return Handler
+
+
+# ------------------------------------------------------------------------------
+# === SYNTHETIC CORPUS ===
+# ------------------------------------------------------------------------------
+SYNTHETIC_VOCABULARY = """
+mitigation emissions pathway scenario warming carbon dioxide methane energy demand supply
+industry steel cement hydrogen electrification efficiency renewable solar wind biomass BECCS
+DACCS AFOLU land forestry agriculture transport buildings urban policy finance investment
+cost abatement capture storage SSP1-1.9 SSP2-4.5 net-zero budget temperature sector
+""".split()
+
+
+def synthetic_text(rng: np.random.Generator, n_words: int) -> str:
+    return " ".join(rng.choice(SYNTHETIC_VOCABULARY, n_words))
+
+
+def build_synthetic_corpus(output_dir: str, n_vectors: int, dim: int = 1024, index_factory: str = "Flat",
+                           words_per_chunk: int = 150, chunks_per_page: int = 5, pages_per_report: int = 2000,
+                           batch_size: int = 100000, train_size: int = 100000, seed: int = 0) -> dict:
+    """
+    Writes `<output_dir>/index.faiss` (inner product, unit vectors added in batches)
+    and `<output_dir>/chunk_store`. Returns the paths and the build seconds.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    index_path = os.path.join(output_dir, "index.faiss")
+    chunk_store_path = os.path.join(output_dir, "chunk_store")
+    rng = np.random.default_rng(seed)
+
+    def vector_batches():
+        for start in range(0, n_vectors, batch_size):
+            vectors = rng.standard_normal((min(batch_size, n_vectors - start), dim)).astype("float32")
+            faiss.normalize_L2(vectors)
+            yield vectors
+
+    t0 = time.perf_counter()
+    index = faiss.index_factory(dim, index_factory, faiss.METRIC_INNER_PRODUCT)
+    if not index.is_trained:
+        training = np.random.default_rng(seed + 1).standard_normal((min(train_size, n_vectors), dim))
+        training = training.astype("float32")
+        faiss.normalize_L2(training)
+        index.train(training)
+    for vectors in vector_batches():
+        index.add(vectors)
+    faiss.write_index(index, index_path)
+    index_seconds = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    text_rng = np.random.default_rng(seed + 2)
+    records = (
+        (
+            f"synthetic_{position}",
+            synthetic_text(text_rng, words_per_chunk),
+            {
+                "source": f"page_{position // chunks_per_page % pages_per_report + 1}",
+                "chunk_index": position,
+                "report_name": f"SYNTHETIC_REPORT_{position // (chunks_per_page * pages_per_report) + 1}",
+            },
+        )
+        for position in range(n_vectors)
+    )
+    write_chunk_store(chunk_store_path, records)
+    chunk_store_seconds = time.perf_counter() - t0
+
+    return {
+        "index_path": index_path,
+        "chunk_store_path": chunk_store_path,
+        "index_build_seconds": index_seconds,
+        "chunk_store_build_seconds": chunk_store_seconds,
+    }
@@ -1,77 +1,262 @@
-import pickle
+import time
+_IMPORT_T0 = time.time()
+import threading
 import faiss
 import numpy as np
-from databricks_langchain import DatabricksEmbeddings, ChatDatabricks
 from langchain.schema import SystemMessage, HumanMessage
-import urllib.request
 import os
 from sklearn.preprocessing import normalize
-import time
+from embedding_cache import EmbeddingCache
+from answer_cache import SemanticAnswerCache, history_key
+from rerankers import LazyReranker
+from build_ann_index import ann_type, load_search_params, apply_search_params
+from chunk_store import ChunkStore, convert_pickle
+from bm25 import BM25Index, build_bm25_index, reciprocal_rank_fusion
+from artifacts import fetch_artifacts
+from locks import file_lock
+from shards import ShardedIndex, available_reports, is_sharded, restrict_to_reports, shards_path
+import serving_client
+import tracing
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 
 
 # ------------------------------------------------------------------------------
-# === EARLY IMPORTS & PATCH FOR TORCH.CLASSES ===
+# === LAZY RERANKER (TORCH + HF MODEL LOADED ON FIRST USE OR BY WARM-UP) ===
 # ------------------------------------------------------------------------------
+# Hub id or a local model directory. A local directory (or RAG_RERANKER_LOCAL_ONLY=1)
+# is loaded with `local_files_only=True`, i.e. without any network access.
+RERANKER_MODEL = os.environ.get("RAG_RERANKER_MODEL", "BAAI/bge-reranker-base")
 
-# Import torch and the Hugging Face reranker at the top so we can patch the problematic attribute.
-# This ensures Streamlit’s watcher never sees an un‐patched torch.classes.__path__.
-try:
-    import torch
-    # Attempt to access torch.classes.__path__. This often raises the “__path__._path” error.
-    # We catch it and then forcibly override __path__ to an empty list.
-    try:
-        _ = torch.classes.__path__
-    except Exception:
-        pass
-    # Overwrite __path__ to avoid Streamlit‐watcher errors
-    torch.classes.__path__ = []
-except ImportError:
-    # In case torch isn't installed, we still want the rest of the file to load.
-    torch = None
-
-# Now import transformers (safe because torch.classes was patched above)
-try:
-    from transformers import AutoTokenizer, AutoModelForSequenceClassification
-    # Instantiate the reranker model & tokenizer at module load time.
-    rerank_tokenizer = AutoTokenizer.from_pretrained("BAAI/bge-reranker-base")
-    rerank_model     = AutoModelForSequenceClassification.from_pretrained("BAAI/bge-reranker-base")
-except Exception:
-    # If anything goes wrong (e.g. torch not installed), set them to None.
-    rerank_tokenizer = None
-    rerank_model     = None
+# Backend: "torch" (fp32), "torch-int8" (dynamic quantization) or "onnx" (ONNX Runtime)
+RERANKER_BACKEND = os.environ.get("RAG_RERANKER_BACKEND", "torch")
+
+reranker = LazyReranker(
+    RERANKER_BACKEND,
+    model_name=RERANKER_MODEL,
+    local_only=os.path.isdir(RERANKER_MODEL) or os.environ.get("RAG_RERANKER_LOCAL_ONLY") == "1",
+    max_length=int(os.environ.get("RAG_RERANKER_MAX_LENGTH", "512")),
+    batch_size=int(os.environ.get("RAG_RERANKER_BATCH_SIZE", "16")),
+    num_threads=int(os.environ["RAG_RERANKER_THREADS"]) if os.environ.get("RAG_RERANKER_THREADS") else None,
+    # Concurrent requests share forward passes: pairs are pooled for at most this many
+    # milliseconds (RAG_RERANKER_SCHEDULER_WAIT_MS=off scores each request on its own)
+    scheduler_wait=(None if os.environ.get("RAG_RERANKER_SCHEDULER_WAIT_MS", "5") == "off"
+                    else float(os.environ.get("RAG_RERANKER_SCHEDULER_WAIT_MS", "5")) / 1000),
+)
+
+
+def warm_up_reranker():
+    return reranker.warm_up()
 
 
 # ------------------------------------------------------------------------------
 # === CONFIGURATION & FAISS LOADING ===
 # ------------------------------------------------------------------------------
-FAISS_URL = "https://drive.google.com/uc?export=download&id=1xWcHgAKqUdHug5Eqec0MEE2MfyTVBoId"
-META_URL  = "https://drive.google.com/uc?export=download&id=1DcG89F5hRGRs0Oe6YO4kB83Lq4rOsF3D"
+# Index and metadata come from the versioned artifact cache (see artifacts.py and
+# artifacts.json); nothing is downloaded at import, only on the first
+# get_faiss_resources() call. The chunk store and BM25 index derived from them are
+# kept in the same version directory.
+def artifact_paths():
+    """(index_path, metadata_path, chunk_store_path) of the manifest version, fetched if missing."""
+    paths = fetch_artifacts()
+    return paths["index"], paths["metadata"], os.path.join(os.path.dirname(paths["index"]), "chunk_store")
+
 
-FAISS_INDEX_PATH = "/tmp/ipcc_faiss.index"
-METADATA_PATH    = "/tmp/ipcc_faiss_metadata.pkl"
+def _read_index(path: str):
+    """
+    Opens the index memory-mapped and read-only when the index type supports it,
+    so every process on the node shares the same pages through the OS page cache.
+    """
+    for flag_name in ("IO_FLAG_MMAP_IFC", "IO_FLAG_MMAP"):
+        flag = getattr(faiss, flag_name, None)
+        if flag is None:
+            continue
+        try:
+            return faiss.read_index(path, flag | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError:
+            continue
+    return faiss.read_index(path)
 
-# Download once if not already present
-if not os.path.exists(FAISS_INDEX_PATH):
-    urllib.request.urlretrieve(FAISS_URL, FAISS_INDEX_PATH)
-    print("✅ FAISS index downloaded.")
 
-if not os.path.exists(METADATA_PATH):
-    urllib.request.urlretrieve(META_URL, METADATA_PATH)
-    print("✅ Metadata downloaded.")
+def _open_index(path: str):
+    index = _read_index(path)
+    # ANN indexes built by build_ann_index.py carry their nprobe / efSearch next to them
+    search_params = load_search_params(path)
+    if not search_params and ann_type(index):
+        print(f"⚠️ {ann_type(index).upper()} index {path} has no {os.path.basename(path)}.params.json; "
+              f"searching with the FAISS defaults (nprobe=1 / efSearch=16).")
+    apply_search_params(index, search_params)
+    return index
+
 
 # Load FAISS index and metadata
-def load_faiss_resources():
-    index = faiss.read_index(FAISS_INDEX_PATH)
-    with open(METADATA_PATH, "rb") as f:
-        meta = pickle.load(f)
-    return index, meta["chunk_ids"], meta["chunk_id_to_info"]
+def load_faiss_resources(
+    index_path: str = None,
+    metadata_path: str = None,
+    chunk_store_path: str = None,
+    with_lexical: bool = True
+):
+    """
+    Loads the given files; without `index_path`, the artifact version of the manifest.
+    Per-report shards (`<index>.shards`, see shards.py), or an `index_path` that is a
+    shard directory, are used instead of the single index and loaded on first search.
+    """
+    if index_path is None:
+        index_path, metadata_path, chunk_store_path = artifact_paths()
+    shard_dir = index_path if is_sharded(index_path) else shards_path(index_path)
+    if is_sharded(shard_dir):
+        index = ShardedIndex(shard_dir, read_index=_read_index)   # search params come from shards.json
+    else:
+        index = _open_index(index_path)
+    # The pickled metadata is converted once into a memory-mapped chunk store;
+    # after that the pickle is never loaded again
+    # (under a file lock: every API worker loads the resources when it starts)
+    if not os.path.exists(chunk_store_path):
+        with file_lock(chunk_store_path + ".lock"):
+            if not os.path.exists(chunk_store_path):
+                count = convert_pickle(metadata_path, chunk_store_path)
+                print(f"✅ Metadata converted to a chunk store ({count} chunks).")
+    chunk_store = ChunkStore(chunk_store_path)
+    if len(chunk_store) != index.ntotal:
+        print(f"⚠️ Chunk store has {len(chunk_store)} chunks but the index has {index.ntotal} vectors.")
+    if not with_lexical:
+        return index, chunk_store, None
+    # BM25 lexical index over the same texts, saved next to the FAISS index
+    bm25_path = index_path + ".bm25"
+    if not os.path.exists(bm25_path):
+        with file_lock(bm25_path + ".lock"):
+            if not os.path.exists(bm25_path):
+                count = build_bm25_index((chunk_store.text(i) for i in range(len(chunk_store))), bm25_path)
+                print(f"✅ BM25 index built ({count} chunks).")
+    return index, chunk_store, BM25Index(bm25_path)
+
+
+# Process-wide copy shared by every session (instead of one copy per st.session_state)
+_faiss_resources = None
+_faiss_resources_version = 0
+_faiss_resources_lock = threading.Lock()
+
+
+def get_faiss_resources():
+    """Returns (index, chunk_store, lexical_index), loading them once per process."""
+    global _faiss_resources, _faiss_resources_version
+    if _faiss_resources is None:
+        with _faiss_resources_lock:
+            if _faiss_resources is None:
+                _faiss_resources = load_faiss_resources()
+                _faiss_resources_version += 1
+    return _faiss_resources
+
+
+def reload_faiss_resources(
+    index_path: str = None,
+    metadata_path: str = None,
+    chunk_store_path: str = None
+):
+    """
+    Swaps in a new index version without restarting (by default the version
+    currently in the manifest, fetched if needed). The new files are loaded before
+    the swap, so in-flight requests finish on the old objects, which are freed once
+    no session references them any more.
+    """
+    global _faiss_resources, _faiss_resources_version
+    resources = load_faiss_resources(index_path, metadata_path, chunk_store_path)
+    with _faiss_resources_lock:
+        _faiss_resources = resources
+        _faiss_resources_version += 1
+    # Cached answers point at chunks of the previous version
+    answer_cache.clear()
+    print(f"✅ FAISS resources reloaded (version {_faiss_resources_version}).")
+    return resources
+
+
+def faiss_resources_version() -> int:
+    return _faiss_resources_version
 
 
 # ------------------------------------------------------------------------------
 # === EMBEDDING & CHAT MODEL INITIALIZATION ===
 # ------------------------------------------------------------------------------
-embedder   = DatabricksEmbeddings(endpoint="databricks-gte-large-en", batch_size=1)
-chat_model = ChatDatabricks(endpoint="databricks-claude-3-7-sonnet", max_tokens=2048, temperature=0.1)
+EMBEDDING_ENDPOINT = "databricks-gte-large-en"
+CHAT_ENDPOINT = "databricks-claude-3-7-sonnet"
+
+# Created on first use (or injected with `set_models`, e.g. the offline stubs of
+# offline_stubs.py), so importing this module needs no Databricks credentials
+embedder = None
+chat_model = None
+_models_lock = threading.Lock()
+
+# "pooled": serving_client.py (keep-alive pool, per-stage deadlines, retries, hedging);
+# "langchain": databricks_langchain clients; "auto": pooled when DATABRICKS_HOST and
+# DATABRICKS_TOKEN are set (other Databricks auth methods need the langchain clients)
+SERVING_CLIENT = os.environ.get("RAG_SERVING_CLIENT", "auto")
+_serving_client = None
+
+
+def _use_pooled_client() -> bool:
+    if SERVING_CLIENT == "auto":
+        return bool(os.environ.get("DATABRICKS_HOST") and os.environ.get("DATABRICKS_TOKEN"))
+    return SERVING_CLIENT == "pooled"
+
+
+def _get_serving_client():
+    global _serving_client
+    if _serving_client is None:
+        _serving_client = serving_client.ServingClient(host=os.environ.get("RAG_SERVING_HOST"))
+    return _serving_client
+
+
+def get_embedder():
+    global embedder
+    if embedder is None:
+        with _models_lock:
+            if embedder is None:
+                # batch_size > 1 so that embed_documents() sends all enriched queries in one request
+                if _use_pooled_client():
+                    embedder = serving_client.ServingEmbeddings(_get_serving_client(), EMBEDDING_ENDPOINT, batch_size=16)
+                else:
+                    from databricks_langchain import DatabricksEmbeddings
+                    embedder = DatabricksEmbeddings(endpoint=EMBEDDING_ENDPOINT, batch_size=16)
+    return embedder
+
+
+def get_chat_model():
+    global chat_model
+    if chat_model is None:
+        with _models_lock:
+            if chat_model is None:
+                if _use_pooled_client():
+                    chat_model = serving_client.ServingChatModel(_get_serving_client(), CHAT_ENDPOINT,
+                                                                 max_tokens=2048, temperature=0.1)
+                else:
+                    from databricks_langchain import ChatDatabricks
+                    chat_model = ChatDatabricks(endpoint=CHAT_ENDPOINT, max_tokens=2048, temperature=0.1)
+    return chat_model
+
+
+def set_models(embeddings=None, chat=None):
+    """Replaces the embedding and/or chat model (anything with the same methods)."""
+    global embedder, chat_model
+    with _models_lock:
+        if embeddings is not None:
+            embedder = embeddings
+        if chat is not None:
+            chat_model = chat
+
+# Process-wide query-embedding cache (in-memory LRU + memory-mapped disk tier),
+# shared by every Streamlit session and kept across restarts
+embedding_cache = EmbeddingCache(
+    cache_dir=os.environ.get("RAG_EMBEDDING_CACHE_DIR", "/tmp/ipcc_embedding_cache"),
+    model_name=EMBEDDING_ENDPOINT,
+    memory_size=int(os.environ.get("RAG_EMBEDDING_CACHE_MEMORY_SIZE", "2048")),
+    disk_size=int(os.environ.get("RAG_EMBEDDING_CACHE_DISK_SIZE", "20000")),
+)
+
+# Semantic answer cache: near-duplicate questions (same chat-history state) skip the pipeline
+answer_cache = SemanticAnswerCache(
+    threshold=float(os.environ.get("RAG_ANSWER_CACHE_THRESHOLD", "0.95")),
+    ttl=float(os.environ.get("RAG_ANSWER_CACHE_TTL", str(6 * 3600))),
+    max_entries=int(os.environ.get("RAG_ANSWER_CACHE_MAX_ENTRIES", "1000")),
+)
 
 
 # ------------------------------------------------------------------------------
@@ -86,8 +271,10 @@ def contextualize_query_with_background(query: str) -> str:
     - Relevant technical terms used in IPCC reports
     Return 2-3 sentences.
     """
-    response = chat_model.invoke([SystemMessage(content=prompt),
-                                  HumanMessage(content=query)])
+    with tracing.span("llm.contextualize", endpoint=CHAT_ENDPOINT) as trace_span, serving_client.stage("expansion"):
+        response = get_chat_model().invoke([SystemMessage(content=prompt),
+                                            HumanMessage(content=query)])
+        trace_span.set_attribute("response_chars", len(response.content))
     return response.content.strip()
 
 def generate_paraphrases(query: str) -> list:
@@ -96,132 +283,639 @@ def generate_paraphrases(query: str) -> list:
     using terminology common in IPCC WGIII reports.
     Return one paraphrase per line.
     """
-    response = chat_model.invoke([SystemMessage(content=prompt),
-                                  HumanMessage(content=query)])
-    return [line.strip() for line in response.content.strip().split("\n") if line.strip()]
+    with tracing.span("llm.paraphrase", endpoint=CHAT_ENDPOINT) as trace_span, serving_client.stage("expansion"):
+        response = get_chat_model().invoke([SystemMessage(content=prompt),
+                                            HumanMessage(content=query)])
+        paraphrases = [line.strip() for line in response.content.strip().split("\n") if line.strip()]
+        trace_span.set_attribute("paraphrases", len(paraphrases))
+    return paraphrases
+
+
+# ------------------------------------------------------------------------------
+# === CONCURRENT QUERY EXPANSION ===
+# ------------------------------------------------------------------------------
+# Per-call timeout (seconds) for the contextualization / paraphrase LLM calls.
+EXPANSION_TIMEOUT = float(os.environ.get("RAG_EXPANSION_TIMEOUT", "20"))
+
+# Shared pool for the expansion stage. Calls that time out keep running in the
+# background until the endpoint answers, so keep some headroom over 3 per request.
+_expansion_pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix="rag-expansion")
+
+
+def _timed(fn, *args, **kwargs):
+    t0 = time.time()
+    result = fn(*args, **kwargs)
+    return result, time.time() - t0
+
+
+def expand_query_concurrently(
+    query: str,
+    index,
+    k: int = 5,
+    timeout: float = EXPANSION_TIMEOUT,
+    retrieve_raw: bool = True,
+    metrics: dict = None
+):
+    """
+    Sends the contextualization and paraphrase calls at the same time and, while
+    they are in flight, runs the FAISS search for the raw user query (its
+    `(distances, indices)` are returned so they can be merged with the enriched queries' hits).
+    A call that does not answer within `timeout` seconds is dropped: the pipeline
+    continues without background context / paraphrases instead of blocking.
+    With `retrieve_raw=False` (raw query already searched) the returned hits are None.
+    Stage timings are added to `metrics` (a new dict if not given), which is returned.
+    """
+    timings = metrics if metrics is not None else {}
+    t0 = time.time()
+    with tracing.span("query_expansion", timeout=timeout) as trace_span:
+        # run_in_context: the LLM-call spans nest under the caller's span in the pool threads
+        context_future = _expansion_pool.submit(tracing.run_in_context(_timed), contextualize_query_with_background, query)
+        paraphrase_future = _expansion_pool.submit(tracing.run_in_context(_timed), generate_paraphrases, query)
+
+        # Raw-query retrieval runs on this thread while the LLM calls are pending
+        raw_hits = None
+        if retrieve_raw:
+            raw_hits, timings["raw_query_retrieval"] = _timed(
+                faiss_search_batch, [query], index, k, metrics=timings
+            )
+
+        deadline = t0 + timeout
+        results = {}
+        for name, future, fallback in [
+            ("contextualization", context_future, ""),
+            ("paraphrase_generation", paraphrase_future, []),
+        ]:
+            try:
+                results[name], timings[name] = future.result(timeout=max(0.0, deadline - time.time()))
+            except FutureTimeoutError:
+                print(f"⚠️ {name} timed out after {timeout:.1f}s, continuing without it.")
+                results[name], timings[name] = fallback, time.time() - t0
+                timings.setdefault("expansion_timeouts", []).append(name)
+            except Exception as e:
+                print(f"⚠️ {name} failed ({e}), continuing without it.")
+                results[name], timings[name] = fallback, time.time() - t0
+
+        trace_span.set_attributes(paraphrases=len(results["paraphrase_generation"]),
+                                  timeouts=timings.get("expansion_timeouts", []))
+    timings["query_expansion"] = time.time() - t0
+    return results["contextualization"], results["paraphrase_generation"], raw_hits, timings
 
 
 # ------------------------------------------------------------------------------
 # === FAISS RETRIEVAL ===
 # ------------------------------------------------------------------------------
+def embed_queries(queries: list, metrics: dict = None) -> np.ndarray:
+    """
+    Embeds all queries in a single `embed_documents` request and returns an
+    L2-normalized (n_queries x dim) float32 matrix. Queries already in
+    `embedding_cache` are not sent; hit/miss counts are added to `metrics`.
+    """
+    with tracing.span("embedding", endpoint=EMBEDDING_ENDPOINT, queries=len(queries)) as trace_span, \
+            serving_client.stage("embedding"):
+        vectors, hits, misses = embedding_cache.embed(list(queries), get_embedder().embed_documents)
+        trace_span.set_attributes(cache_hits=hits, cache_misses=misses)
+    if metrics is not None:
+        metrics["embedding_cache_hits"] = metrics.get("embedding_cache_hits", 0) + hits
+        metrics["embedding_cache_misses"] = metrics.get("embedding_cache_misses", 0) + misses
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def faiss_search_batch(queries: list, index, k: int = 5, metrics: dict = None):
+    """
+    One embedding round trip + one `index.search` over the whole query matrix.
+    Returns the raw (n_queries x k) `distances` and `indices` arrays; the embedding and
+    search seconds are added to `metrics["embedding"]` / `metrics["faiss_search"]`.
+    """
+    t0 = time.time()
+    query_vectors = embed_queries(queries, metrics=metrics)
+    t1 = time.time()
+    with tracing.span("faiss.search", queries=len(queries), k=k, ntotal=index.ntotal):
+        distances, indices = index.search(query_vectors, k)
+    if metrics is not None:
+        metrics["embedding"] = metrics.get("embedding", 0.0) + t1 - t0
+        metrics["faiss_search"] = metrics.get("faiss_search", 0.0) + time.time() - t1
+    return distances, indices
+
+
+def expand_neighbor_windows(indices: np.ndarray, n_chunks: int, window: int = 1) -> np.ndarray:
+    """
+    Turns FAISS anchor positions (any shape) into a (n_groups x 2*window+1) matrix
+    of neighbor positions, -1 where the window falls outside the corpus.
+    Anchors hit by several queries are kept once, in first-hit order, which is the
+    same as de-duplicating the resulting groups.
+    """
+    anchors = np.asarray(indices, dtype="int64").reshape(-1)
+    anchors = anchors[(anchors >= 0) & (anchors < n_chunks)]
+    _, first_hit = np.unique(anchors, return_index=True)
+    anchors = anchors[np.sort(first_hit)]
+
+    positions = anchors[:, None] + np.arange(-window, window + 1)[None, :]
+    positions[(positions < 0) | (positions >= n_chunks)] = -1
+    return positions
+
+
+# ------------------------------------------------------------------------------
+# === SPAN BUILDER (MERGES OVERLAPPING NEIGHBOR WINDOWS) ===
+# ------------------------------------------------------------------------------
+# Neighbor windows stop at a change of report; windows anchored on different pages
+# are never merged into one span (their neighbors across the page change are kept)
+WINDOW_BOUNDARY_KEY = "report_name"
+MERGE_BOUNDARY_KEY = "source"
+
+
+def build_spans(distances: np.ndarray, indices: np.ndarray, chunk_store, window: int = 1,
+                query_labels: list = None, fused_scores: np.ndarray = None) -> list:
+    """
+    Turns the (n_queries x k) FAISS hits into unique, non-overlapping spans of chunks.
+    Each anchor's ±window is clipped at report boundaries, the windows are sorted by
+    anchor and overlapping ones are merged unless their anchors are on different pages;
+    those are cut at the page change instead, so no neighbor is dropped. Every span
+    keeps its best FAISS score (NaN distances, e.g. lexical hits, are ignored) and the
+    labels of the queries that hit it. With `fused_scores` (aligned with `indices`)
+    spans also keep their best fused score and are ordered by it; otherwise they come
+    best FAISS score first.
+    """
+    n_chunks = len(chunk_store)
+    n_queries, k = indices.shape
+    anchors = indices.reshape(-1).astype("int64")
+    scores = distances.reshape(-1)
+    fused = fused_scores.reshape(-1) if fused_scores is not None else scores
+    query_ids = np.repeat(np.arange(n_queries), k)
+    valid = (anchors >= 0) & (anchors < n_chunks)
+    anchors, scores, fused, query_ids = anchors[valid], scores[valid], fused[valid], query_ids[valid]
+    if len(anchors) == 0:
+        return []
+
+    # Neighbor positions that stay inside the corpus and in the anchor's report
+    positions = anchors[:, None] + np.arange(-window, window + 1)[None, :]
+    inside = (positions >= 0) & (positions < n_chunks)
+    clipped = np.clip(positions, 0, n_chunks - 1)
+    report_codes = chunk_store.column_codes(WINDOW_BOUNDARY_KEY)
+    if report_codes is not None:
+        inside &= report_codes[clipped] == report_codes[anchors][:, None]
+    # Length of the unbroken run of neighbors on each side of the anchor
+    left = np.cumprod(inside[:, :window][:, ::-1], axis=1).sum(axis=1)
+    right = np.cumprod(inside[:, window + 1:], axis=1).sum(axis=1)
+    starts, ends = anchors - left, anchors + right
+
+    # Interval merge on windows sorted by anchor (starts and ends are then sorted too
+    # inside a report): a new span begins where a window starts after the furthest
+    # end seen so far, or where the anchor's page changes
+    order = np.lexsort((ends, anchors))
+    starts, ends, anchors, scores, fused, query_ids = (
+        a[order] for a in (starts, ends, anchors, scores, fused, query_ids)
+    )
+    furthest_end = np.maximum.accumulate(ends)
+    new_span = np.ones(len(starts), dtype=bool)
+    new_span[1:] = starts[1:] > furthest_end[:-1]
+    page_codes = chunk_store.column_codes(MERGE_BOUNDARY_KEY)
+    page_cuts = np.zeros(len(starts), dtype=bool)
+    if page_codes is not None:
+        page_cuts[1:] = ~new_span[1:] & (page_codes[anchors[1:]] != page_codes[anchors[:-1]])
+        new_span |= page_cuts
+    span_ids = np.cumsum(new_span) - 1
+    first = np.flatnonzero(new_span)
+
+    span_starts = starts[first]
+    span_ends = np.maximum.reduceat(ends, first)
+    # Overlapping windows of two pages are split where the later anchor's page run
+    # begins (kept inside the overlap, so every position stays in exactly one span)
+    for span_id in np.flatnonzero(page_cuts[first]):
+        previous_anchor, anchor = anchors[first[span_id] - 1], anchors[first[span_id]]
+        cut = int(anchor)
+        while cut - 1 > previous_anchor and page_codes[cut - 1] == page_codes[anchor]:
+            cut -= 1
+        cut = min(max(cut, span_starts[span_id]), span_ends[span_id - 1] + 1)
+        span_ends[span_id - 1] = cut - 1
+        span_starts[span_id] = cut
+    span_scores = np.fmax.reduceat(scores, first)
+    span_fused = np.fmax.reduceat(fused, first)
+    labels = query_labels or [f"query_{i}" for i in range(n_queries)]
+    spans = []
+    for span_id in np.argsort(-np.nan_to_num(span_fused, nan=-np.inf), kind="stable"):
+        members = span_ids == span_id
+        span = {
+            "start": int(span_starts[span_id]),
+            "end": int(span_ends[span_id]),
+            "score": None if np.isnan(span_scores[span_id]) else float(span_scores[span_id]),
+            "anchors": sorted(set(anchors[members].tolist())),
+            "queries": [labels[q] for q in sorted(set(query_ids[members].tolist()))],
+        }
+        if fused_scores is not None:
+            span["fused_score"] = float(span_fused[span_id])
+        spans.append(span)
+    return spans
+
+
+def spans_to_groups(spans: list, chunk_store) -> list:
+    # Only the retrieved chunks are decoded from the chunk store
+    groups = []
+    for span in spans:
+        positions = range(span["start"], span["end"] + 1)
+        group = chunk_store.get_many(positions)
+        for position, chunk in zip(positions, group):
+            if span["score"] is not None:
+                chunk["faiss_score"] = round(span["score"], 4)
+            if "fused_score" in span:
+                chunk["fused_score"] = round(span["fused_score"], 6)
+            chunk["matched_queries"] = span["queries"]
+            chunk["is_anchor"] = position in span["anchors"]
+            chunk["position"] = position
+        groups.append(group)
+    return groups
+
+
+def count_tokens(text: str) -> int:
+    """Local token count: the reranker's tokenizer once it is loaded, else ~4 characters per token."""
+    if reranker.ready:
+        return len(reranker.backend.tokenizer.encode(text, add_special_tokens=False))
+    return max(1, len(text) // 4)
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    if count_tokens(text) <= max_tokens:
+        return text
+    if max_tokens <= 0:
+        return ""
+    if reranker.ready:
+        tokenizer = reranker.backend.tokenizer
+        ids = tokenizer.encode(text, add_special_tokens=False)[:max_tokens]
+        return tokenizer.decode(ids) + " …"
+    return text[:4 * max_tokens] + " …"
+
+
+def span_token_savings(indices: np.ndarray, spans: list, chunk_store, window: int = 1) -> int:
+    """
+    Estimated tokens the merged spans save over the per-anchor ±window groups they
+    replace (~4 bytes per token, from the text offsets: no text is decoded).
+    """
+    window_positions = expand_neighbor_windows(indices, len(chunk_store), window)
+    window_positions = window_positions[window_positions >= 0]
+    span_positions = np.concatenate(
+        [np.arange(span["start"], span["end"] + 1) for span in spans]
+    ) if spans else np.zeros(0, dtype="int64")
+    saved_bytes = chunk_store.text_lengths(window_positions).sum() - chunk_store.text_lengths(span_positions).sum()
+    return int(saved_bytes) // 4
+
+
+def faiss_similarity_search_groups_batch(
+    queries: list,
+    index,
+    chunk_store,
+    k: int = 5,
+    window: int = 1
+):
+    """
+    Batched retrieval: all queries share one embedding request and one FAISS search,
+    and the hits of all queries are merged into non-overlapping spans at once.
+    """
+    distances, indices = faiss_search_batch(queries, index, k)
+    spans = build_spans(distances, indices, chunk_store, window=window, query_labels=queries)
+    return spans_to_groups(spans, chunk_store)
+
+
 def faiss_similarity_search_groups(
     query: str,
     index,
-    chunk_ids,
-    chunk_id_to_info,
+    chunk_store,
     k: int = 5,
     window: int = 1
 ):
-    query_vector = embedder.embed_query(query)
-    query_vector = np.array([query_vector], dtype="float32")
-    faiss.normalize_L2(query_vector)
-    distances, indices = index.search(query_vector, k)
-
-    chunk_groups = []
-    for anchor_idx, dist in zip(indices[0], distances[0]):
-        if anchor_idx < 0 or anchor_idx >= len(chunk_ids):
-            continue
-        group = []
-        for offset in range(-window, window + 1):
-            neighbor_idx = anchor_idx + offset
-            if 0 <= neighbor_idx < len(chunk_ids):
-                chunk_id = chunk_ids[neighbor_idx]
-                info = chunk_id_to_info[chunk_id]
-                group.append({
-                    "chunk_id": chunk_id,
-                    "text": info["text"],
-                    "metadata": info.get("metadata", {})
-                })
-        if group:
-            chunk_groups.append(group)
-    return chunk_groups
+    return faiss_similarity_search_groups_batch(
+        [query], index, chunk_store, k=k, window=window
+    )
 
 
 # ------------------------------------------------------------------------------
-# === RERANK FUNCTION (uses top‐level rerank_model & rerank_tokenizer) ===
+# === RERANK FUNCTION (uses the lazily loaded `reranker`) ===
 # ------------------------------------------------------------------------------
-def rerank_chunk_groups(query, chunk_groups, top_n=5):
+def group_passages(chunk_groups, chunk_store=None) -> list:
     """
-    Uses the pre-loaded `rerank_model` and `rerank_tokenizer` from module load.
-    Because we patched `torch.classes.__path__` above, Streamlit’s watcher will not trip.
+    Reranker passage of each group: the concatenated pre-computed token ids of its
+    chunks when the chunk store holds them for the reranker's tokenizer (only the
+    query is tokenized then), else the joined chunk texts.
     """
-    if rerank_model is None or rerank_tokenizer is None:
-        # If something went wrong loading HF, skip reranking
-        return chunk_groups
+    backend = reranker.backend
+    if chunk_store is None or chunk_store.tokenizer_name != backend.model_name:
+        return [" ".join(chunk["text"] for chunk in group) for group in chunk_groups]
+    passages = []
+    for group in chunk_groups:
+        if all("position" in chunk for chunk in group):
+            ids = np.concatenate([chunk_store.token_ids(chunk["position"]) for chunk in group])
+            passages.append(ids[:backend.max_length])
+        else:
+            passages.append(" ".join(chunk["text"] for chunk in group))
+    return passages
 
-    # Build inputs for reranking
-    inputs = [
-        f"{query} [SEP] " + " ".join(chunk["text"] for chunk in group)
-        for group in chunk_groups
-    ]
-    tokens = rerank_tokenizer(inputs, padding=True, truncation=True, return_tensors="pt")
 
-    # Compute scores
-    with torch.no_grad():
-        scores = rerank_model(**tokens).logits.squeeze(-1)
+def rerank_chunk_groups(query, chunk_groups, top_n=5, metrics: dict = None, chunk_store=None):
+    """
+    Scores every group with the cross-encoder and keeps the `top_n` best.
+    If the model is still loading in the warm-up thread, or failed to load, the
+    groups are kept in FAISS hit order instead (`reranker_fallback` in `metrics`).
+    If nobody started a warm-up, the model is loaded here, on first use.
+    With `chunk_store`, pre-tokenized passages are used when available.
+    """
+    if not reranker.ready and not reranker.loading:
+        t_load = time.time()
+        with tracing.span("reranker.load", backend=reranker.backend_name):
+            reranker.load()
+        if metrics is not None and reranker.ready:
+            metrics["reranker_load"] = time.time() - t_load
+    if metrics is not None:
+        metrics["reranker_fallback"] = int(not reranker.ready)
+    if not reranker.ready:
+        # Fallback: first-stage (FAISS) order
+        return chunk_groups[:top_n]
+
+    # Score (query, group text) pairs with the configured backend
+    passages = group_passages(chunk_groups, chunk_store)
+    if metrics is not None:
+        metrics["rerank_pretokenized"] = int(any(isinstance(p, np.ndarray) for p in passages))
+    scores = reranker.score_pairs([(query, passage) for passage in passages])
 
     # Select top_n groups by score
-    top_indices = torch.topk(scores, k=min(top_n, len(chunk_groups))).indices.tolist()
+    top_indices = np.argsort(-scores, kind="stable")[:top_n].tolist()
     top_groups  = [chunk_groups[i] for i in top_indices]
 
     # Attach reranker_score to each chunk
     for i, idx in enumerate(top_indices):
         for chunk in top_groups[i]:
-            chunk["reranker_score"] = round(scores[idx].item(), 4)
+            chunk["reranker_score"] = round(float(scores[idx]), 4)
 
     return top_groups
 
 
 # ------------------------------------------------------------------------------
-# === GENERATE_ANSWER WITH TIMING & “RELEVANCE CHECK” ===
+# === PIPELINE STAGES SHARED BY generate_answer AND generate_answer_stream ===
 # ------------------------------------------------------------------------------
-def generate_answer(
-    query: str,
-    index,
-    chunk_ids,
-    chunk_id_to_info,
-    k: int = 5,
-    window: int = 1,
-    rerank_top_n: int = 6,
-    chat_history: list = []
-):
-    timings = {}
+def _lookup_answer_cache(query, chat_history, cache_params, timings):
+    """
+    Semantic answer cache: a near-duplicate question asked in the same
+    chat-history state returns the stored answer and chunks directly.
+    Returns (cached_or_None, query_vector, cache_key).
+    """
+    t_cache = time.time()
+    with tracing.span("answer_cache.lookup", entries=len(answer_cache)) as trace_span:
+        query_vector = embed_queries([query], metrics=timings)[0]
+        cache_key = history_key(chat_history, *cache_params)
+        cached = answer_cache.lookup(query_vector, cache_key)
+        trace_span.set_attribute("hit", cached is not None)
+    timings["answer_cache_lookup"] = time.time() - t_cache
+    timings["answer_cache_hit"] = int(cached is not None)
+    if cached is not None:
+        timings["answer_cache_similarity"] = cached["similarity"]
+    return cached, query_vector, cache_key
 
-    # 1) Contextualization
-    t0 = time.time()
-    context = contextualize_query_with_background(query)
-    timings["contextualization"] = time.time() - t0
 
-    # 2) Paraphrase generation
-    t1 = time.time()
-    paraphrases = generate_paraphrases(query)
-    timings["paraphrase_generation"] = time.time() - t1
+# ------------------------------------------------------------------------------
+# === PIPELINE MODES (FAST / ADAPTIVE / FULL) ===
+# ------------------------------------------------------------------------------
+# "full":     always run contextualization + paraphrasing (the original pipeline)
+# "fast":     never run them; retrieve with the raw query only
+# "adaptive": retrieve with the raw query first and escalate to the expansion
+#             stages only when that retrieval does not look confident
+PIPELINE_MODES = ("fast", "adaptive", "full")
+PIPELINE_MODE = os.environ.get("RAG_PIPELINE_MODE", "full")
+
+# Confidence signal for "adaptive": "faiss" (raw-query scores) or "reranker"
+ADAPTIVE_SIGNAL = os.environ.get("RAG_ADAPTIVE_SIGNAL", "faiss")
+# FAISS signal: best cosine score, and its margin over the mean of the other top-k hits
+ADAPTIVE_MIN_SCORE = float(os.environ.get("RAG_ADAPTIVE_MIN_SCORE", "0.80"))
+ADAPTIVE_MIN_MARGIN = float(os.environ.get("RAG_ADAPTIVE_MIN_MARGIN", "0.02"))
+# Reranker signal: best cross-encoder logit over the raw-query candidates
+ADAPTIVE_MIN_RERANK_SCORE = float(os.environ.get("RAG_ADAPTIVE_MIN_RERANK_SCORE", "1.0"))
+
+
+def faiss_confidence(distances: np.ndarray, indices: np.ndarray):
+    """
+    (top score, margin of the top score over the mean of the other hits) for one query.
+    Slots FAISS pads with index -1 (fewer hits than k, e.g. filtered or sharded
+    searches) are ignored: their distance (-3.4e38) is finite.
+    """
+    scores = distances[0][indices[0] >= 0]
+    if len(scores) == 0:
+        return 0.0, 0.0
+    margin = scores[0] - scores[1:].mean() if len(scores) > 1 else 0.0
+    return float(scores[0]), float(margin)
+
+
+def retrieve_top_groups(query, index, chunk_store, k, window, rerank_top_n, timings,
+                        lexical_index=None, mode: str = "full"):
+    if mode not in PIPELINE_MODES:
+        raise ValueError(f"Unknown pipeline mode {mode!r}, expected one of {PIPELINE_MODES}")
+    search_args = (query, index, chunk_store, k, window, rerank_top_n, timings, lexical_index)
 
+    if mode == "full":
+        # 1) + 2) Contextualization and paraphrase generation, sent concurrently
+        #         while the raw query is already being retrieved
+        context, paraphrases, raw_hits, _ = expand_query_concurrently(query, index, k=k, metrics=timings)
+        timings["pipeline_path"] = "full"
+        return search_and_rank(context, paraphrases, raw_hits, *search_args)
+
+    raw_hits, timings["raw_query_retrieval"] = _timed(faiss_search_batch, [query], index, k, metrics=timings)
+    if mode == "fast":
+        timings["pipeline_path"] = "fast"
+        return search_and_rank("", [], raw_hits, *search_args)
+
+    # Adaptive: judge the raw-query retrieval before paying for the LLM expansion calls
+    top_score, margin = faiss_confidence(*raw_hits)
+    timings["confidence_top_score"], timings["confidence_margin"] = top_score, margin
+    confident = top_score >= ADAPTIVE_MIN_SCORE and margin >= ADAPTIVE_MIN_MARGIN
+    if ADAPTIVE_SIGNAL == "reranker":
+        top_groups = search_and_rank("", [], raw_hits, *search_args)
+        if reranker.ready and top_groups:
+            timings["confidence_reranker_score"] = top_groups[0][0]["reranker_score"]
+            confident = top_groups[0][0]["reranker_score"] >= ADAPTIVE_MIN_RERANK_SCORE
+        if confident:
+            timings["pipeline_path"] = "adaptive:confident"
+            return top_groups
+    elif confident:
+        timings["pipeline_path"] = "adaptive:confident"
+        return search_and_rank("", [], raw_hits, *search_args)
+
+    timings["pipeline_path"] = "adaptive:escalated"
+    context, paraphrases, _, _ = expand_query_concurrently(query, index, k=k, retrieve_raw=False,
+                                                           metrics=timings)
+    return search_and_rank(context, paraphrases, raw_hits, *search_args)
+
+
+# ------------------------------------------------------------------------------
+# === FIRST-STAGE SCORE FUSION + CANDIDATE PRUNING (BEFORE THE CROSS-ENCODER) ===
+# ------------------------------------------------------------------------------
+# How the hit lists of all (enriched / paraphrased) queries are fused into one span
+# score: "rrf" (reciprocal rank) or "max" (best cosine similarity, dense lists only;
+# with BM25 lists RRF is always used since the two scores are not comparable)
+RERANK_FUSION = os.environ.get("RAG_RERANK_FUSION", "rrf")
+# At most this many spans go to the cross-encoder ("0" = no limit) ...
+RERANK_MAX_CANDIDATES = int(os.environ.get("RAG_RERANK_MAX_CANDIDATES", "16"))
+# ... and only those within this fraction of the best fused score ("0" = no cutoff)
+RERANK_SCORE_GAP = float(os.environ.get("RAG_RERANK_SCORE_GAP", "0"))
+
+
+def fuse_first_stage_scores(distances: np.ndarray, indices: np.ndarray, lexical: bool = False) -> np.ndarray:
+    """Fused score of every hit, aligned with `indices` (build_spans keeps the best per span)."""
+    if RERANK_FUSION == "max" and not lexical:
+        return distances
+    return reciprocal_rank_fusion(indices)
+
+
+def prune_candidates(spans: list, min_candidates: int, max_candidates: int = None, score_gap: float = None) -> list:
+    """
+    Keeps the best spans (build_spans orders them by fused score): at most
+    `max_candidates`, and only those whose score is within `score_gap` (a fraction)
+    of the best one, but never fewer than `min_candidates` (the reranker's top_n).
+    """
+    max_candidates = RERANK_MAX_CANDIDATES if max_candidates is None else max_candidates
+    score_gap = RERANK_SCORE_GAP if score_gap is None else score_gap
+    keep = len(spans)
+    if max_candidates > 0:
+        keep = min(keep, max(max_candidates, min_candidates))
+    if score_gap > 0 and spans:
+        best = spans[0]["fused_score"]
+        cutoff = best - score_gap * abs(best)
+        above = sum(1 for span in spans[:keep] if span["fused_score"] >= cutoff)
+        keep = min(keep, max(above, min_candidates))
+    return spans[:keep]
+
+
+def search_and_rank(context, paraphrases, raw_hits, query, index, chunk_store, k, window, rerank_top_n,
+                    timings, lexical_index=None):
     # Build enriched queries (original + paraphrases)
     queries = [query] + paraphrases
-    enriched_queries = [f"{q}\n\n{context}" for q in queries]
+    enriched_queries = [f"{q}\n\n{context}" for q in queries] if context else paraphrases
+    # Labels recorded on each span: which (paraphrased) queries hit it
+    paraphrase_labels = [f"paraphrase_{i + 1}" for i in range(len(paraphrases))]
+    query_labels = ["query"] + (
+        [f"{label}+context" for label in ["query"] + paraphrase_labels] if context else paraphrase_labels
+    )
 
     # 3) FAISS retrieval + reranking
     t2 = time.time()
-    all_groups = []
-    seen_ids = set()
-    for q in enriched_queries:
-        groups = faiss_similarity_search_groups(
-            q, index, chunk_ids, chunk_id_to_info, k=k, window=window
-        )
-        for group in groups:
-            ids = tuple(chunk["chunk_id"] for chunk in group)
-            if ids not in seen_ids:
-                seen_ids.add(ids)
-                all_groups.append(group)
+    hits = [raw_hits]
+    if enriched_queries:
+        # One embedding request + one matrix search for all enriched queries
+        hits.append(faiss_search_batch(enriched_queries, index, k, metrics=timings))
+    distances = np.vstack([d for d, _ in hits])
+    indices = np.vstack([i for _, i in hits])
 
-    top_groups = rerank_chunk_groups(query, all_groups, top_n=rerank_top_n)
-    timings["retrieval_and_rerank"] = time.time() - t2
+    # Local BM25 lists for the query and its paraphrases (no network call), fused
+    # with the dense lists by reciprocal rank
+    if lexical_index is not None:
+        t_lexical = time.time()
+        lexical_queries = [query] + paraphrases
+        lexical_distances = np.full((len(lexical_queries), k), np.nan, dtype="float32")
+        lexical_indices = np.full((len(lexical_queries), k), -1, dtype="int64")
+        with tracing.span("bm25.search", queries=len(lexical_queries), k=k):
+            for row, q in enumerate(lexical_queries):
+                _, positions = lexical_index.search(q, k)
+                lexical_indices[row, :len(positions)] = positions
+        distances = np.vstack([distances, lexical_distances])
+        indices = np.vstack([indices, lexical_indices])
+        query_labels += [f"bm25:{label}" for label in ["query"] + paraphrase_labels]
+        timings["lexical_retrieval"] = time.time() - t_lexical
+    fused_scores = fuse_first_stage_scores(distances, indices, lexical=lexical_index is not None)
 
-    # Flatten into a single list of “selected_chunks”
-    selected_chunks = [chunk for group in top_groups for chunk in group]
+    # Overlapping ±window groups are merged into unique spans before reranking
+    t_spans = time.time()
+    with tracing.span("spans.build", window=window, candidates=int((indices >= 0).sum())) as trace_span:
+        spans = build_spans(distances, indices, chunk_store, window=window, query_labels=query_labels,
+                            fused_scores=fused_scores)
+        # Only the best fused candidates reach the cross-encoder, however many queries
+        # and hits there are (and only those are decoded from the chunk store)
+        candidates = prune_candidates(spans, min_candidates=rerank_top_n)
+        all_groups = spans_to_groups(candidates, chunk_store)
+        trace_span.set_attribute("spans", len(spans))
+        trace_span.set_attribute("candidates", len(candidates))
+    timings["span_build"] = timings.get("span_build", 0.0) + time.time() - t_spans
+    timings["span_count"] = len(spans)
+    timings["rerank_candidates"] = len(candidates)
+    timings["span_tokens_saved"] = span_token_savings(indices, spans, chunk_store, window=window)
 
-    # Tag chunks with inline references (1), (2), …
+    t_rerank = time.time()
+    with tracing.span("rerank", candidates=len(all_groups), top_n=rerank_top_n) as trace_span:
+        top_groups = rerank_chunk_groups(query, all_groups, top_n=rerank_top_n, metrics=timings,
+                                         chunk_store=chunk_store)
+        trace_span.set_attribute("fallback", bool(timings.get("reranker_fallback")))
+    timings["rerank"] = timings.get("rerank", 0.0) + time.time() - t_rerank
+    timings["retrieval_and_rerank"] = timings.get("retrieval_and_rerank", 0.0) + time.time() - t2
+    return top_groups
+
+
+# ------------------------------------------------------------------------------
+# === TOKEN-BUDGETED CONTEXT PACKING ===
+# ------------------------------------------------------------------------------
+# Token budgets (counted with the local reranker tokenizer) for the retrieved
+# context and for the previous-turn snippet of the generation prompt
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("RAG_CONTEXT_TOKEN_BUDGET", "3500"))
+HISTORY_TOKEN_BUDGET = int(os.environ.get("RAG_HISTORY_TOKEN_BUDGET", "400"))
+
+
+def _group_score(group: list) -> float:
+    chunk = group[0]
+    return chunk.get("reranker_score", chunk.get("fused_score", chunk.get("faiss_score", 0.0)))
+
+
+def pack_context(top_groups: list, budget: int = CONTEXT_TOKEN_BUDGET):
+    """
+    Packs spans best reranker score first until `budget` tokens are used. A span that
+    does not fit is trimmed from its edges, dropping non-anchor neighbors first; if
+    its anchors alone still do not fit it is left out.
+    Returns (selected_chunks, context_tokens, dropped_chunk_count).
+    """
+    selected_chunks, used, dropped = [], 0, 0
+    for group in sorted(top_groups, key=_group_score, reverse=True):
+        costs = [count_tokens(chunk["text"]) for chunk in group]
+        first, last = 0, len(group) - 1
+        while first <= last and used + sum(costs[first:last + 1]) > budget:
+            if not group[last].get("is_anchor", False):
+                last -= 1
+            elif not group[first].get("is_anchor", False):
+                first += 1
+            else:
+                first, last = 0, -1
+        dropped += len(group) - max(0, last - first + 1)
+        selected_chunks.extend(group[first:last + 1])
+        used += sum(costs[first:last + 1])
+    return selected_chunks, used, dropped
+
+
+def build_past_snippet(chat_history: list, budget: int = HISTORY_TOKEN_BUDGET) -> str:
+    # If we have a “last conversation” (just the final turn), merge it into one snippet,
+    # cutting the previous answer so the snippet stays within `budget` tokens
+    if not chat_history:
+        return ""
+    last_user, last_assistant = chat_history[-1]["user"], chat_history[-1]["assistant"]
+    header = (
+        "Previous conversation:\n"
+        f"User: {last_user}\n"
+        "Assistant: "
+    )
+    return header + truncate_to_tokens(last_assistant, budget - count_tokens(header) - 1) + "\n\n"
+
+
+def assemble_prompt(query: str, top_groups: list, chat_history: list, context_token_budget: int, timings: dict):
+    """Packs the context within budget and builds the messages; returns (selected_chunks, msgs)."""
+    t_pack = time.time()
+    with tracing.span("prompt.build", budget=context_token_budget) as trace_span:
+        selected_chunks, timings["context_tokens"], timings["context_chunks_dropped"] = pack_context(
+            top_groups, budget=context_token_budget
+        )
+        past_snippet = build_past_snippet(chat_history)
+        msgs = build_generation_messages(query, selected_chunks, past_snippet)
+        timings["history_tokens"] = count_tokens(past_snippet) if past_snippet else 0
+        timings["prompt_tokens"] = sum(count_tokens(msg.content) for msg in msgs)
+        trace_span.set_attributes(chunks=len(selected_chunks), context_tokens=timings["context_tokens"],
+                                  dropped_chunks=timings["context_chunks_dropped"],
+                                  prompt_tokens=timings["prompt_tokens"])
+    timings["prompt_build"] = time.time() - t_pack
+    return selected_chunks, msgs
+
+
+def build_generation_messages(query: str, selected_chunks: list, past_snippet: str = "") -> list:
+    # Tag the packed chunks with inline references (1), (2), … — the same list is
+    # returned to app.py, so the numbers in the answer match the source cards
     context_text = ""
     for i, chunk in enumerate(selected_chunks):
         ref = f"({i+1})"
@@ -233,8 +927,6 @@ def generate_answer(
     #    • System instructions
     #    • (If it exists) a tiny “past‐conversation” snippet
     #    • The new question + retrieved context
-    t3 = time.time()
-
     # 4a) Relevance‐check instruction
     relevance_check = SystemMessage(content="""
     Before using any previous conversation turns, ask yourself:
@@ -259,18 +951,9 @@ def generate_answer(
     Never assume facts outside the given documents, and do not speculate. Be factual, structured, and neutral.
     """)
 
-    # 4c) If we have a “last conversation” (just the final turn), merge it into one snippet:
-    if chat_history:
-        last_user, last_assistant = chat_history[-1]["user"], chat_history[-1]["assistant"]
-        # We do NOT pass them as separate ChatDatabricks messages.
-        # Instead, we embed them as plain text inside the USER prompt, below:
-        past_snippet = (
-            "Previous conversation:\n"
-            f"User: {last_user}\n"
-            f"Assistant: {last_assistant}\n\n"
-        )
-    else:
-        past_snippet = ""
+    # 4c) The “past‐conversation” snippet (built by build_past_snippet) is NOT passed
+    #     as separate ChatDatabricks messages; it is embedded as plain text inside
+    #     the USER prompt, below.
 
     # 4d) Now build the single HumanMessage that contains:
     #     • the past conversation (if any),
@@ -295,12 +978,176 @@ def generate_answer(
         HumanMessage(content=prompt)
     ]
 
-    # Invoke the model:
-    ai_msg = chat_model.invoke(msgs)
-    timings["generation"] = time.time() - t3
+    return msgs
+
+
+# ------------------------------------------------------------------------------
+# === GENERATE_ANSWER WITH TIMING & “RELEVANCE CHECK” ===
+# ------------------------------------------------------------------------------
+def generate_answer(
+    query: str,
+    index,
+    chunk_store,
+    k: int = 5,
+    window: int = 1,
+    rerank_top_n: int = 6,
+    chat_history: list = [],
+    use_answer_cache: bool = True,
+    context_token_budget: int = CONTEXT_TOKEN_BUDGET,
+    lexical_index=None,
+    mode: str = PIPELINE_MODE,
+    profile: str = None,
+    report_filter: list = None
+):
+    """
+    `profile` ("cprofile" / "pyinstrument", default RAG_PROFILE) profiles this request;
+    the output file is returned in `timings["profile_path"]`.
+    `report_filter` (report names) limits retrieval to the chunks of those reports.
+    """
+    timings = {}
+    with tracing.span("generate_answer", mode=mode, k=k, window=window, rerank_top_n=rerank_top_n,
+                      history_turns=len(chat_history), reports=list(report_filter or [])) as trace_span, \
+            tracing.profiled("generate_answer", profile) as profile_result:
+        timings["trace_id"] = trace_span.trace_id
+        index, lexical_index = restrict_to_reports(index, chunk_store, lexical_index, report_filter)
 
+        # 0) Semantic answer cache
+        if use_answer_cache:
+            cached, query_vector, cache_key = _lookup_answer_cache(
+                query, chat_history, (k, window, rerank_top_n, context_token_budget, lexical_index is not None, mode,
+                                      tuple(sorted(report_filter or ()))),
+                timings
+            )
+            trace_span.set_attribute("answer_cache_hit", cached is not None)
+            if cached is not None:
+                return {
+                    "answer": cached["answer"],
+                    "chunks": cached["chunks"],
+                    "timings": timings
+                }
+
+        # 1) - 3) Query expansion, retrieval and reranking
+        top_groups = retrieve_top_groups(
+            query, index, chunk_store, k, window, rerank_top_n, timings,
+            lexical_index=lexical_index, mode=mode
+        )
+        trace_span.set_attribute("pipeline_path", timings.get("pipeline_path"))
+
+        # 4) Token-budgeted prompt + generation
+        t3 = time.time()
+        selected_chunks, msgs = assemble_prompt(query, top_groups, chat_history, context_token_budget, timings)
+
+        # Invoke the model:
+        with tracing.span("llm.generate", endpoint=CHAT_ENDPOINT, prompt_tokens=timings["prompt_tokens"]) as llm_span, \
+                serving_client.stage("generation"):
+            ai_msg = get_chat_model().invoke(msgs)
+            llm_span.set_attribute("answer_chars", len(ai_msg.content))
+        timings["generation"] = time.time() - t3
+
+        if use_answer_cache:
+            answer_cache.put(query_vector, cache_key, ai_msg.content, selected_chunks)
+
+    if profile_result["path"]:
+        timings["profile_path"] = profile_result["path"]
     return {
         "answer": ai_msg.content,
         "chunks": selected_chunks,
         "timings": timings
     }
+
+
+# ------------------------------------------------------------------------------
+# === STREAMING VARIANT ===
+# ------------------------------------------------------------------------------
+def generate_answer_stream(
+    query: str,
+    index,
+    chunk_store,
+    k: int = 5,
+    window: int = 1,
+    rerank_top_n: int = 6,
+    chat_history: list = [],
+    use_answer_cache: bool = True,
+    context_token_budget: int = CONTEXT_TOKEN_BUDGET,
+    lexical_index=None,
+    mode: str = PIPELINE_MODE,
+    report_filter: list = None
+):
+    """
+    Same pipeline as `generate_answer`, but as a generator of events:
+      {"type": "chunks", "chunks": [...]}          once retrieval + rerank is done
+      {"type": "token",  "text": "..."}            for each piece streamed by `chat_model.stream`
+      {"type": "done",   "answer": ..., "chunks": ..., "timings": ...}
+    `timings` reports `time_to_first_token` separately from the total `generation` time.
+    """
+    timings = {}
+    # The root span stays open across yields, so it is only made current around the
+    # work done between them (the consumer runs in the same context in between)
+    root_span = tracing.start_span("generate_answer_stream", mode=mode, k=k, window=window,
+                                   rerank_top_n=rerank_top_n, history_turns=len(chat_history),
+                                   reports=list(report_filter or []))
+    timings["trace_id"] = root_span.trace_id
+    error = None
+    try:
+        index, lexical_index = restrict_to_reports(index, chunk_store, lexical_index, report_filter)
+        if use_answer_cache:
+            with tracing.use_span(root_span):
+                cached, query_vector, cache_key = _lookup_answer_cache(
+                    query, chat_history, (k, window, rerank_top_n, context_token_budget, lexical_index is not None, mode,
+                                          tuple(sorted(report_filter or ()))),
+                    timings
+                )
+            root_span.set_attribute("answer_cache_hit", cached is not None)
+            if cached is not None:
+                yield {"type": "chunks", "chunks": cached["chunks"]}
+                yield {"type": "token", "text": cached["answer"]}
+                yield {"type": "done", "answer": cached["answer"], "chunks": cached["chunks"], "timings": timings}
+                return
+
+        with tracing.use_span(root_span):
+            top_groups = retrieve_top_groups(
+                query, index, chunk_store, k, window, rerank_top_n, timings,
+                lexical_index=lexical_index, mode=mode
+            )
+            root_span.set_attribute("pipeline_path", timings.get("pipeline_path"))
+            t3 = time.time()
+            selected_chunks, msgs = assemble_prompt(query, top_groups, chat_history, context_token_budget, timings)
+        yield {"type": "chunks", "chunks": selected_chunks}
+
+        # Started only once the consumer asks for tokens: a generator closed at the yield
+        # above would skip the `finally` below and leave the trace open
+        with tracing.use_span(root_span):
+            llm_span = tracing.start_span("llm.generate", endpoint=CHAT_ENDPOINT,
+                                          prompt_tokens=timings["prompt_tokens"])
+        pieces = []
+        try:
+            # Streamed calls use the default "generation" policy of serving_client (a stage
+            # context cannot be held open across the yields below)
+            for message_chunk in get_chat_model().stream(msgs):
+                text = message_chunk.content
+                if not text:
+                    continue
+                if not pieces:
+                    timings["time_to_first_token"] = time.time() - t3
+                    tracing.observe("time_to_first_token", timings["time_to_first_token"])
+                pieces.append(text)
+                yield {"type": "token", "text": text}
+        finally:
+            llm_span.set_attributes(pieces=len(pieces), answer_chars=sum(len(p) for p in pieces))
+            tracing.end_span(llm_span)
+        timings["generation"] = time.time() - t3
+
+        answer = "".join(pieces)
+        if use_answer_cache:
+            answer_cache.put(query_vector, cache_key, answer, selected_chunks)
+
+        yield {"type": "done", "answer": answer, "chunks": selected_chunks, "timings": timings}
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        tracing.end_span(root_span, error=error)
+
+
+# Seconds spent importing this module (no model loads happen at import any more)
+IMPORT_SECONDS = time.time() - _IMPORT_T0
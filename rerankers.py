@@ -0,0 +1,449 @@
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+import tracing
+from locks import file_lock
+
+
+# ------------------------------------------------------------------------------
+# === TORCH IMPORT (WITH STREAMLIT WATCHER PATCH) ===
+# ------------------------------------------------------------------------------
+def _import_torch():
+    import torch
+    # Accessing torch.classes.__path__ often raises the “__path__._path” error in
+    # Streamlit’s file watcher, so we forcibly override __path__ to an empty list.
+    try:
+        _ = torch.classes.__path__
+    except Exception:
+        pass
+    torch.classes.__path__ = []
+    return torch
+
+
+# ------------------------------------------------------------------------------
+# === PAIR TRUNCATION ===
+# ------------------------------------------------------------------------------
+def longest_first(a_len: int, b_len: int, budget: int):
+    """
+    Lengths kept by the tokenizers' "longest_first" truncation of a pair to `budget`
+    tokens (same rule as `tokenizer(a, b, truncation=True)`): the shorter sequence keeps
+    up to half the budget and the longer one takes the rest; when both exceed half,
+    each gets half and the longer one the odd token.
+    """
+    if a_len + b_len <= budget:
+        return a_len, b_len
+    swap = a_len > b_len
+    short, long_ = (b_len, a_len) if swap else (a_len, b_len)
+    long_ = short if short > budget else max(short, budget - short)
+    if short + long_ > budget:
+        short = budget // 2
+        long_ = short + budget % 2
+    return (long_, short) if swap else (short, long_)
+
+
+# ------------------------------------------------------------------------------
+# === BACKEND INTERFACE ===
+# ------------------------------------------------------------------------------
+class RerankerBackend:
+    """
+    Turns (query, passage) pairs into cross-encoder relevance scores.
+
+    - `max_length`: token truncation of each pair,
+    - `batch_size`: pairs per forward pass (micro-batches),
+    - `num_threads`: intra-op threads (None keeps the runtime default).
+    Subclasses implement `_load_model()` and `_forward(features) -> np.ndarray`.
+    """
+
+    name = "base"
+
+    def __init__(self, model_name: str, max_length: int = 512, batch_size: int = 16,
+                 num_threads: int = None, local_only: bool = False):
+        self.model_name = model_name
+        self.max_length = max_length
+        self.batch_size = batch_size
+        self.num_threads = num_threads
+        self.local_only = local_only
+        self.tokenizer = None
+
+    def load(self):
+        from transformers import AutoTokenizer
+        self.tokenizer = AutoTokenizer.from_pretrained(self.model_name, local_files_only=self.local_only)
+        self._load_model()
+        return self
+
+    def _load_model(self):
+        raise NotImplementedError
+
+    def _forward(self, features) -> np.ndarray:
+        raise NotImplementedError
+
+    def encode(self, pairs: list, return_tensors: str = "pt"):
+        """
+        Pair-encodes (query, passage) with truncation to `max_length`. A passage may be
+        a string or an int32 array of pre-computed token ids (chunk_store.token_ids),
+        in which case only the query is tokenized.
+        """
+        if not any(isinstance(passage, np.ndarray) for _, passage in pairs):
+            queries, passages = zip(*pairs)
+            return self.tokenizer(list(queries), list(passages), padding=True, truncation="longest_first",
+                                  max_length=self.max_length, return_tensors=return_tensors)
+        return self.encode_ids(pairs, return_tensors)
+
+    def _pair_template(self) -> dict:
+        """
+        Special tokens and token types around (query, passage), read once from a sample
+        pair encoding: works for any tokenizer, e.g. `[CLS] q [SEP] p [SEP]` (BERT) or
+        `<s> q </s></s> p </s>` (XLM-RoBERTa / bge-reranker).
+        """
+        if getattr(self, "_template", None) is None:
+            a_len = len(self.tokenizer.encode("query", add_special_tokens=False))
+            sample = self.tokenizer("query", "passage", return_special_tokens_mask=True)
+            ids, mask = sample["input_ids"], sample["special_tokens_mask"]
+            types = sample.get("token_type_ids")
+            content = [i for i, special in enumerate(mask) if not special]
+            a_start, a_end = content[0], content[a_len - 1] + 1
+            b_start, b_end = content[a_len], content[-1] + 1
+            template = {
+                "prefix": ids[:a_start], "middle": ids[a_end:b_start], "suffix": ids[b_end:],
+            }
+            if types is not None:
+                template["types"] = (types[:a_start], types[a_start], types[a_end:b_start], types[b_start], types[b_end:])
+            self._template = template
+        return self._template
+
+    def encode_ids(self, pairs: list, return_tensors: str = "pt"):
+        template = self._pair_template()
+        n_special = len(template["prefix"]) + len(template["middle"]) + len(template["suffix"])
+        budget = max(0, self.max_length - n_special)
+        query_ids = {}
+        features = []
+        for query, passage in pairs:
+            if query not in query_ids:
+                query_ids[query] = self.tokenizer.encode(query, add_special_tokens=False)
+            if not isinstance(passage, np.ndarray):
+                passage = self.tokenizer.encode(passage, add_special_tokens=False)
+            q_len, p_len = longest_first(len(query_ids[query]), len(passage), budget)
+            q_ids = query_ids[query][:q_len]
+            p_ids = [int(i) for i in passage[:p_len]]
+            input_ids = template["prefix"] + q_ids + template["middle"] + p_ids + template["suffix"]
+            feature = {"input_ids": input_ids, "attention_mask": [1] * len(input_ids)}
+            if "types" in template:
+                prefix, q_type, middle, p_type, suffix = template["types"]
+                feature["token_type_ids"] = prefix + [q_type] * len(q_ids) + middle + [p_type] * len(p_ids) + suffix
+            features.append(feature)
+        return self.tokenizer.pad(features, padding=True, return_tensors=return_tensors)
+
+    def _score_batch(self, pairs: list):
+        """(scores, padded tokens) of one forward pass, without a span (RerankScheduler traces its callers)."""
+        features = self.encode(pairs)
+        return self._forward(features), int(np.prod(features["input_ids"].shape))
+
+    def score_batch(self, pairs: list) -> np.ndarray:
+        """One forward pass over `pairs` (at most `batch_size` of them)."""
+        with tracing.span("rerank.batch", backend=self.name, pairs=len(pairs)) as span:
+            scores, padded_tokens = self._score_batch(pairs)
+            span.set_attribute("padded_tokens", padded_tokens)
+            return scores
+
+    def score_pairs(self, pairs: list) -> np.ndarray:
+        scores = [
+            self.score_batch(pairs[start:start + self.batch_size])
+            for start in range(0, len(pairs), self.batch_size)
+        ]
+        return np.concatenate(scores) if scores else np.zeros(0, dtype="float32")
+
+
+# ------------------------------------------------------------------------------
+# === PYTORCH BACKENDS ===
+# ------------------------------------------------------------------------------
+class TorchReranker(RerankerBackend):
+    """fp32 PyTorch inference (the original behavior)."""
+
+    name = "torch"
+
+    def _load_model(self):
+        from transformers import AutoModelForSequenceClassification
+        self.torch = _import_torch()
+        if self.num_threads:
+            # Process-wide setting in PyTorch
+            self.torch.set_num_threads(self.num_threads)
+        self.model = AutoModelForSequenceClassification.from_pretrained(
+            self.model_name, local_files_only=self.local_only
+        ).eval()
+
+    def _forward(self, features) -> np.ndarray:
+        with self.torch.no_grad():
+            return self.model(**features).logits.squeeze(-1).float().numpy()
+
+
+class QuantizedTorchReranker(TorchReranker):
+    """PyTorch with the Linear layers dynamically quantized to int8."""
+
+    name = "torch-int8"
+
+    def _load_model(self):
+        super()._load_model()
+        self.model = self.torch.quantization.quantize_dynamic(
+            self.model, {self.torch.nn.Linear}, dtype=self.torch.qint8
+        )
+
+
+# ------------------------------------------------------------------------------
+# === ONNX RUNTIME BACKEND ===
+# ------------------------------------------------------------------------------
+class OnnxReranker(RerankerBackend):
+    """
+    ONNX Runtime inference. The model is exported once to `onnx_path` (under a file
+    lock: API workers start together); when that file already exists only the
+    tokenizer and onnxruntime are needed at start-up.
+    """
+
+    name = "onnx"
+
+    def __init__(self, model_name: str, onnx_path: str = None, **kwargs):
+        super().__init__(model_name, **kwargs)
+        self.onnx_path = onnx_path or os.path.join(
+            os.environ.get("RAG_RERANKER_ONNX_DIR", "/tmp/ipcc_reranker_onnx"),
+            model_name.strip("/").replace("/", "_") + ".onnx",
+        )
+
+    def export(self):
+        from transformers import AutoModelForSequenceClassification
+        torch = _import_torch()
+        model = AutoModelForSequenceClassification.from_pretrained(
+            self.model_name, local_files_only=self.local_only
+        ).eval()
+        sample = self.encode([("query", "passage")])
+        input_names = list(sample.keys())
+        dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+        dynamic_axes["logits"] = {0: "batch"}
+        os.makedirs(os.path.dirname(self.onnx_path), exist_ok=True)
+        tmp_path = f"{self.onnx_path}.{os.getpid()}.tmp"
+        with torch.no_grad():
+            torch.onnx.export(
+                model, tuple(sample[name] for name in input_names), tmp_path,
+                input_names=input_names, output_names=["logits"],
+                dynamic_axes=dynamic_axes, opset_version=14,
+            )
+        os.replace(tmp_path, self.onnx_path)
+        print(f"✅ Reranker exported to {self.onnx_path}.")
+
+    def _load_model(self):
+        import onnxruntime as ort
+        if not os.path.exists(self.onnx_path):
+            with file_lock(self.onnx_path + ".lock"):
+                if not os.path.exists(self.onnx_path):
+                    self.export()
+        options = ort.SessionOptions()
+        if self.num_threads:
+            options.intra_op_num_threads = self.num_threads
+        self.session = ort.InferenceSession(self.onnx_path, options, providers=["CPUExecutionProvider"])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+
+    def encode(self, pairs: list, return_tensors: str = "np"):
+        return super().encode(pairs, return_tensors=return_tensors)
+
+    def _forward(self, features) -> np.ndarray:
+        feeds = {name: features[name].astype("int64") for name in self.input_names}
+        return self.session.run(["logits"], feeds)[0].reshape(-1).astype("float32")
+
+
+BACKENDS = {
+    TorchReranker.name: TorchReranker,
+    QuantizedTorchReranker.name: QuantizedTorchReranker,
+    OnnxReranker.name: OnnxReranker,
+}
+
+
+def make_reranker(backend: str = "torch", **kwargs) -> RerankerBackend:
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown reranker backend {backend!r}, expected one of {sorted(BACKENDS)}")
+    return BACKENDS[backend](**kwargs)
+
+
+# ------------------------------------------------------------------------------
+# === CROSS-REQUEST MICRO-BATCHING ===
+# ------------------------------------------------------------------------------
+def _pair_length(pair) -> int:
+    query, passage = pair
+    return len(query) + (4 * len(passage) if isinstance(passage, np.ndarray) else len(passage))
+
+
+class RerankScheduler:
+    """
+    Pools the (query, passage) pairs of concurrent callers into shared forward passes.
+
+    A background worker waits at most `max_wait` seconds after the first pending
+    request (or until `batch_size` pairs are pending), sorts everything pending by
+    length so each padded batch holds similar lengths, runs one forward pass per
+    `batch_size` pairs and hands every caller its own scores, in its own order.
+    The worker has no request context, so `score_pairs` records one
+    "rerank.scheduled" span per caller, on the caller's trace, with its queue
+    wait and its share of the round (forward passes, seconds, padded tokens).
+    """
+
+    def __init__(self, backend: RerankerBackend, max_wait: float = 0.005, batch_size: int = None):
+        self.backend = backend
+        self.max_wait = max_wait
+        self.batch_size = batch_size or backend.batch_size
+        self.stats = {"requests": 0, "pairs": 0, "batches": 0, "rounds": 0}
+        self._pending = []   # (pairs, future, submit time)
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="reranker-scheduler", daemon=True)
+        self._thread.start()
+
+    def submit(self, pairs: list) -> Future:
+        future = Future()
+        future.trace_attributes = {"batches": 0, "forward_seconds": 0.0, "padded_tokens": 0}
+        if not pairs:
+            future.set_result(np.zeros(0, dtype="float32"))
+            return future
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("RerankScheduler is closed")
+            self._pending.append((list(pairs), future, time.time()))
+            self._cond.notify()
+        return future
+
+    def score_pairs(self, pairs: list) -> np.ndarray:
+        with tracing.span("rerank.scheduled", backend=self.backend.name, pairs=len(pairs)) as span:
+            future = self.submit(pairs)
+            try:
+                return future.result()
+            finally:
+                span.set_attributes(**future.trace_attributes)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _take_round(self) -> list:
+        with self._cond:
+            while not self._pending and not self._closed:
+                self._cond.wait()
+            deadline = time.monotonic() + self.max_wait
+            while not self._closed and sum(len(p) for p, _, _ in self._pending) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            requests, self._pending = self._pending, []
+            return requests
+
+    def _run(self):
+        while True:
+            requests = self._take_round()
+            if not requests:
+                return   # closed and drained
+            self._score_round(requests)
+
+    def _score_round(self, requests: list):
+        # Flatten, sort by length (characters, ~4 per token, as a cheap proxy) and batch
+        flat = [(i, j, pair) for i, (pairs, _, _) in enumerate(requests) for j, pair in enumerate(pairs)]
+        flat.sort(key=lambda item: _pair_length(item[2]))
+        results = [np.zeros(len(pairs), dtype="float32") for pairs, _, _ in requests]
+        t_round = time.time()
+        for _, future, submitted in requests:
+            future.trace_attributes.update(queue_wait=t_round - submitted, round_requests=len(requests),
+                                           round_pairs=len(flat))
+        failed = {}
+        for start in range(0, len(flat), self.batch_size):
+            batch = flat[start:start + self.batch_size]
+            t0 = time.time()
+            try:
+                scores, padded_tokens = self.backend._score_batch([pair for _, _, pair in batch])
+            except Exception as e:
+                for i, _, _ in batch:
+                    failed.setdefault(i, e)
+                continue
+            for (i, j, _), score in zip(batch, scores):
+                results[i][j] = score
+            for i in {i for i, _, _ in batch}:
+                attributes = requests[i][1].trace_attributes
+                attributes["batches"] += 1
+                attributes["forward_seconds"] += time.time() - t0
+                attributes["padded_tokens"] += padded_tokens
+            self.stats["batches"] += 1
+        for i, (_, future, _) in enumerate(requests):
+            if i in failed:
+                future.set_exception(failed[i])
+            else:
+                future.set_result(results[i])
+        self.stats["rounds"] += 1
+        self.stats["requests"] += len(requests)
+        self.stats["pairs"] += len(flat)
+
+
+# ------------------------------------------------------------------------------
+# === LAZY LOADING (FIRST USE OR BACKGROUND WARM-UP) ===
+# ------------------------------------------------------------------------------
+class LazyReranker:
+    """
+    Holds a reranker backend, loaded on the first call to `load()` or in a
+    background thread started by `warm_up()`. `load_seconds` and `error` record
+    how the load went; until the backend is ready callers use a fallback.
+    With `scheduler_wait` (seconds) set, `score_pairs` goes through a
+    RerankScheduler that micro-batches the pairs of concurrent callers.
+    """
+
+    def __init__(self, backend: str = "torch", scheduler_wait: float = None, **backend_kwargs):
+        self.backend_name = backend
+        self.backend_kwargs = backend_kwargs
+        self.scheduler_wait = scheduler_wait
+        self.backend = None
+        self.scheduler = None
+        self.error = None
+        self.load_seconds = None
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def ready(self) -> bool:
+        return self._done.is_set() and self.backend is not None
+
+    @property
+    def loading(self) -> bool:
+        return self._thread is not None and not self._done.is_set()
+
+    def load(self) -> bool:
+        with self._lock:
+            if self._done.is_set():
+                return self.ready
+            t0 = time.time()
+            try:
+                self.backend = make_reranker(self.backend_name, **self.backend_kwargs).load()
+                if self.scheduler_wait is not None:
+                    self.scheduler = RerankScheduler(self.backend, max_wait=self.scheduler_wait)
+            except Exception as e:
+                # e.g. torch not installed, or no local copy while offline: reranking is skipped
+                self.error = e
+                print(f"⚠️ Reranker {self.backend_kwargs.get('model_name')} ({self.backend_name}) unavailable ({e}).")
+            self.load_seconds = time.time() - t0
+            self._done.set()
+            if self.ready:
+                print(f"✅ Reranker ({self.backend_name}) loaded in {self.load_seconds:.1f}s.")
+            return self.ready
+
+    def score_pairs(self, pairs: list) -> np.ndarray:
+        return (self.scheduler or self.backend).score_pairs(pairs)
+
+    def disable(self):
+        """Marks the reranker as unavailable without loading it: callers use their fallback."""
+        with self._lock:
+            self._done.set()
+
+    def warm_up(self):
+        """Starts loading in a daemon thread; calling it again is a no-op."""
+        with self._lock:
+            if self._thread is None and not self._done.is_set():
+                self._thread = threading.Thread(target=self.load, name="reranker-warm-up", daemon=True)
+                self._thread.start()
+        return self._thread
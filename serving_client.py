@@ -0,0 +1,500 @@
+"""
+Resilient client of the Databricks model-serving endpoints (standard library only).
+
+    POST {host}/serving-endpoints/{endpoint}/invocations
+
+- pooled keep-alive HTTP(S) connections (one pool per host, `RAG_SERVING_POOL_SIZE`),
+- per-stage deadlines: every attempt, retry and backoff of one call fits in the
+  stage's time budget (`RAG_SERVING_<STAGE>_DEADLINE`),
+- retries with exponential backoff and full jitter on connection errors, 429 and 5xx,
+- optional hedging (`RAG_SERVING_HEDGE=1`, short expansion calls and embeddings): when
+  a call has not answered after the stage's observed p95 latency, a duplicate is sent
+  (at most `RAG_SERVING_MAX_HEDGES` at once); the first response wins and the other
+  call's connection is closed.
+
+`ServingChatModel` / `ServingEmbeddings` have the methods rag_core uses on
+ChatDatabricks / DatabricksEmbeddings (`invoke`, `stream`, `embed_documents`,
+`embed_query`). rag_core selects the stage of each call with `stage(...)`.
+offline_stubs.StubServingServer is a local endpoint with injected latency and errors.
+"""
+import collections
+import contextvars
+import heapq
+import http.client
+import itertools
+import json
+import os
+import queue
+import random
+import socket
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+
+POOL_SIZE = int(os.environ.get("RAG_SERVING_POOL_SIZE", "8"))
+HEDGING = os.environ.get("RAG_SERVING_HEDGE", "0") == "1"
+MAX_HEDGES = int(os.environ.get("RAG_SERVING_MAX_HEDGES", "4"))
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class ServingError(RuntimeError):
+    def __init__(self, status: int, body: str):
+        super().__init__(f"HTTP {status}: {body[:300]}")
+        self.status = status
+
+
+class Cancelled(Exception):
+    """The call lost a hedge race; its connection was closed by the winner."""
+
+
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+
+# ------------------------------------------------------------------------------
+# === STAGE POLICIES ===
+# ------------------------------------------------------------------------------
+class StagePolicy:
+    """Time budget, retries and hedging of the calls of one pipeline stage."""
+
+    def __init__(self, deadline: float, retries: int = 2, hedge: bool = False,
+                 hedge_quantile: float = 0.95, initial_hedge_delay: float = 2.0, min_samples: int = 20):
+        self.deadline = deadline
+        self.retries = retries
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.initial_hedge_delay = initial_hedge_delay
+        self.min_samples = min_samples
+        self.latencies = collections.deque(maxlen=500)
+        self.stats = {"calls": 0, "retries": 0, "hedges": 0, "hedge_wins": 0, "deadline_exceeded": 0}
+        self._lock = threading.Lock()   # calls of one stage come from many threads
+
+    def count(self, name: str):
+        with self._lock:
+            self.stats[name] += 1
+
+    def record_latency(self, seconds: float):
+        with self._lock:
+            self.latencies.append(seconds)
+
+    def hedge_delay(self) -> float:
+        """p95 of the recent successful latencies (a fixed delay until enough are known)."""
+        with self._lock:
+            ordered = sorted(self.latencies)
+        if len(ordered) < self.min_samples:
+            return self.initial_hedge_delay
+        return ordered[min(len(ordered) - 1, int(self.hedge_quantile * len(ordered)))]
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.stats)
+
+
+def _env_deadline(stage_name: str, default: float) -> float:
+    return float(os.environ.get(f"RAG_SERVING_{stage_name.upper()}_DEADLINE", default))
+
+
+STAGE_POLICIES = {
+    # Contextualization + paraphrases: short answers, worth a duplicate when slow
+    "expansion": StagePolicy(_env_deadline("expansion", 15), retries=2, hedge=HEDGING),
+    "embedding": StagePolicy(_env_deadline("embedding", 10), retries=3, hedge=HEDGING),
+    # Long generation: never duplicated (cost), one retry before the first token
+    "generation": StagePolicy(_env_deadline("generation", 120), retries=1),
+}
+_stage = contextvars.ContextVar("rag_serving_stage", default="generation")
+
+
+@contextmanager
+def stage(name: str):
+    """Calls made inside the block use STAGE_POLICIES[name] (no effect on other clients)."""
+    token = _stage.set(name)
+    try:
+        yield
+    finally:
+        _stage.reset(token)
+
+
+def current_policy() -> StagePolicy:
+    return STAGE_POLICIES.get(_stage.get(), STAGE_POLICIES["generation"])
+
+
+# ------------------------------------------------------------------------------
+# === POOLED KEEP-ALIVE CONNECTIONS ===
+# ------------------------------------------------------------------------------
+class ConnectionPool:
+    """At most `size` idle keep-alive connections to one host, reused LIFO."""
+
+    def __init__(self, base_url: str, size: int = POOL_SIZE):
+        parsed = urllib.parse.urlparse(base_url)
+        self.scheme, self.host, self.port = parsed.scheme, parsed.hostname, parsed.port
+        self.base_path = parsed.path.rstrip("/")
+        self._idle = queue.LifoQueue(maxsize=size)
+        self.stats = {"created": 0, "reused": 0}
+        self._stats_lock = threading.Lock()
+
+    def acquire(self, timeout: float):
+        try:
+            conn = self._idle.get_nowait()
+            reused = True
+        except queue.Empty:
+            cls = http.client.HTTPSConnection if self.scheme == "https" else http.client.HTTPConnection
+            conn = cls(self.host, self.port, timeout=timeout)
+            reused = False
+        with self._stats_lock:
+            self.stats["reused" if reused else "created"] += 1
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        return conn
+
+    def release(self, conn):
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+# ------------------------------------------------------------------------------
+# === HEDGING: DELAYED DUPLICATES, CANCELLATION OF THE LOSER ===
+# ------------------------------------------------------------------------------
+class _Timer:
+    """One thread running delayed callbacks (hedge launches) for all calls of a client."""
+
+    def __init__(self):
+        self._heap = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def schedule(self, delay: float, callback) -> list:
+        entry = [time.monotonic() + delay, next(self._sequence), callback]
+        with self._condition:
+            heapq.heappush(self._heap, entry)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="rag-serving-timer", daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return entry
+
+    def cancel(self, entry: list):
+        with self._condition:
+            entry[2] = None
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    self._condition.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                _, _, callback = heapq.heappop(self._heap)
+            if callback is not None:
+                callback()
+
+
+class _CallHandle:
+    """The connection of one copy of a hedged call, which the other copy can close."""
+
+    def __init__(self):
+        self.cancelled = False
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def attach(self, conn):
+        with self._lock:
+            if self.cancelled:
+                raise Cancelled()
+            self._conn = conn
+
+    def detach(self):
+        with self._lock:
+            self._conn = None
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            if self._conn is not None and self._conn.sock is not None:
+                try:
+                    self._conn.sock.shutdown(socket.SHUT_RDWR)   # wakes the thread blocked on it
+                except OSError:
+                    pass
+
+
+class ServingClient:
+    """POSTs JSON to the serving endpoints with deadlines, retries and optional hedging."""
+
+    def __init__(self, host: str = None, token: str = None, pool_size: int = POOL_SIZE,
+                 max_hedges: int = MAX_HEDGES):
+        host = host or os.environ["DATABRICKS_HOST"]
+        if "://" not in host:
+            host = "https://" + host
+        self.pool = ConnectionPool(host, pool_size)
+        self.token = token if token is not None else os.environ.get("DATABRICKS_TOKEN", "")
+        # Only hedged duplicates run here (originals run on the caller's thread); a hedge
+        # is skipped rather than queued when `max_hedges` are already in flight
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_hedges), thread_name_prefix="rag-serving")
+        self._hedge_slots = threading.Semaphore(max(1, max_hedges))
+        self._timer = _Timer()
+
+    def _headers(self, stream: bool = False) -> dict:
+        headers = {"Content-Type": "application/json", "Connection": "keep-alive",
+                   "Accept": "text/event-stream" if stream else "application/json"}
+        if self.token:
+            headers["Authorization"] = f"Bearer {self.token}"
+        return headers
+
+    def _path(self, endpoint: str) -> str:
+        return f"{self.pool.base_path}/serving-endpoints/{endpoint}/invocations"
+
+    def _attempt(self, endpoint: str, body: bytes, deadline: float, handle: _CallHandle = None) -> dict:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceeded(f"{endpoint}: deadline exceeded")
+        conn = self.pool.acquire(remaining)
+        try:
+            if handle is not None:
+                handle.attach(conn)
+            conn.request("POST", self._path(endpoint), body=body, headers=self._headers())
+            response = conn.getresponse()
+            data = response.read()
+        except BaseException:
+            conn.close()
+            raise
+        finally:
+            if handle is not None:
+                handle.detach()
+        if response.will_close:
+            conn.close()
+        else:
+            self.pool.release(conn)
+        if response.status != 200:
+            raise ServingError(response.status, data.decode("utf-8", "replace"))
+        return json.loads(data)
+
+    def _with_retries(self, attempt, policy: StagePolicy, deadline: float, handle: _CallHandle = None):
+        for n in range(policy.retries + 1):
+            try:
+                return attempt()
+            except (ServingError, OSError, http.client.HTTPException) as e:
+                if handle is not None and handle.cancelled:
+                    raise Cancelled() from e   # the other copy answered: no retry
+                retryable = not isinstance(e, ServingError) or e.status in RETRYABLE_STATUS
+                if isinstance(e, TimeoutError) and time.monotonic() >= deadline:
+                    policy.count("deadline_exceeded")
+                    raise DeadlineExceeded(f"deadline of {policy.deadline:.1f}s exceeded") from e
+                if not retryable or n == policy.retries:
+                    raise
+                # Full jitter, and never sleep past the deadline
+                backoff = random.uniform(0, min(4.0, 0.1 * 2 ** n))
+                if time.monotonic() + backoff >= deadline:
+                    policy.count("deadline_exceeded")
+                    raise DeadlineExceeded(f"deadline of {policy.deadline:.1f}s exceeded") from e
+                policy.count("retries")
+                time.sleep(backoff)
+
+    def post(self, endpoint: str, payload: dict) -> dict:
+        """One logical call under the current stage policy; returns the decoded JSON response."""
+        policy = current_policy()
+        policy.count("calls")
+        body = json.dumps(payload).encode("utf-8")
+        t0 = time.monotonic()
+        deadline = t0 + policy.deadline
+
+        def call(handle: _CallHandle = None):
+            return self._with_retries(lambda: self._attempt(endpoint, body, deadline, handle),
+                                      policy, deadline, handle)
+
+        result = self._hedged(call, policy, deadline) if policy.hedge else call()
+        policy.record_latency(time.monotonic() - t0)
+        return result
+
+    def _hedged(self, call, policy: StagePolicy, deadline: float):
+        """
+        Runs `call` on this thread; if it has not answered after the hedge delay, a
+        duplicate starts on the executor. The first success cancels the other copy.
+        """
+        primary, duplicate = _CallHandle(), _CallHandle()
+        lock = threading.Lock()
+        state = {"primary_done": False, "launched": False}
+        outcome = {}
+        duplicate_done = threading.Event()
+
+        def run_duplicate():
+            try:
+                outcome["result"] = call(duplicate)
+                with lock:
+                    won = not state["primary_done"]
+                if won:
+                    primary.cancel()
+            except BaseException as e:
+                outcome["error"] = e
+            finally:
+                self._hedge_slots.release()
+                duplicate_done.set()
+
+        def launch():
+            with lock:
+                if state["primary_done"] or not self._hedge_slots.acquire(blocking=False):
+                    return   # answered meanwhile, or too many hedges in flight
+                state["launched"] = True
+            try:
+                self._executor.submit(run_duplicate)
+            except RuntimeError:   # client closed
+                self._hedge_slots.release()
+                duplicate_done.set()
+                return
+            policy.count("hedges")
+
+        timer = self._timer.schedule(min(policy.hedge_delay(), max(0.0, deadline - time.monotonic())), launch)
+        try:
+            result, error = call(primary), None
+        except BaseException as e:
+            result, error = None, e
+        with lock:
+            state["primary_done"] = True
+            launched = state["launched"]
+        self._timer.cancel(timer)
+        if error is None:
+            duplicate.cancel()   # the slower copy stops instead of holding a thread and a connection
+            return result
+        if launched:
+            # The primary failed or was cancelled by a winning duplicate
+            duplicate_done.wait(timeout=max(0.0, deadline - time.monotonic()))
+            if "result" in outcome:
+                policy.count("hedge_wins")
+                return outcome["result"]
+            if not duplicate_done.is_set():
+                policy.count("deadline_exceeded")
+                raise DeadlineExceeded(f"deadline of {policy.deadline:.1f}s exceeded") from error
+        raise error
+
+    def post_stream(self, endpoint: str, payload: dict):
+        """
+        Yields the decoded `data:` events of a streamed response. Retries only happen
+        before the first event; the deadline covers the wait for the response headers.
+        """
+        policy = current_policy()
+        policy.count("calls")
+        body = json.dumps({**payload, "stream": True}).encode("utf-8")
+        t0 = time.monotonic()
+        deadline = t0 + policy.deadline
+
+        def open_stream():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise DeadlineExceeded(f"{endpoint}: deadline exceeded")
+            conn = self.pool.acquire(remaining)
+            try:
+                conn.request("POST", self._path(endpoint), body=body, headers=self._headers(stream=True))
+                response = conn.getresponse()
+                if response.status != 200:
+                    data = response.read()
+                    conn.close()
+                    raise ServingError(response.status, data.decode("utf-8", "replace"))
+            except BaseException:
+                conn.close()
+                raise
+            return conn, response
+
+        conn, response = self._with_retries(open_stream, policy, deadline)
+        policy.record_latency(time.monotonic() - t0)
+        finished = False
+        try:
+            for raw_line in response:
+                line = raw_line.decode("utf-8").strip()
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                yield json.loads(data)
+            response.read()
+            finished = True
+        finally:
+            # A stream abandoned half-way leaves unread data on the socket: not reusable
+            if finished and not response.will_close:
+                self.pool.release(conn)
+            else:
+                conn.close()
+
+    def close(self):
+        self.pool.close()
+        self._executor.shutdown(wait=False)
+
+
+# ------------------------------------------------------------------------------
+# === CHAT & EMBEDDING MODELS ===
+# ------------------------------------------------------------------------------
+class ServingMessage:
+    def __init__(self, content: str):
+        self.content = content
+
+
+_ROLES = {"system": "system", "human": "user", "user": "user", "ai": "assistant", "assistant": "assistant"}
+
+
+def _role(message) -> str:
+    kind = getattr(message, "type", None) or type(message).__name__.replace("Message", "").lower()
+    return _ROLES.get(kind, "user")
+
+
+class ServingChatModel:
+    """Chat completions (OpenAI-style payload) of a Databricks chat endpoint."""
+
+    def __init__(self, client: ServingClient, endpoint: str, max_tokens: int = 2048, temperature: float = 0.1):
+        self.client = client
+        self.endpoint = endpoint
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+
+    def _payload(self, messages: list) -> dict:
+        return {
+            "messages": [{"role": _role(m), "content": m.content} for m in messages],
+            "max_tokens": self.max_tokens,
+            "temperature": self.temperature,
+        }
+
+    def invoke(self, messages: list) -> ServingMessage:
+        response = self.client.post(self.endpoint, self._payload(messages))
+        return ServingMessage(response["choices"][0]["message"]["content"])
+
+    def stream(self, messages: list):
+        for event in self.client.post_stream(self.endpoint, self._payload(messages)):
+            choices = event.get("choices") or [{}]
+            text = (choices[0].get("delta") or {}).get("content")
+            if text:
+                yield ServingMessage(text)
+
+
+class ServingEmbeddings:
+    """Embeddings of a Databricks embedding endpoint, `batch_size` texts per request."""
+
+    def __init__(self, client: ServingClient, endpoint: str, batch_size: int = 16):
+        self.client = client
+        self.endpoint = endpoint
+        self.batch_size = batch_size
+
+    def embed_documents(self, texts: list) -> list:
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            response = self.client.post(self.endpoint, {"input": texts[start:start + self.batch_size]})
+            vectors.extend(item["embedding"] for item in sorted(response["data"], key=lambda item: item["index"]))
+        return vectors
+
+    def embed_query(self, text: str) -> list:
+        return self.embed_documents([text])[0]
+
+
+def policy_stats() -> dict:
+    """Per-stage calls / retries / hedges / deadline counts and current hedge delay."""
+    return {name: {**policy.snapshot(), "hedge_delay": policy.hedge_delay()} for name, policy in STAGE_POLICIES.items()}
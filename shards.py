@@ -0,0 +1,328 @@
+"""
+Sharded index layout: one FAISS index per report, searched in parallel.
+
+    <index>.shards/shards.json           dim, metric, ntotal, factory, search params (nprobe /
+                                         efSearch of ANN shards) and one entry per report
+    <index>.shards/shard_<i>.index       IndexIDMap over the report's vectors, ids = global
+                                         positions (so the chunk store, BM25 and spans are shared)
+
+Shards are read (memory-mapped when possible) the first time they are searched. A
+search fans out over the selected shards on a thread pool (FAISS releases the GIL)
+and the per-shard top-k lists are merged into one global top-k. Restricting the
+search to some reports is a view of the index (`select`), so the pipeline below
+generate_answer does not change.
+
+    python shards.py split --index /tmp/ipcc_faiss.index --chunk-store /tmp/ipcc_chunk_store
+    python shards.py split --index-factory IVF256,Flat --nprobe 16
+    python shards.py list --shards /tmp/ipcc_faiss.index.shards
+"""
+import argparse
+import json
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import faiss
+import numpy as np
+
+from build_ann_index import apply_search_params, load_search_params
+
+
+SHARD_WORKERS = int(os.environ.get("RAG_SHARD_WORKERS", "4"))
+
+
+def shards_path(index_path: str) -> str:
+    return index_path + ".shards"
+
+
+def is_sharded(path: str) -> bool:
+    return os.path.exists(os.path.join(path, "shards.json"))
+
+
+# ------------------------------------------------------------------------------
+# === SHARDED INDEX (LAZY SHARDS, PARALLEL FAN-OUT) ===
+# ------------------------------------------------------------------------------
+class ShardedIndex:
+    """
+    Duck-types the parts of a FAISS index the pipeline uses (`search`, `ntotal`, `d`).
+    `read_index` opens one shard file (rag_core passes its memory-mapping reader); the
+    manifest's search params are applied to each shard when it is loaded.
+    """
+
+    def __init__(self, path: str, read_index=faiss.read_index, max_workers: int = SHARD_WORKERS):
+        self.path = path
+        with open(os.path.join(path, "shards.json")) as f:
+            manifest = json.load(f)
+        self.d = manifest["dim"]
+        self.metric_type = manifest["metric"]
+        self.shard_specs = manifest["shards"]   # report_name -> {"file", "count"}
+        self.reports = list(self.shard_specs)
+        self.search_params = manifest.get("search_params", {})
+        self.read_index = read_index
+        factory = manifest.get("index_factory", "Flat")
+        if not self.search_params and ("IVF" in factory or "HNSW" in factory):
+            print(f"⚠️ {factory} shards in {path} have no search params; "
+                  f"searching with the FAISS defaults (nprobe=1 / efSearch=16).")
+        self._shards = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="rag-shards")
+
+    @property
+    def ntotal(self) -> int:
+        return sum(self.shard_specs[report]["count"] for report in self.reports)
+
+    @property
+    def loaded_reports(self) -> list:
+        return [report for report in self.reports if report in self._shards]
+
+    def shard(self, report: str):
+        if report not in self._shards:
+            with self._lock:
+                if report not in self._shards:
+                    shard = self.read_index(os.path.join(self.path, self.shard_specs[report]["file"]))
+                    apply_search_params(shard, self.search_params)
+                    self._shards[report] = shard
+        return self._shards[report]
+
+    def select(self, reports) -> "ShardedIndex":
+        """View searching only `reports`; shards, lock and thread pool are shared with this index."""
+        unknown = [report for report in reports if report not in self.shard_specs]
+        if unknown:
+            raise ValueError(f"Unknown reports {unknown}, expected some of {list(self.shard_specs)}")
+        view = object.__new__(ShardedIndex)
+        view.__dict__.update(self.__dict__)
+        view.reports = [report for report in self.reports if report in set(reports)]
+        return view
+
+    def search(self, x: np.ndarray, k: int):
+        if len(self.reports) == 1:
+            return self.shard(self.reports[0]).search(x, k)
+        results = list(self._pool.map(lambda report: self.shard(report).search(x, k), self.reports))
+        return merge_results(results, k, self.metric_type)
+
+
+def merge_results(results: list, k: int, metric_type: int = faiss.METRIC_INNER_PRODUCT):
+    """Global top-k of per-shard (distances, ids) lists; shorter lists are padded with -1 ids."""
+    distances = np.hstack([d for d, _ in results])
+    ids = np.hstack([i for _, i in results])
+    # Padding entries (-1) sort last whatever the metric
+    keys = -distances if metric_type == faiss.METRIC_INNER_PRODUCT else distances.copy()
+    keys[ids < 0] = np.inf
+    order = np.argsort(keys, axis=1, kind="stable")[:, :k]
+    return np.take_along_axis(distances, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+
+# ------------------------------------------------------------------------------
+# === REPORT FILTER ON A SINGLE INDEX / BM25 ===
+# ------------------------------------------------------------------------------
+def report_positions(chunk_store, reports) -> np.ndarray:
+    """Chunk positions whose `report_name` is in `reports`."""
+    codes = chunk_store.column_codes("report_name")
+    vocabulary = getattr(chunk_store, "vocabularies", {}).get("report_name")
+    if codes is None:
+        return np.zeros(0, dtype="int64")
+    if vocabulary is None:
+        names = [chunk_store.metadata(p).get("report_name") for p in range(len(chunk_store))]
+        return np.flatnonzero(np.isin(np.array(names, dtype=object), list(reports))).astype("int64")
+    wanted = [vocabulary.index(report) for report in reports if report in vocabulary]
+    return np.flatnonzero(np.isin(codes, wanted)).astype("int64")
+
+
+def _search_parameters(index, selector):
+    """Search parameters carrying `selector` plus the index's own nprobe / efSearch."""
+    base = faiss.downcast_index(index.index if isinstance(index, faiss.IndexPreTransform) else index)
+    if isinstance(base, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(sel=selector, nprobe=base.nprobe)
+    if isinstance(base, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=base.hnsw.efSearch)
+    return faiss.SearchParameters(sel=selector)
+
+
+class FilteredIndex:
+    """Single (non-sharded) index restricted to some positions with an IDSelector."""
+
+    def __init__(self, index, positions: np.ndarray):
+        self.index = index
+        self.d = index.d
+        self.ntotal = len(positions)
+        self._selector = faiss.IDSelectorBatch(positions)
+        self._params = _search_parameters(index, self._selector)
+
+    def search(self, x: np.ndarray, k: int):
+        return self.index.search(x, k, params=self._params)
+
+
+class FilteredLexicalIndex:
+    """BM25 index whose results are limited to the allowed positions."""
+
+    def __init__(self, lexical_index, positions: np.ndarray):
+        self.lexical_index = lexical_index
+        self.allowed = np.zeros(len(lexical_index), dtype=bool)
+        self.allowed[positions] = True
+
+    def __len__(self):
+        return int(self.allowed.sum())
+
+    def search(self, query: str, k: int = 5):
+        return self.lexical_index.search(query, k, allowed=self.allowed)
+
+
+# Filtered views are built once per (object, report set). They are kept on the chunk
+# store, which is loaded and reloaded together with the index and BM25 index (FAISS
+# objects take no new attributes), so they go away with them.
+MAX_CACHED_FILTERS = 64
+
+
+def _cached_filter(chunk_store, owner, reports: frozenset, build):
+    cache = getattr(chunk_store, "_report_filters", None)
+    if cache is None:
+        cache = {}
+        chunk_store._report_filters = cache
+    key = (id(owner), reports)
+    entry = cache.get(key)
+    if entry is None or entry[0] is not owner:
+        if len(cache) >= MAX_CACHED_FILTERS:
+            cache.clear()
+        entry = cache[key] = (owner, build())
+    return entry[1]
+
+
+def restrict_to_reports(index, chunk_store, lexical_index, reports):
+    """(index, lexical_index) searching only the chunks of `reports` (unchanged if `reports` is empty)."""
+    if not reports:
+        return index, lexical_index
+    reports = frozenset(reports)
+
+    def positions():
+        return _cached_filter(chunk_store, chunk_store, reports, lambda: report_positions(chunk_store, reports))
+
+    def filtered_index():
+        if isinstance(index, ShardedIndex):
+            return index.select(reports)   # shard selection only: no per-chunk positions needed
+        if len(positions()) == 0:
+            raise ValueError(f"No chunks of reports {sorted(reports)} in the index")
+        return FilteredIndex(index, positions())
+
+    filtered = _cached_filter(chunk_store, index, reports, filtered_index)
+    if lexical_index is not None:
+        lexical_index = _cached_filter(chunk_store, lexical_index, reports,
+                                       lambda: FilteredLexicalIndex(lexical_index, positions()))
+    return filtered, lexical_index
+
+
+def available_reports(index, chunk_store) -> list:
+    if isinstance(index, ShardedIndex):
+        return list(index.shard_specs)
+    vocabulary = getattr(chunk_store, "vocabularies", {}).get("report_name")
+    if vocabulary is not None:
+        return list(vocabulary)
+    return sorted({chunk_store.metadata(p).get("report_name") for p in range(len(chunk_store))} - {None})
+
+
+# ------------------------------------------------------------------------------
+# === SPLIT A SINGLE INDEX INTO PER-REPORT SHARDS, ADD TO THEM ===
+# ------------------------------------------------------------------------------
+def split_index(index_path: str, chunk_store, output_path: str, index_factory: str = "Flat",
+                search_params: dict = None) -> dict:
+    """
+    Writes one IndexIDMap per report (ids = global positions) built with `index_factory`
+    from the vectors of the single index; returns the shards manifest. `search_params`
+    (e.g. {"nprobe": 16}) are recorded for ANN shards; they are checked against the
+    first shard, so parameters that do not fit the factory fail here, not at search time.
+    """
+    search_params = dict(search_params or {})
+    index = faiss.read_index(index_path)
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.make_direct_map()   # needed by reconstruct_n on IVF indexes
+    vectors = index.reconstruct_n(0, index.ntotal)
+
+    tmp_path = output_path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    shards = {}
+    for i, report in enumerate(available_reports(index, chunk_store)):
+        positions = report_positions(chunk_store, [report])
+        shard = faiss.IndexIDMap(faiss.index_factory(index.d, index_factory, index.metric_type))
+        if not shard.is_trained:
+            shard.train(vectors[positions])
+        shard.add_with_ids(vectors[positions], positions)
+        apply_search_params(shard, search_params)
+        filename = f"shard_{i}.index"
+        faiss.write_index(shard, os.path.join(tmp_path, filename))
+        shards[report] = {"file": filename, "count": int(len(positions))}
+        print(f"  {report}: {len(positions)} vectors")
+
+    manifest = {"dim": index.d, "metric": int(index.metric_type), "ntotal": int(index.ntotal),
+                "index_factory": index_factory, "search_params": search_params, "shards": shards}
+    with open(os.path.join(tmp_path, "shards.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+    shutil.rmtree(output_path, ignore_errors=True)
+    os.replace(tmp_path, output_path)
+    return manifest
+
+
+def add_to_shards(path: str, vectors: np.ndarray, positions: np.ndarray, reports: list) -> dict:
+    """
+    Adds vectors (ids = their global positions) to the shards of their reports; a new
+    report gets a new shard built with the manifest's factory. Only the affected shard
+    files and the manifest (last) are rewritten. Returns the updated manifest.
+    """
+    with open(os.path.join(path, "shards.json")) as f:
+        manifest = json.load(f)
+    positions = np.asarray(positions, dtype="int64")
+    reports = np.asarray(reports, dtype=object)
+    for report in dict.fromkeys(reports.tolist()):
+        selected = reports == report
+        spec = manifest["shards"].get(report)
+        if spec is not None:
+            shard = faiss.read_index(os.path.join(path, spec["file"]))
+        else:
+            spec = {"file": f"shard_{len(manifest['shards'])}.index"}
+            shard = faiss.IndexIDMap(faiss.index_factory(manifest["dim"], manifest.get("index_factory", "Flat"),
+                                                         manifest["metric"]))
+            if not shard.is_trained:
+                shard.train(vectors[selected])
+        shard.add_with_ids(vectors[selected], positions[selected])
+        faiss.write_index(shard, os.path.join(path, spec["file"] + ".tmp"))
+        os.replace(os.path.join(path, spec["file"] + ".tmp"), os.path.join(path, spec["file"]))
+        manifest["shards"][report] = {"file": spec["file"], "count": int(shard.ntotal)}
+        print(f"  {report}: +{int(selected.sum())} vectors")
+
+    manifest["ntotal"] += len(positions)
+    with open(os.path.join(path, "shards.json.tmp"), "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(os.path.join(path, "shards.json.tmp"), os.path.join(path, "shards.json"))
+    return manifest
+
+
+def main():
+    from chunk_store import ChunkStore
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["split", "list"])
+    parser.add_argument("--index", default="/tmp/ipcc_faiss.index")
+    parser.add_argument("--chunk-store", default="/tmp/ipcc_chunk_store")
+    parser.add_argument("--shards", help="shard directory (default: <index>.shards, where rag_core looks for it)")
+    parser.add_argument("--index-factory", default="Flat", help="FAISS factory string of each shard")
+    parser.add_argument("--nprobe", type=int, help="IVF shards (default: the single index's params file)")
+    parser.add_argument("--ef-search", type=int, help="HNSW shards (default: the single index's params file)")
+    args = parser.parse_args()
+    path = args.shards or shards_path(args.index)
+
+    if args.command == "split":
+        search_params = {name: value for name, value in [("nprobe", args.nprobe), ("efSearch", args.ef_search)]
+                         if value is not None}
+        if not search_params and args.index_factory != "Flat":
+            search_params = load_search_params(args.index)
+        manifest = split_index(args.index, ChunkStore(args.chunk_store), path, args.index_factory, search_params)
+        print(f"✅ {manifest['ntotal']} vectors split into {len(manifest['shards'])} report shards in {path}.")
+    else:
+        index = ShardedIndex(path)
+        for report, spec in index.shard_specs.items():
+            print(f"{report}: {spec['count']} vectors ({spec['file']})")
+
+
+if __name__ == "__main__":
+    main()
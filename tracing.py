@@ -0,0 +1,424 @@
+"""
+Tracing and latency metrics for the RAG pipeline.
+
+Spans nest through a context variable: every `with span("name", key=value):` opened
+while another span is active becomes its child, also across the expansion thread
+pool (submit through `run_in_context`). A finished span is
+
+- observed in the `rag_span_duration_seconds` histogram (label `span`),
+- kept in a bounded in-memory buffer of recent spans,
+- appended, once its whole trace is finished, as one OTLP/JSON line to
+  `RAG_TRACE_FILE` (if set).
+
+Export:
+    prometheus_text()            Prometheus text exposition format
+    otlp_metrics() / otlp_traces()   OpenTelemetry OTLP/JSON payloads
+    serve_metrics(port)          /metrics, /metrics/otlp and /traces on a local port
+                                 (RAG_METRICS_PORT + start_metrics_server_from_env())
+    export_to_file(path)         the same payloads written to a file
+
+Set RAG_TRACING=0 to turn spans into no-ops. `profiled()` is the opt-in per-request
+profiler hook (RAG_PROFILE=cprofile|pyinstrument, output in RAG_PROFILE_DIR).
+"""
+import bisect
+import contextvars
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+TRACING_ENABLED = os.environ.get("RAG_TRACING", "1") != "0"
+TRACE_FILE = os.environ.get("RAG_TRACE_FILE")
+TRACE_BUFFER_SIZE = int(os.environ.get("RAG_TRACE_BUFFER", "10000"))
+SERVICE_NAME = os.environ.get("RAG_SERVICE_NAME", "ipcc-rag")
+
+PROFILER = os.environ.get("RAG_PROFILE", "")
+PROFILE_DIR = os.environ.get("RAG_PROFILE_DIR", "/tmp/ipcc_rag_profiles")
+
+# Seconds; from sub-millisecond FAISS searches up to slow LLM generations
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+# ------------------------------------------------------------------------------
+# === HISTOGRAMS ===
+# ------------------------------------------------------------------------------
+class Histogram:
+    """Cumulative histogram with one series per label value."""
+
+    def __init__(self, name: str, description: str, label: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label = label
+        self.buckets = tuple(buckets)
+        self.series = {}   # label value -> [bucket counts..., +Inf count], sum
+        self._lock = threading.Lock()
+
+    def observe(self, label_value: str, value: float):
+        with self._lock:
+            counts, total = self.series.get(label_value, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.series[label_value] = (counts, total + value)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {label_value: (list(counts), total) for label_value, (counts, total) in self.series.items()}
+
+    def reset(self):
+        with self._lock:
+            self.series.clear()
+
+
+span_duration = Histogram("rag_span_duration_seconds", "Duration of pipeline spans.", "span")
+stage_latency = Histogram("rag_stage_seconds", "Latencies that are not spans (e.g. time to first token).", "stage")
+HISTOGRAMS = (span_duration, stage_latency)
+
+
+def observe(stage: str, seconds: float):
+    if TRACING_ENABLED:
+        stage_latency.observe(stage, seconds)
+
+
+# ------------------------------------------------------------------------------
+# === SPANS ===
+# ------------------------------------------------------------------------------
+class Span:
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "start", "end", "attributes", "error")
+
+    def __init__(self, name: str, parent=None, attributes: dict = None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent is not None else f"{random.getrandbits(128):032x}"
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent.span_id if parent is not None else None
+        self.start = time.time()
+        self.end = None
+        self.attributes = dict(attributes or {})
+        self.error = None
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def set_attributes(self, **attributes):
+        self.attributes.update(attributes)
+
+    @property
+    def duration(self) -> float:
+        return (self.end or time.time()) - self.start
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name, "trace_id": self.trace_id, "span_id": self.span_id, "parent_id": self.parent_id,
+            "start": self.start, "end": self.end, "attributes": self.attributes, "error": self.error,
+        }
+
+
+class _NoopSpan:
+    trace_id = span_id = parent_id = None
+    attributes = {}
+
+    def set_attribute(self, key, value):
+        pass
+
+    def set_attributes(self, **attributes):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+_current_span = contextvars.ContextVar("rag_current_span", default=None)
+
+
+class Tracer:
+    def __init__(self, buffer_size: int = TRACE_BUFFER_SIZE, trace_file: str = TRACE_FILE):
+        self.finished = deque(maxlen=buffer_size)
+        self.trace_file = trace_file
+        self._open_traces = {}   # trace_id -> [open span count, finished spans]
+        self._lock = threading.Lock()
+        self._file_lock = threading.Lock()
+
+    def start_span(self, name: str, parent=None, **attributes) -> Span:
+        """Starts a span without making it current (see `use_span`); parent defaults to the current span."""
+        parent = parent if parent is not None else _current_span.get()
+        span = Span(name, parent, attributes)
+        with self._lock:
+            self._open_traces.setdefault(span.trace_id, [0, []])[0] += 1
+        return span
+
+    def end_span(self, span: Span):
+        span.end = time.time()
+        span_duration.observe(span.name, span.end - span.start)
+        with self._lock:
+            self.finished.append(span)
+            trace = self._open_traces[span.trace_id]
+            trace[0] -= 1
+            trace[1].append(span)
+            done = trace[1] if trace[0] == 0 else None
+            if done is not None:
+                del self._open_traces[span.trace_id]
+        if done is not None and self.trace_file:
+            self._write_trace(done)
+
+    def _write_trace(self, spans: list):
+        line = json.dumps(otlp_traces(spans), separators=(",", ":"))
+        with self._file_lock, open(self.trace_file, "a") as f:
+            f.write(line + "\n")
+
+    def recent_spans(self, limit: int = None) -> list:
+        with self._lock:
+            spans = list(self.finished)
+        return spans[-limit:] if limit else spans
+
+
+tracer = Tracer()
+
+
+@contextmanager
+def use_span(span):
+    """Makes `span` the current span inside the block (does not end it)."""
+    token = _current_span.set(span)
+    try:
+        yield span
+    finally:
+        _current_span.reset(token)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """Child of the current span (or a new trace); yields the span to add attributes to."""
+    if not TRACING_ENABLED:
+        yield NOOP_SPAN
+        return
+    current = tracer.start_span(name, **attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current_span.reset(token)
+        tracer.end_span(current)
+
+
+def start_span(name: str, **attributes):
+    """For spans that outlive one block (e.g. across generator yields); end with `end_span`."""
+    return tracer.start_span(name, **attributes) if TRACING_ENABLED else NOOP_SPAN
+
+
+def end_span(span_, error: str = None):
+    if span_ is not NOOP_SPAN and span_.end is None:
+        span_.error = error
+        tracer.end_span(span_)
+
+
+def current_span():
+    return _current_span.get() or NOOP_SPAN
+
+
+def run_in_context(fn):
+    """Wraps `fn` to run in a copy of the caller's context (keeps span nesting in thread pools)."""
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(fn, *args, **kwargs)
+
+
+# ------------------------------------------------------------------------------
+# === EXPORT: PROMETHEUS TEXT / OTLP JSON ===
+# ------------------------------------------------------------------------------
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def prometheus_text() -> str:
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.append(f"# HELP {histogram.name} {histogram.description}")
+        lines.append(f"# TYPE {histogram.name} histogram")
+        for label_value, (counts, total) in sorted(histogram.snapshot().items()):
+            label = f'{histogram.label}="{_escape(label_value)}"'
+            cumulative = 0
+            for bound, count in zip(list(histogram.buckets) + ["+Inf"], counts):
+                cumulative += count
+                lines.append(f'{histogram.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f"{histogram.name}_sum{{{label}}} {total}")
+            lines.append(f"{histogram.name}_count{{{label}}} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    if isinstance(value, (list, tuple)):
+        return {"arrayValue": {"values": [_otlp_value(v) for v in value]}}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes: dict) -> list:
+    return [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items() if value is not None]
+
+
+def _resource() -> dict:
+    return {"attributes": _otlp_attributes({"service.name": SERVICE_NAME})}
+
+
+def otlp_traces(spans: list = None) -> dict:
+    """OTLP/JSON `ExportTraceServiceRequest` for `spans` (default: the recent-span buffer)."""
+    spans = tracer.recent_spans() if spans is None else spans
+    otlp_spans = []
+    for s in spans:
+        otlp_span = {
+            "traceId": s.trace_id,
+            "spanId": s.span_id,
+            "name": s.name,
+            "kind": 1,
+            "startTimeUnixNano": str(int(s.start * 1e9)),
+            "endTimeUnixNano": str(int(s.end * 1e9)),
+            "attributes": _otlp_attributes(s.attributes),
+            "status": {"code": 2, "message": s.error} if s.error else {"code": 1},
+        }
+        if s.parent_id:
+            otlp_span["parentSpanId"] = s.parent_id
+        otlp_spans.append(otlp_span)
+    return {"resourceSpans": [{"resource": _resource(),
+                               "scopeSpans": [{"scope": {"name": "rag_core"}, "spans": otlp_spans}]}]}
+
+
+_START_TIME_NANO = str(time.time_ns())
+
+
+def otlp_metrics() -> dict:
+    """OTLP/JSON `ExportMetricsServiceRequest` with the cumulative histograms."""
+    now = str(time.time_ns())
+    metrics = []
+    for histogram in HISTOGRAMS:
+        data_points = [
+            {
+                "attributes": _otlp_attributes({histogram.label: label_value}),
+                "startTimeUnixNano": _START_TIME_NANO,
+                "timeUnixNano": now,
+                "count": str(sum(counts)),
+                "sum": total,
+                "bucketCounts": [str(c) for c in counts],
+                "explicitBounds": list(histogram.buckets),
+            }
+            for label_value, (counts, total) in sorted(histogram.snapshot().items())
+        ]
+        metrics.append({"name": histogram.name, "description": histogram.description, "unit": "s",
+                        "histogram": {"dataPoints": data_points, "aggregationTemporality": 2}})
+    return {"resourceMetrics": [{"resource": _resource(),
+                                 "scopeMetrics": [{"scope": {"name": "rag_core"}, "metrics": metrics}]}]}
+
+
+def export_to_file(path: str, fmt: str = "prometheus"):
+    """Writes the metrics ("prometheus" or "otlp") or the recent traces ("traces") to `path`."""
+    if fmt == "prometheus":
+        payload = prometheus_text()
+    elif fmt == "otlp":
+        payload = json.dumps(otlp_metrics())
+    elif fmt == "traces":
+        payload = json.dumps(otlp_traces())
+    else:
+        raise ValueError(f"Unknown export format {fmt!r}, expected 'prometheus', 'otlp' or 'traces'")
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(payload)
+    os.replace(tmp_path, path)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path == "/metrics":
+            body, content_type = prometheus_text(), "text/plain; version=0.0.4"
+        elif path == "/metrics/otlp":
+            body, content_type = json.dumps(otlp_metrics()), "application/json"
+        elif path == "/traces":
+            body, content_type = json.dumps(otlp_traces()), "application/json"
+        else:
+            self.send_error(404)
+            return
+        data = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_metrics_server = None
+
+
+def serve_metrics(port: int, host: str = "127.0.0.1"):
+    """Serves the exports from a daemon thread; calling it again returns the running server."""
+    global _metrics_server
+    if _metrics_server is None:
+        _metrics_server = ThreadingHTTPServer((host, port), _MetricsHandler)
+        threading.Thread(target=_metrics_server.serve_forever, name="rag-metrics", daemon=True).start()
+        print(f"✅ Metrics served on http://{host}:{_metrics_server.server_address[1]}/metrics.")
+    return _metrics_server
+
+
+def start_metrics_server_from_env():
+    if os.environ.get("RAG_METRICS_PORT"):
+        return serve_metrics(int(os.environ["RAG_METRICS_PORT"]), os.environ.get("RAG_METRICS_HOST", "127.0.0.1"))
+    return None
+
+
+# ------------------------------------------------------------------------------
+# === OPT-IN PER-REQUEST PROFILER ===
+# ------------------------------------------------------------------------------
+@contextmanager
+def profiled(name: str, backend: str = None):
+    """
+    Profiles the block with cProfile (`.prof`, open with pstats / snakeviz) or
+    pyinstrument (`.html`) and yields a dict whose "path" is set on exit. Only the
+    calling thread is profiled, which is where retrieval, rerank and prompt
+    packing run. Without a backend (argument or RAG_PROFILE) this is a no-op.
+    """
+    backend = backend or PROFILER
+    result = {"path": None}
+    if not backend:
+        yield result
+        return
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    trace_id = current_span().trace_id or f"{random.getrandbits(64):016x}"
+    base_path = os.path.join(PROFILE_DIR, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}-{trace_id[:16]}")
+
+    if backend == "pyinstrument":
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            print("⚠️ pyinstrument is not installed, request not profiled.")
+            yield result
+            return
+        profiler = Profiler()
+        profiler.start()
+        try:
+            yield result
+        finally:
+            profiler.stop()
+            result["path"] = base_path + ".html"
+            with open(result["path"], "w") as f:
+                f.write(profiler.output_html())
+    elif backend == "cprofile":
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield result
+        finally:
+            profiler.disable()
+            result["path"] = base_path + ".prof"
+            profiler.dump_stats(result["path"])
+    else:
+        raise ValueError(f"Unknown profiler {backend!r}, expected 'cprofile' or 'pyinstrument'")
+    current_span().set_attribute("profile_path", result["path"])